@@ -0,0 +1,141 @@
+"""
+Кэш заранее собранных архивов.
+
+Архив определяется набором вошедших в него файлов, поэтому имя файла в кэше
+содержит отпечаток списка файлов (ключи, размеры и контрольные суммы из индекса).
+Если файлы пользователя удалены или перенесены, отпечаток меняется и устаревший
+архив просто перестаёт находиться; такие архивы удаляются по истечении
+ARCHIVE_CACHE_TTL.
+"""
+
+import asyncio
+import hashlib
+import os
+import time
+from pathlib import Path
+
+from config import settings
+from loguru import logger
+from metrics import counter
+from storage import StoredObject
+
+cache_requests = counter(
+    "archiver_archive_cache_requests_total",
+    "Запросы архивов к кэшу заранее собранных архивов",
+)
+
+
+def cache_dir() -> Path:
+    """Директория кэша архивов."""
+    return Path(settings.ARCHIVE_CACHE_DIR or Path(settings.FILES_DIR) / ".archives")
+
+
+def cache_path(user_id: int, objects: list[StoredObject]) -> Path:
+    """Путь к архиву с указанными файлами в кэше."""
+    digest = hashlib.sha256()
+    for obj in objects:
+        digest.update(f"{obj.key}\0{obj.size}\0{obj.sha256}\n".encode())
+    return cache_dir() / f"user_{user_id}_{digest.hexdigest()[:32]}.zip"
+
+
+async def lookup(user_id: int, objects: list[StoredObject]) -> Path | None:
+    """
+    Ищет в кэше архив с указанными файлами.
+
+    Args:
+        user_id: ID пользователя
+        objects: Файлы, которые должны войти в архив
+
+    Returns:
+        Путь к архиву или None, если его нет в кэше
+    """
+    path = cache_path(user_id, objects)
+    found = await asyncio.to_thread(path.is_file)
+    cache_requests.inc(result="hit" if found else "miss")
+    return path if found else None
+
+
+async def store(archive_path: str, path: Path) -> None:
+    """Атомарно помещает собранный архив в кэш."""
+    await asyncio.to_thread(os.replace, archive_path, path)
+
+
+def _remove_user_sync(user_id: int) -> None:
+    for path in cache_dir().glob(f"user_{user_id}_*.zip"):
+        path.unlink(missing_ok=True)
+
+
+async def remove_user(user_id: int) -> None:
+    """Удаляет из кэша все архивы пользователя."""
+    await asyncio.to_thread(_remove_user_sync, user_id)
+
+
+def _purge_sync(max_age: float) -> int:
+    directory = cache_dir()
+    if not directory.is_dir():
+        return 0
+
+    removed = 0
+    deadline = time.time() - max_age
+    for path in directory.iterdir():
+        try:
+            if path.stat().st_mtime < deadline:
+                path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            continue
+    return removed
+
+
+async def purge_expired() -> int:
+    """
+    Удаляет архивы, пролежавшие в кэше дольше ARCHIVE_CACHE_TTL.
+
+    Returns:
+        Количество удалённых архивов
+    """
+    removed = await asyncio.to_thread(_purge_sync, settings.ARCHIVE_CACHE_TTL)
+    if removed:
+        logger.debug("Из кэша удалено {} устаревших архивов", removed)
+    return removed
+
+
+def _trim_sync(needed: int) -> int:
+    directory = cache_dir()
+    if not directory.is_dir():
+        return 0
+
+    archives = []
+    for path in directory.iterdir():
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        archives.append((stat.st_mtime, stat.st_size, path))
+
+    freed = 0
+    for _mtime, size, path in sorted(archives):
+        if freed >= needed:
+            break
+        path.unlink(missing_ok=True)
+        freed += size
+    return freed
+
+
+async def trim(needed: int) -> int:
+    """
+    Удаляет самые старые архивы, пока не освободится `needed` байт.
+
+    Архивы из кэша можно собрать заново, поэтому при нехватке места они
+    удаляются раньше файлов пользователей.
+
+    Args:
+        needed: Сколько байт нужно освободить
+
+    Returns:
+        Освобождённый объём, байт
+    """
+    freed = await asyncio.to_thread(_trim_sync, needed)
+    if freed:
+        logger.info("Из кэша архивов удалено {} байт", freed)
+    return freed
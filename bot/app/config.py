@@ -1,4 +1,7 @@
-from pydantic import Field
+from datetime import time
+from typing import Literal
+
+from pydantic import Field, model_validator
 from pydantic_settings import BaseSettings
 
 
@@ -6,6 +9,144 @@ class Settings(BaseSettings):
     TELEGRAM_BOT_TOKEN: str
     FILES_DIR: str = Field(default="files")
     SENTRY_DSN: str | None = Field(default=None)
+    # Цикл событий uvloop вместо стандартного asyncio (требует uv sync --extra uvloop)
+    USE_UVLOOP: bool = Field(default=False)
+
+    # Раскладка директорий пользователей: flat - FILES_DIR/<user_id>,
+    # sharded - FILES_DIR/ab/cd/<user_id> по хешу ID (для большого числа пользователей)
+    FILES_LAYOUT: Literal["flat", "sharded"] = Field(default="flat")
+
+    # Хранилище индекса файлов: sqlite - локальная база, redis - общий Redis
+    # (REDIS_URL). По умолчанию redis, если задан REDIS_URL: индекс - единственный
+    # источник списка файлов и должен быть общим для всех реплик, а SQLite нельзя
+    # разделять между хостами. sqlite с несколькими репликами допустим, только
+    # если они работают на одном хосте и INDEX_DB_PATH лежит на общем томе
+    INDEX_BACKEND: Literal["sqlite", "redis"] | None = Field(default=None)
+    # База индекса в SQLite; по умолчанию FILES_DIR/index.sqlite3
+    INDEX_DB_PATH: str | None = Field(default=None)
+
+    # Хранилище файлов: локальная директория FILES_DIR или S3-совместимый бакет
+    STORAGE_BACKEND: Literal["local", "s3"] = Field(default="local")
+    S3_ENDPOINT_URL: str | None = Field(default=None)
+    S3_BUCKET: str | None = Field(default=None)
+    S3_REGION: str | None = Field(default=None)
+    S3_ACCESS_KEY_ID: str | None = Field(default=None)
+    S3_SECRET_ACCESS_KEY: str | None = Field(default=None)
+    # Размер части multipart-загрузки (S3 требует не меньше 5 Мб)
+    S3_MULTIPART_CHUNK_SIZE: int = Field(default=8 * 1024 * 1024, ge=5 * 1024 * 1024)
+
+    # Потоки для файловых операций при сохранении файлов (см. fileio.py)
+    FILE_IO_THREADS: int = Field(default=8, ge=1)
+
+    # Чтение файлов при сборке архива: размер блока и число файлов, читаемых наперёд
+    ARCHIVE_CHUNK_SIZE: int = Field(default=1024 * 1024, gt=0)
+    ARCHIVE_READ_AHEAD: int = Field(default=4, ge=1)
+
+    # Предварительная сборка вчерашних архивов в непиковое время (None - отключена):
+    # время запуска, приоритет потока сжатия (nice) и доля времени, которую
+    # сборка может занимать
+    ARCHIVE_PREBUILD_TIME: time | None = Field(default=None)
+    ARCHIVE_PREBUILD_NICE: int = Field(default=10, ge=0, le=19)
+    ARCHIVE_PREBUILD_BUDGET: float = Field(default=0.25, gt=0, le=1)
+    # Кэш собранных архивов; по умолчанию FILES_DIR/.archives
+    ARCHIVE_CACHE_DIR: str | None = Field(default=None)
+    ARCHIVE_CACHE_TTL: int = Field(default=2 * 24 * 60 * 60, gt=0)
+
+    # Пакеты для небольших файлов (только для STORAGE_BACKEND=local): файлы не
+    # больше PACK_MAX_FILE_SIZE дописываются в общий файл пользователя за день.
+    # Пакет уплотняется, когда доля удалённых из него данных превышает
+    # PACK_COMPACT_RATIO
+    PACK_SMALL_FILES: bool = Field(default=False)
+    PACK_MAX_FILE_SIZE: int = Field(default=64 * 1024, gt=0)
+    PACK_COMPACT_RATIO: float = Field(default=0.5, gt=0, lt=1)
+
+    # Общий Redis для нескольких реплик: FSM-хранилище и блокировки пользователей
+    REDIS_URL: str | None = Field(default=None)
+    # Соединений с Redis на реплику; остальные операции ждут свободное
+    REDIS_POOL_SIZE: int = Field(default=50, gt=0)
+    # Время жизни блокировки пользователя, если реплика перестала её продлевать
+    USER_LOCK_TIMEOUT: int = Field(default=60, gt=0)
+    # Сколько простаивающих очередей и блокировок пользователей держать в памяти
+    USER_LANES_MAX_IDLE: int = Field(default=10_000, ge=0)
+
+    # Режим вебхука: если WEBHOOK_URL задан, бот принимает обновления по HTTP
+    WEBHOOK_URL: str | None = Field(default=None)
+    WEBHOOK_PATH: str = Field(default="/webhook")
+    WEBHOOK_SECRET: str | None = Field(default=None)
+    WEBHOOK_HOST: str = Field(default="0.0.0.0")
+    WEBHOOK_PORT: int = Field(default=8080)
+
+    # Правила хранения файлов (None - правило отключено)
+    RETENTION_MAX_AGE_DAYS: int | None = Field(default=None, gt=0)
+    RETENTION_MAX_USER_BYTES: int | None = Field(default=None, gt=0)
+    RETENTION_DELETE_AFTER_ARCHIVE: bool = Field(default=False)
+    # Доля свободного места на диске: ниже LOW начинается удаление самых старых
+    # файлов всех пользователей, которое продолжается до HIGH
+    DISK_FREE_LOW_WATERMARK: float | None = Field(default=None, gt=0, lt=1)
+    DISK_FREE_HIGH_WATERMARK: float = Field(default=0.2, gt=0, lt=1)
+    # Периодичность очистки и темп удаления
+    SWEEP_INTERVAL: int = Field(default=60 * 60, gt=0)
+    SWEEP_BATCH_SIZE: int = Field(default=100, gt=0)
+    SWEEP_BATCH_DELAY: float = Field(default=0.5, ge=0)
+
+    # Фоновая проверка контрольных сумм файлов: ограничение скорости чтения
+    # (None - проверка отключена) и период повторной проверки каждого файла
+    SCRUB_BYTES_PER_SECOND: int | None = Field(default=None, gt=0)
+    SCRUB_INTERVAL: int = Field(default=7 * 24 * 60 * 60, gt=0)
+
+    # Логи (см. logs.py): уровень, формат (json - для систем сбора логов) и
+    # ограничение частоты: не больше LOG_RATE_LIMIT сообщений в секунду с одного
+    # места в коде (None - без ограничения; предупреждения и ошибки не
+    # ограничиваются). При переполнении очереди записи сообщения отбрасываются
+    LOG_LEVEL: Literal["TRACE", "DEBUG", "INFO", "WARNING", "ERROR"] = Field(
+        default="INFO"
+    )
+    LOG_FORMAT: Literal["text", "json"] = Field(default="text")
+    LOG_RATE_LIMIT: float | None = Field(default=20, gt=0)
+    LOG_QUEUE_SIZE: int = Field(default=10_000, ge=1)
+
+    # Порт HTTP-сервера с метриками Prometheus (None - не запускать)
+    METRICS_PORT: int | None = Field(default=None)
+
+    # Адрес собственного сервера Bot API (None - api.telegram.org)
+    TELEGRAM_API_URL: str | None = Field(default=None)
+
+    # Пул HTTP-соединений с серверами Telegram
+    HTTP_POOL_SIZE: int = Field(default=100, ge=1)
+    HTTP_POOL_PER_HOST: int = Field(default=0, ge=0)  # 0 - без ограничения
+    HTTP_KEEPALIVE_TIMEOUT: float = Field(default=60, gt=0)
+    HTTP_TIMEOUT: int = Field(default=60, gt=0)
+    HTTP_PROXY: str | None = Field(default=None)
+
+    # Скачивание файлов: размер блока, таймауты и повторы с докачкой
+    DOWNLOAD_CHUNK_SIZE: int = Field(default=256 * 1024, gt=0)
+    # Таймаут чтения и базовая часть общего таймаута, к которой добавляется
+    # время скачивания файла на минимальной ожидаемой скорости (байт/с)
+    DOWNLOAD_TIMEOUT: int = Field(default=30, gt=0)
+    DOWNLOAD_MIN_SPEED: int = Field(default=256 * 1024, gt=0)
+    DOWNLOAD_MAX_RETRIES: int = Field(default=5, ge=0)
+    DOWNLOAD_RETRY_DELAY: float = Field(default=0.5, gt=0)
+    DOWNLOAD_RETRY_MAX_DELAY: float = Field(default=30, gt=0)
+
+    # Лимиты исходящих запросов (https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this)
+    THROTTLE_GLOBAL_RATE: float = Field(default=30, gt=0)
+    THROTTLE_CHAT_RATE: float = Field(default=1, gt=0)
+    THROTTLE_GROUP_RATE: float = Field(default=20 / 60, gt=0)
+    THROTTLE_CHAT_BURST: float = Field(default=3, ge=1)
+    THROTTLE_MAX_RETRIES: int = Field(default=3, ge=0)
+
+    @model_validator(mode="after")
+    def check_consistency(self) -> "Settings":
+        """Проверяет сочетания настроек, которые по отдельности допустимы."""
+        low = self.DISK_FREE_LOW_WATERMARK
+        if low is not None and low >= self.DISK_FREE_HIGH_WATERMARK:
+            raise ValueError(
+                "DISK_FREE_LOW_WATERMARK должен быть меньше DISK_FREE_HIGH_WATERMARK, "
+                "иначе при нехватке места очистка ничего не удаляет"
+            )
+        if self.INDEX_BACKEND == "redis" and not self.REDIS_URL:
+            raise ValueError("Для INDEX_BACKEND=redis необходимо задать REDIS_URL")
+        return self
 
 
 settings = Settings()
@@ -0,0 +1,52 @@
+"""
+Пул потоков для файловых операций при сохранении файлов.
+
+Блокирующие вызовы (открытие, запись, переименование, хеширование) выполняются
+в отдельном ограниченном пуле FILE_IO_THREADS: медленный диск (например, сетевой
+том) не задерживает цикл событий и не занимает общий пул `asyncio.to_thread`,
+в котором работают индекс и сборка архивов. io_uring из стандартной библиотеки
+Python недоступен, поэтому используется пул потоков.
+"""
+
+import asyncio
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, BinaryIO, TypeVar
+
+from config import settings
+
+T = TypeVar("T")
+
+_executor = ThreadPoolExecutor(
+    max_workers=settings.FILE_IO_THREADS, thread_name_prefix="file-io"
+)
+
+
+def run_io(func: Callable[..., T], *args: Any) -> "asyncio.Future[T]":
+    """
+    Выполняет блокирующую файловую операцию в пуле.
+
+    Возвращает future, поэтому операцию можно запустить и дождаться позже
+    (например, записывать блок, пока из сети читается следующий).
+    """
+    return asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+
+def open_creating_dirs(path: Path, mode: str) -> BinaryIO:
+    """
+    Открывает файл, создавая директории, только если их ещё нет.
+
+    В обычном случае директория уже существует, и вместо mkdir на каждое
+    сохранение выполняется один системный вызов open.
+    """
+    try:
+        return open(path, mode)  # type: ignore[return-value]
+    except FileNotFoundError:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return open(path, mode)  # type: ignore[return-value]
+
+
+def shutdown() -> None:
+    """Останавливает пул, дождавшись начатых операций."""
+    _executor.shutdown(wait=True)
@@ -1,17 +1,20 @@
+import html
 import os
-from datetime import datetime
 from pathlib import Path
 
 from aiogram import Bot, Router
 from aiogram.filters import Command, CommandStart
 from aiogram.types import BufferedInputFile, Message
+from locks import user_lock
 from loguru import logger
 from services import (
     clear_user_files,
     create_user_archive,
-    create_user_archive_by_date,
     format_file_size,
     get_user_files_stats,
+    has_user_files,
+    mark_archive_sent,
+    parse_archive_filter,
     save_user_files,
 )
 
@@ -35,7 +38,7 @@ async def start_command_handler(message: Message) -> None:
         message.from_user.username or message.from_user.first_name or "Пользователь"
     )
 
-    logger.debug(f"Получена команда /start от пользователя {user_id} (@{username})")
+    logger.debug("Получена команда /start от пользователя {} (@{})", user_id, username)
 
     welcome_text = (
         f"👋 Привет, {username}!\n\n"
@@ -55,9 +58,10 @@ async def start_command_handler(message: Message) -> None:
 @router.message(Command("archive"))
 async def archive_command_handler(message: Message, bot: Bot) -> None:
     """
-    Обработчик команды /archive и /archive YYYY-MM-DD.
+    Обработчик команды /archive с необязательными фильтрами.
 
-    Создаёт zip-архив со всеми файлами пользователя или с файлами за указанную дату.
+    Создаёт zip-архив со всеми файлами пользователя или с файлами, отобранными по
+    типу, дате и размеру (например, `/archive photo 2024-01-15`).
     """
     if message.from_user is None:
         logger.error("Получено сообщение без данных пользователя")
@@ -68,139 +72,91 @@ async def archive_command_handler(message: Message, bot: Bot) -> None:
         message.from_user.username or message.from_user.first_name or "Пользователь"
     )
 
-    # Извлекаем дату из команды, если она есть
+    # Извлекаем фильтры из команды, если они есть
     if message.text is None:
         logger.error("Получено сообщение без текста")
         return
 
-    command_text = message.text.strip()
-    parts = command_text.split()
+    try:
+        archive_filter = parse_archive_filter(message.text.split()[1:])
+    except ValueError as e:
+        await message.answer(f"❌ {html.escape(str(e))}")
+        return
+
+    description = archive_filter.describe()
+    logger.debug(
+        "Получена команда /archive {} от пользователя {} (@{})",
+        description,
+        user_id,
+        username,
+    )
 
-    if len(parts) == 2:
-        # Команда с датой: /archive YYYY-MM-DD
-        target_date = parts[1]
+    # Отправляем сообщение о начале создания архива
+    if archive_filter:
+        status_message = await message.answer(
+            f"📦 Создаю архив с файлами: {description}..."
+        )
+    else:
+        status_message = await message.answer("📦 Создаю архив с вашими файлами...")
 
-        # Проверяем формат даты
-        try:
-            datetime.strptime(target_date, "%Y-%m-%d")
-        except ValueError:
-            await message.answer(
-                "❌ Неверный формат даты. Используйте формат YYYY-MM-DD (например: 2024-01-15)"
-            )
+    try:
+        # Создаём архив
+        async with user_lock(user_id):
+            archive = await create_user_archive(user_id, archive_filter)
+
+        if archive is None:
+            if archive_filter:
+                text = f"📁 У вас нет сохранённых файлов: {description}."
+            else:
+                text = "📁 У вас нет сохранённых файлов для создания архива."
+            await status_message.edit_text(text)
             return
 
-        logger.debug(
-            f"Получена команда /archive {target_date} от пользователя {user_id} (@{username})"
+        # Читаем архив и отправляем его пользователю
+        archive_file = Path(archive.path)
+        with open(archive_file, "rb") as file:
+            archive_data = file.read()
+
+        # Создаём имя файла для архива
+        archive_filename = (
+            f"archive_{username}_{user_id}{archive_filter.filename_suffix()}.zip"
         )
 
-        # Отправляем сообщение о начале создания архива
-        status_message = await message.answer(
-            f"📦 Создаю архив с файлами за {target_date}..."
+        # Отправляем архив как документ
+        document = BufferedInputFile(archive_data, filename=archive_filename)
+        if archive_filter:
+            caption = f"📦 Ваш архив с файлами готов: {description}"
+        else:
+            caption = "📦 Ваш архив с сохранёнными файлами готов!"
+        await bot.send_document(
+            chat_id=message.chat.id,
+            document=document,
+            caption=caption,
         )
 
-        try:
-            # Создаём архив за указанную дату
-            archive_path = await create_user_archive_by_date(
-                user_id=user_id,
-                target_date=target_date,
-            )
-
-            if archive_path is None:
-                await status_message.edit_text(
-                    f"📁 У вас нет сохранённых файлов за {target_date}."
-                )
-                return
-
-            # Читаем архив и отправляем его пользователю
-            archive_file = Path(archive_path)
-            with open(archive_file, "rb") as file:
-                archive_data = file.read()
-
-            # Создаём имя файла для архива
-            archive_filename = f"archive_{username}_{user_id}_{target_date}.zip"
-
-            # Отправляем архив как документ
-            document = BufferedInputFile(archive_data, filename=archive_filename)
-            await bot.send_document(
-                chat_id=message.chat.id,
-                document=document,
-                caption=f"📦 Ваш архив с файлами за {target_date} готов!",
-            )
-
-            # Удаляем сообщение о статусе
-            await status_message.delete()
-
-            logger.info(f"Архив за {target_date} отправлен пользователю {user_id}")
-
-        except Exception as e:
-            logger.error(
-                f"Ошибка при отправке архива за {target_date} пользователю {user_id}: {e}"
-            )
-            await status_message.edit_text(
-                "❌ Произошла ошибка при создании архива. Попробуйте позже."
-            )
-        finally:
-            # Удаляем временный файл архива, если он существует
-            if "archive_path" in locals() and archive_path:
-                try:
-                    os.unlink(archive_path)
-                    logger.debug(f"Удалён временный архив {archive_path}")
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении временного архива: {e}")
+        await mark_archive_sent(archive)
 
-    else:
-        # Обычная команда /archive без даты
-        logger.debug(
-            f"Получена команда /archive от пользователя {user_id} (@{username})"
-        )
+        # Удаляем сообщение о статусе
+        await status_message.delete()
 
-        # Отправляем сообщение о начале создания архива
-        status_message = await message.answer("📦 Создаю архив с вашими файлами...")
+        logger.info(
+            "Архив ({}) отправлен пользователю {}", description or "все файлы", user_id
+        )
 
-        try:
-            # Создаём архив
-            archive_path = await create_user_archive(user_id)
-
-            if archive_path is None:
-                await status_message.edit_text(
-                    "📁 У вас нет сохранённых файлов для создания архива."
-                )
-                return
-
-            # Читаем архив и отправляем его пользователю
-            archive_file = Path(archive_path)
-            with open(archive_file, "rb") as file:
-                archive_data = file.read()
-
-            # Создаём имя файла для архива
-            archive_filename = f"archive_{username}_{user_id}.zip"
-
-            # Отправляем архив как документ
-            document = BufferedInputFile(archive_data, filename=archive_filename)
-            await bot.send_document(
-                chat_id=message.chat.id,
-                document=document,
-                caption="📦 Ваш архив с сохранёнными файлами готов!",
-            )
-
-            # Удаляем сообщение о статусе
-            await status_message.delete()
-
-            logger.info(f"Архив отправлен пользователю {user_id}")
-
-        except Exception as e:
-            logger.error(f"Ошибка при отправке архива пользователю {user_id}: {e}")
-            await status_message.edit_text(
-                "❌ Произошла ошибка при создании архива. Попробуйте позже."
-            )
-        finally:
-            # Удаляем временный файл архива, если он существует
-            if "archive_path" in locals() and archive_path:
-                try:
-                    os.unlink(archive_path)
-                    logger.debug(f"Удалён временный архив {archive_path}")
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении временного архива: {e}")
+    except Exception as e:
+        logger.error("Ошибка при отправке архива пользователю {}: {}", user_id, e)
+        await status_message.edit_text(
+            "❌ Произошла ошибка при создании архива. Попробуйте позже."
+        )
+    finally:
+        # Удаляем временный файл архива, если он существует (архивы из кэша
+        # остаются в кэше)
+        if "archive" in locals() and archive and not archive.cached:
+            try:
+                os.unlink(archive.path)
+                logger.debug("Удалён временный архив {}", archive.path)
+            except Exception as e:
+                logger.error("Ошибка при удалении временного архива: {}", e)
 
 
 # MARK: Clear
@@ -220,9 +176,10 @@ async def clear_command_handler(message: Message) -> None:
         message.from_user.username or message.from_user.first_name or "Пользователь"
     )
 
-    logger.debug(f"Получена команда /clear от пользователя {user_id} (@{username})")
+    logger.debug("Получена команда /clear от пользователя {} (@{})", user_id, username)
 
-    deleted_count = await clear_user_files(user_id)
+    async with user_lock(user_id):
+        deleted_count = await clear_user_files(user_id)
 
     if deleted_count > 0:
         response_text = f"🗑️ Удалено файлов: {deleted_count}"
@@ -249,7 +206,7 @@ async def help_command_handler(message: Message) -> None:
         message.from_user.username or message.from_user.first_name or "Пользователь"
     )
 
-    logger.debug(f"Получена команда /help от пользователя {user_id} (@{username})")
+    logger.debug("Получена команда /help от пользователя {} (@{})", user_id, username)
 
     help_text = (
         "📋 **Доступные команды:**\n\n"
@@ -258,12 +215,14 @@ async def help_command_handler(message: Message) -> None:
         "/stats - Показать статистику по сохранённым файлам\n"
         "/archive - Создать и получить zip-архив со всеми вашими файлами\n"
         "/archive YYYY-MM-DD - Создать архив только с файлами за указанную дату\n"
+        "/archive photo doc >1MB <50MB 2024-01-01..2024-01-31 - Фильтры архива по типу, размеру и датам\n"
         "/clear - Удалить все ваши сохранённые файлы\n\n"
         "📁 **Работа с файлами:**\n"
         "• Отправьте любой файл, фото, видео, аудио, документ или стикер - бот автоматически сохранит его\n"
         "• Используйте /stats для просмотра статистики файлов\n"
         "• Используйте /archive для получения архива с вашими файлами\n"
         "• Используйте /archive YYYY-MM-DD для получения архива с файлами за конкретную дату\n"
+        "• Фильтры можно сочетать: /archive photo 2024-01-15, /archive video >10MB\n"
         "• Используйте /clear для удаления всех сохранённых файлов"
     )
 
@@ -287,10 +246,10 @@ async def stats_command_handler(message: Message) -> None:
         message.from_user.username or message.from_user.first_name or "Пользователь"
     )
 
-    logger.debug(f"Получена команда /stats от пользователя {user_id} (@{username})")
+    logger.debug("Получена команда /stats от пользователя {} (@{})", user_id, username)
 
     # Получаем статистику файлов
-    stats = get_user_files_stats(user_id=user_id)
+    stats = await get_user_files_stats(user_id=user_id)
 
     if stats["total_files"] == 0:
         await message.answer("📁 У вас нет сохранённых файлов.")
@@ -326,16 +285,21 @@ async def message_handler(message: Message, bot: Bot) -> None:
         logger.error("Получено сообщение без данных пользователя")
         return
 
-    user_id = message.from_user.id
-    username = (
-        message.from_user.username or message.from_user.first_name or "Пользователь"
-    )
+    user = message.from_user
+    user_id = user.id
 
-    logger.debug(f"Получено сообщение от пользователя {user_id} (@{username})")
+    # Обработчик вызывается на каждое сообщение: имя вычисляется, только если
+    # DEBUG включён
+    logger.opt(lazy=True).debug(
+        "Получено сообщение от пользователя {} (@{})",
+        lambda: user_id,
+        lambda: user.username or user.first_name or "Пользователь",
+    )
 
-    # Сохраняем файлы, если они есть в сообщении
-    saved_files = await save_user_files(message=message, bot=bot)
+    # Текстовым сообщениям блокировка не нужна: сохранять нечего
+    if not has_user_files(message):
+        return
 
-    if saved_files:
-        files_count = len(saved_files)
-        logger.info(f"Сохранено {files_count} файлов для пользователя {user_id}")
+    # Сохраняем файлы из сообщения
+    async with user_lock(user_id):
+        await save_user_files(message=message, bot=bot)
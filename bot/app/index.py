@@ -0,0 +1,1082 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections.abc import Callable, Iterable
+from datetime import datetime
+from pathlib import Path
+from typing import Any, TypeVar
+
+from config import settings
+from locks import redis, redis_lock
+from loguru import logger
+from storage import StoredObject, storage
+
+T = TypeVar("T")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    key TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    archived_at REAL
+);
+CREATE INDEX IF NOT EXISTS files_user_created ON files (user_id, created_at);
+CREATE INDEX IF NOT EXISTS files_created ON files (created_at);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS packs (
+    pack TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+"""
+
+# Колонки, добавленные после первой версии схемы: создаются в существующей базе
+ADDED_COLUMNS = {
+    "pack": "TEXT",
+    "pack_offset": "INTEGER",
+    "sha256": "TEXT",
+    "verified_at": "REAL",
+    "media_type": "TEXT",
+}
+
+# Индексы по добавленным колонкам
+ADDED_INDEXES = """
+CREATE INDEX IF NOT EXISTS files_pack ON files (pack, pack_offset);
+CREATE INDEX IF NOT EXISTS files_user_media ON files (user_id, media_type, created_at);
+CREATE INDEX IF NOT EXISTS files_verified
+    ON files (COALESCE(verified_at, created_at)) WHERE sha256 IS NOT NULL;
+"""
+
+# Колонки, из которых собирается StoredObject
+OBJECT_COLUMNS = "key, size, created_at, pack, pack_offset, sha256"
+
+
+def user_id_from_key(key: str) -> int | None:
+    """Извлекает ID пользователя из ключа в плоской или шардированной раскладке."""
+    parts = key.split("/")
+    if len(parts) >= 2 and parts[0].isdigit() and len(parts[0]) > 2:
+        return int(parts[0])
+    if len(parts) >= 4 and parts[2].isdigit():
+        return int(parts[2])
+    return None
+
+
+class FileIndex(ABC):
+    """
+    Индекс метаданных файлов.
+
+    Позволяет получать списки файлов, статистику и кандидатов на удаление одним
+    запросом, не обходя хранилище. Индекс - единственный источник списка файлов,
+    поэтому все реплики бота должны работать с одним индексом.
+    """
+
+    @abstractmethod
+    async def add_file(
+        self,
+        *,
+        user_id: int,
+        key: str,
+        size: int,
+        pack: str | None = None,
+        pack_offset: int | None = None,
+        sha256: str | None = None,
+        media_type: str | None = None,
+    ) -> None:
+        """Добавляет сохранённый файл (отдельный или внутри пакета) в индекс."""
+
+    @abstractmethod
+    async def keys_with_prefix(self, prefix: str) -> set[str]:
+        """Возвращает все ключи, начинающиеся с `prefix`."""
+
+    @abstractmethod
+    async def get_file(self, key: str) -> StoredObject | None:
+        """Возвращает файл по ключу или None, если его нет."""
+
+    @abstractmethod
+    async def remove_files(self, keys: Iterable[str]) -> None:
+        """Удаляет файлы из индекса."""
+
+    @abstractmethod
+    async def remove_user(self, user_id: int) -> int:
+        """Удаляет из индекса все файлы пользователя и возвращает их количество."""
+
+    @abstractmethod
+    async def rename_keys(
+        self,
+        renames: Iterable[tuple[str, str]],
+        *,
+        user_id: int,
+        old_prefix: str,
+        new_prefix: str,
+    ) -> None:
+        """
+        Обновляет ключи после переноса файлов пользователя в другую директорию.
+
+        Args:
+            renames: Пары (старый ключ, новый ключ) перенесённых файлов и пакетов
+            user_id: ID пользователя
+            old_prefix: Прежняя директория пользователя
+            new_prefix: Новая директория пользователя
+        """
+
+    @abstractmethod
+    async def list_user_files(
+        self,
+        user_id: int,
+        *,
+        media_types: Iterable[str] = (),
+        created_from: float | None = None,
+        created_to: float | None = None,
+        min_size: int | None = None,
+        max_size: int | None = None,
+    ) -> list[StoredObject]:
+        """
+        Возвращает файлы пользователя в порядке сохранения.
+
+        Args:
+            user_id: ID пользователя
+            media_types: Только файлы этих типов (пусто - любые)
+            created_from: Только файлы, сохранённые не раньше (unix)
+            created_to: Только файлы, сохранённые раньше (unix)
+            min_size: Минимальный размер, байт
+            max_size: Максимальный размер, байт
+
+        Returns:
+            Список файлов
+        """
+
+    @abstractmethod
+    async def users_with_files(
+        self, *, created_from: float, created_to: float
+    ) -> list[int]:
+        """Возвращает ID пользователей, сохранявших файлы в указанный период (unix)."""
+
+    @abstractmethod
+    async def mark_archived(self, keys: Iterable[str]) -> None:
+        """Отмечает файлы как успешно отправленные в архиве."""
+
+    @abstractmethod
+    async def select_for_eviction(
+        self,
+        *,
+        limit: int,
+        created_before: float | None = None,
+        archived: bool = False,
+        user_id: int | None = None,
+    ) -> list[tuple[str, int, int, str | None]]:
+        """
+        Выбирает самые старые файлы для удаления.
+
+        Args:
+            limit: Максимальное число файлов
+            created_before: Только файлы, сохранённые раньше этого времени (unix)
+            archived: Только файлы, уже отправленные в архиве
+            user_id: Только файлы указанного пользователя
+
+        Returns:
+            Список (ключ, ID пользователя, размер, пакет или None)
+        """
+
+    @abstractmethod
+    async def users_over_quota(self, max_bytes: int) -> list[tuple[int, int]]:
+        """Возвращает пользователей, чьи файлы занимают больше `max_bytes`, и их объём."""
+
+    @abstractmethod
+    async def fragmented_packs(self, ratio: float) -> list[tuple[str, int]]:
+        """
+        Возвращает пакеты, в которых доля удалённых данных больше `ratio`.
+
+        Args:
+            ratio: Доля удалённых данных (0..1)
+
+        Returns:
+            Список (ключ пакета, ID пользователя)
+        """
+
+    @abstractmethod
+    async def list_pack_files(self, pack: str) -> list[StoredObject]:
+        """Возвращает файлы пакета в порядке расположения."""
+
+    @abstractmethod
+    async def replace_pack(
+        self,
+        pack: str,
+        *,
+        new_pack: str,
+        user_id: int,
+        size: int,
+        offsets: list[tuple[str, int]],
+    ) -> None:
+        """
+        Переводит файлы пакета в уплотнённую копию одной транзакцией.
+
+        Args:
+            pack: Ключ прежнего пакета
+            new_pack: Ключ уплотнённого пакета
+            user_id: ID владельца
+            size: Размер уплотнённого пакета (0 - живых файлов не осталось)
+            offsets: Пары (ключ файла, смещение в новом пакете)
+        """
+
+    @abstractmethod
+    async def select_for_scrub(
+        self, *, limit: int, verified_before: float
+    ) -> list[StoredObject]:
+        """
+        Возвращает файлы с контрольной суммой, которые давно не проверялись.
+
+        Args:
+            limit: Максимальное количество файлов
+            verified_before: Проверять файлы, не проверенные (или сохранённые,
+                если проверок не было) после этого момента (Unix time)
+
+        Returns:
+            Файлы, начиная с дольше всех не проверявшихся
+        """
+
+    @abstractmethod
+    async def mark_verified(
+        self, keys: Iterable[str], *, verified_at: float | None = None
+    ) -> None:
+        """
+        Отмечает время проверки контрольной суммы файлов.
+
+        Args:
+            keys: Ключи файлов
+            verified_at: Время проверки (Unix time); по умолчанию текущее
+        """
+
+    @abstractmethod
+    async def ensure_populated(self) -> None:
+        """
+        Однократно заполняет индекс файлами, сохранёнными до его появления.
+
+        Единственный полный обход хранилища; дальше индекс обновляется при
+        сохранении и удалении файлов.
+        """
+
+    @abstractmethod
+    def close(self) -> None:
+        """Освобождает ресурсы индекса."""
+
+    @staticmethod
+    async def _stored_files() -> list[tuple[str, int, int, float]]:
+        # Файлы хранилища для первоначального заполнения индекса:
+        # (ключ, ID пользователя, размер, время сохранения)
+        logger.info("Заполнение индекса файлов по содержимому хранилища...")
+        rows = []
+        for obj in await storage.list_objects(""):
+            user_id = user_id_from_key(obj.key)
+            if user_id is None:
+                continue
+            rows.append((obj.key, user_id, obj.size, obj.created_at.timestamp()))
+        return rows
+
+
+class SqliteFileIndex(FileIndex):
+    """
+    Индекс в SQLite: запросы выполняются в отдельном потоке.
+
+    Базу нельзя разделять между хостами (в том числе через сетевую ФС), поэтому
+    несколько реплик могут делить её, только работая на одном хосте.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        self._connection: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            # Реплики с общим индексом запускаются одновременно: колонки
+            # проверяются и добавляются под блокировкой записи, иначе обе
+            # добавляли бы одну колонку и вторая падала бы при запуске
+            connection.execute("BEGIN IMMEDIATE")
+            columns = {row[1] for row in connection.execute("PRAGMA table_info(files)")}
+            for name, column_type in ADDED_COLUMNS.items():
+                if name not in columns:
+                    connection.execute(
+                        f"ALTER TABLE files ADD COLUMN {name} {column_type}"
+                    )
+            connection.commit()
+            connection.executescript(ADDED_INDEXES)
+            self._connection = connection
+        return self._connection
+
+    def _execute_sync(self, func: Callable[[sqlite3.Connection], T]) -> T:
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                return func(connection)
+
+    async def _execute(self, func: Callable[[sqlite3.Connection], T]) -> T:
+        return await asyncio.to_thread(self._execute_sync, func)
+
+    @staticmethod
+    def _to_object(row: tuple[Any, ...]) -> StoredObject:
+        key, size, created_at, pack, pack_offset, sha256 = row
+        return StoredObject(
+            key=key,
+            size=size,
+            created_at=datetime.fromtimestamp(created_at),
+            pack=pack,
+            pack_offset=pack_offset or 0,
+            sha256=sha256,
+        )
+
+    async def add_file(
+        self,
+        *,
+        user_id: int,
+        key: str,
+        size: int,
+        pack: str | None = None,
+        pack_offset: int | None = None,
+        sha256: str | None = None,
+        media_type: str | None = None,
+    ) -> None:
+        def add(db: sqlite3.Connection) -> None:
+            db.execute(
+                "INSERT OR REPLACE INTO files (key, user_id, size, created_at, "
+                "pack, pack_offset, sha256, media_type) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    user_id,
+                    size,
+                    time.time(),
+                    pack,
+                    pack_offset,
+                    sha256,
+                    media_type,
+                ),
+            )
+            if pack is not None:
+                pack_size = (pack_offset or 0) + size
+                db.execute(
+                    "INSERT INTO packs (pack, user_id, size) VALUES (?, ?, ?) "
+                    "ON CONFLICT (pack) DO UPDATE SET size = ?",
+                    (pack, user_id, pack_size, pack_size),
+                )
+
+        await self._execute(add)
+
+    async def keys_with_prefix(self, prefix: str) -> set[str]:
+        # Диапазон по первичному ключу вместо LIKE: спецсимволы в имени не мешают
+        rows = await self._execute(
+            lambda db: db.execute(
+                "SELECT key FROM files WHERE key >= ? AND key < ?",
+                (prefix, prefix + "\U0010ffff"),
+            ).fetchall()
+        )
+        return {key for (key,) in rows}
+
+    async def get_file(self, key: str) -> StoredObject | None:
+        row = await self._execute(
+            lambda db: db.execute(
+                f"SELECT {OBJECT_COLUMNS} FROM files WHERE key = ?", (key,)
+            ).fetchone()
+        )
+        return self._to_object(row) if row else None
+
+    async def remove_files(self, keys: Iterable[str]) -> None:
+        rows = [(key,) for key in keys]
+        await self._execute(
+            lambda db: db.executemany("DELETE FROM files WHERE key = ?", rows)
+        )
+
+    async def remove_user(self, user_id: int) -> int:
+        def remove(db: sqlite3.Connection) -> int:
+            db.execute("DELETE FROM packs WHERE user_id = ?", (user_id,))
+            cursor = db.execute("DELETE FROM files WHERE user_id = ?", (user_id,))
+            removed: int = cursor.rowcount
+            return removed
+
+        return await self._execute(remove)
+
+    async def rename_keys(
+        self,
+        renames: Iterable[tuple[str, str]],
+        *,
+        user_id: int,
+        old_prefix: str,
+        new_prefix: str,
+    ) -> None:
+        rows = [(new, old) for old, new in renames]
+
+        def rename(db: sqlite3.Connection) -> None:
+            db.executemany("UPDATE files SET key = ? WHERE key = ?", rows)
+            db.executemany("UPDATE files SET pack = ? WHERE pack = ?", rows)
+            db.executemany("UPDATE packs SET pack = ? WHERE pack = ?", rows)
+            # Ключи файлов внутри пакетов не соответствуют файлам на диске:
+            # переносим их по префиксу
+            db.execute(
+                "UPDATE files SET key = ? || substr(key, ?) "
+                "WHERE user_id = ? AND substr(key, 1, ?) = ?",
+                (
+                    new_prefix,
+                    len(old_prefix) + 1,
+                    user_id,
+                    len(old_prefix) + 1,
+                    f"{old_prefix}/",
+                ),
+            )
+
+        await self._execute(rename)
+
+    async def list_user_files(
+        self,
+        user_id: int,
+        *,
+        media_types: Iterable[str] = (),
+        created_from: float | None = None,
+        created_to: float | None = None,
+        min_size: int | None = None,
+        max_size: int | None = None,
+    ) -> list[StoredObject]:
+        conditions = ["user_id = ?"]
+        params: list[Any] = [user_id]
+        if media_types := list(media_types):
+            conditions.append(f"media_type IN ({', '.join('?' * len(media_types))})")
+            params.extend(media_types)
+        if created_from is not None:
+            conditions.append("created_at >= ?")
+            params.append(created_from)
+        if created_to is not None:
+            conditions.append("created_at < ?")
+            params.append(created_to)
+        if min_size is not None:
+            conditions.append("size >= ?")
+            params.append(min_size)
+        if max_size is not None:
+            conditions.append("size <= ?")
+            params.append(max_size)
+
+        rows = await self._execute(
+            lambda db: db.execute(
+                f"SELECT {OBJECT_COLUMNS} FROM files "
+                f"WHERE {' AND '.join(conditions)} ORDER BY created_at",
+                params,
+            ).fetchall()
+        )
+        return [self._to_object(row) for row in rows]
+
+    async def users_with_files(
+        self, *, created_from: float, created_to: float
+    ) -> list[int]:
+        rows = await self._execute(
+            lambda db: db.execute(
+                "SELECT DISTINCT user_id FROM files "
+                "WHERE created_at >= ? AND created_at < ?",
+                (created_from, created_to),
+            ).fetchall()
+        )
+        return [user_id for (user_id,) in rows]
+
+    async def mark_archived(self, keys: Iterable[str]) -> None:
+        now = time.time()
+        rows = [(now, key) for key in keys]
+        await self._execute(
+            lambda db: db.executemany(
+                "UPDATE files SET archived_at = ? WHERE key = ?", rows
+            )
+        )
+
+    async def select_for_eviction(
+        self,
+        *,
+        limit: int,
+        created_before: float | None = None,
+        archived: bool = False,
+        user_id: int | None = None,
+    ) -> list[tuple[str, int, int, str | None]]:
+        conditions = []
+        params: list[Any] = []
+        if created_before is not None:
+            conditions.append("created_at < ?")
+            params.append(created_before)
+        if archived:
+            conditions.append("archived_at IS NOT NULL")
+        if user_id is not None:
+            conditions.append("user_id = ?")
+            params.append(user_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        params.append(limit)
+
+        return await self._execute(
+            lambda db: db.execute(
+                f"SELECT key, user_id, size, pack FROM files {where} "
+                "ORDER BY created_at LIMIT ?",
+                params,
+            ).fetchall()
+        )
+
+    async def users_over_quota(self, max_bytes: int) -> list[tuple[int, int]]:
+        return await self._execute(
+            lambda db: db.execute(
+                "SELECT user_id, SUM(size) FROM files GROUP BY user_id "
+                "HAVING SUM(size) > ?",
+                (max_bytes,),
+            ).fetchall()
+        )
+
+    async def fragmented_packs(self, ratio: float) -> list[tuple[str, int]]:
+        return await self._execute(
+            lambda db: db.execute(
+                "SELECT packs.pack, packs.user_id FROM packs "
+                "LEFT JOIN files ON files.pack = packs.pack "
+                "GROUP BY packs.pack "
+                "HAVING packs.size - COALESCE(SUM(files.size), 0) > ? * packs.size",
+                (ratio,),
+            ).fetchall()
+        )
+
+    async def list_pack_files(self, pack: str) -> list[StoredObject]:
+        rows = await self._execute(
+            lambda db: db.execute(
+                f"SELECT {OBJECT_COLUMNS} FROM files "
+                "WHERE pack = ? ORDER BY pack_offset",
+                (pack,),
+            ).fetchall()
+        )
+        return [self._to_object(row) for row in rows]
+
+    async def replace_pack(
+        self,
+        pack: str,
+        *,
+        new_pack: str,
+        user_id: int,
+        size: int,
+        offsets: list[tuple[str, int]],
+    ) -> None:
+        def replace(db: sqlite3.Connection) -> None:
+            db.executemany(
+                "UPDATE files SET pack = ?, pack_offset = ? WHERE key = ?",
+                [(new_pack, offset, key) for key, offset in offsets],
+            )
+            db.execute("DELETE FROM packs WHERE pack = ?", (pack,))
+            if size:
+                db.execute(
+                    "INSERT INTO packs (pack, user_id, size) VALUES (?, ?, ?)",
+                    (new_pack, user_id, size),
+                )
+
+        await self._execute(replace)
+
+    async def select_for_scrub(
+        self, *, limit: int, verified_before: float
+    ) -> list[StoredObject]:
+        rows = await self._execute(
+            lambda db: db.execute(
+                f"SELECT {OBJECT_COLUMNS} FROM files "
+                "WHERE sha256 IS NOT NULL "
+                "AND COALESCE(verified_at, created_at) < ? "
+                "ORDER BY COALESCE(verified_at, created_at) LIMIT ?",
+                (verified_before, limit),
+            ).fetchall()
+        )
+        return [self._to_object(row) for row in rows]
+
+    async def mark_verified(
+        self, keys: Iterable[str], *, verified_at: float | None = None
+    ) -> None:
+        if verified_at is None:
+            verified_at = time.time()
+        rows = [(verified_at, key) for key in keys]
+        await self._execute(
+            lambda db: db.executemany(
+                "UPDATE files SET verified_at = ? WHERE key = ?", rows
+            )
+        )
+
+    async def ensure_populated(self) -> None:
+        populated = await self._execute(
+            lambda db: db.execute(
+                "SELECT 1 FROM meta WHERE name = 'populated'"
+            ).fetchone()
+        )
+        if populated:
+            return
+
+        rows = await self._stored_files()
+
+        def populate(db: sqlite3.Connection) -> bool:
+            # Реплики с общим индексом заполняют его одновременно: заполняет
+            # первая, остальные не добавляют строки по устаревшему списку файлов
+            db.execute("BEGIN IMMEDIATE")
+            if db.execute("SELECT 1 FROM meta WHERE name = 'populated'").fetchone():
+                return False
+            db.executemany(
+                "INSERT OR IGNORE INTO files (key, user_id, size, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            db.execute("INSERT INTO meta (name, value) VALUES ('populated', '1')")
+            return True
+
+        if await self._execute(populate):
+            logger.info("В индекс добавлено {} файлов", len(rows))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class RedisFileIndex(FileIndex):
+    """
+    Индекс в Redis - общий для реплик на любых хостах.
+
+    Метаданные каждого файла хранятся в хеше, а порядок сохранения (общий и по
+    пользователям), отправленные в архиве файлы, очередь проверки целостности и
+    содержимое пакетов - в сортированных множествах, поэтому запросы не
+    перебирают все файлы. Изменения выполняются транзакциями MULTI/EXEC; файлы
+    одного пользователя меняются под `user_lock`.
+    """
+
+    PREFIX = "archiver:index"
+    # Все ключи файлов с одинаковым весом: выборка по префиксу через ZRANGEBYLEX
+    KEYS = f"{PREFIX}:keys"
+    # Ключи файлов по времени сохранения
+    CREATED = f"{PREFIX}:created"
+    # Отправленные в архиве файлы по времени сохранения
+    ARCHIVED = f"{PREFIX}:archived"
+    # Файлы с контрольной суммой по времени последней проверки
+    SCRUB = f"{PREFIX}:scrub"
+    # Объём файлов по пользователям
+    USAGE = f"{PREFIX}:usage"
+    # Пакеты: владелец, размер и объём живых файлов
+    PACK_OWNERS = f"{PREFIX}:pack-owners"
+    PACK_SIZES = f"{PREFIX}:pack-sizes"
+    PACK_LIVE = f"{PREFIX}:pack-live"
+    POPULATED = f"{PREFIX}:populated"
+
+    # Сколько ключей читается за одно обращение при постраничном обходе
+    PAGE_SIZE = 1000
+
+    def __init__(self, client: Any) -> None:
+        self.redis = client
+
+    def _file(self, key: str) -> str:
+        return f"{self.PREFIX}:file:{key}"
+
+    def _user(self, user_id: int | str) -> str:
+        return f"{self.PREFIX}:user:{user_id}"
+
+    def _user_packs(self, user_id: int | str) -> str:
+        return f"{self.PREFIX}:user-packs:{user_id}"
+
+    def _pack_files(self, pack: str) -> str:
+        return f"{self.PREFIX}:pack-files:{pack}"
+
+    @staticmethod
+    def _decode(values: Iterable[bytes]) -> list[str]:
+        return [value.decode() for value in values]
+
+    async def _load(self, keys: list[str]) -> list[dict[str, str]]:
+        # Метаданные существующих файлов в порядке `keys`; ключ файла - в поле key
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(self._file(key))
+        rows = []
+        for key, fields in zip(keys, await pipe.execute(), strict=True):
+            if fields:
+                row = {name.decode(): value.decode() for name, value in fields.items()}
+                row["key"] = key
+                rows.append(row)
+        return rows
+
+    async def _load_range(self, name: str, low: Any, high: Any) -> list[dict[str, str]]:
+        keys = self._decode(await self.redis.zrangebyscore(name, low, high))
+        return await self._load(keys)
+
+    @staticmethod
+    def _to_object(row: dict[str, str]) -> StoredObject:
+        return StoredObject(
+            key=row["key"],
+            size=int(row["size"]),
+            created_at=datetime.fromtimestamp(float(row["created_at"])),
+            pack=row.get("pack"),
+            pack_offset=int(row.get("pack_offset", 0)),
+            sha256=row.get("sha256"),
+        )
+
+    def _write(self, pipe: Any, row: dict[str, str]) -> None:
+        key = row["key"]
+        user_id = row["user_id"]
+        size = int(row["size"])
+        created_at = float(row["created_at"])
+        pipe.hset(self._file(key), mapping={k: v for k, v in row.items() if k != "key"})
+        pipe.zadd(self.KEYS, {key: 0})
+        pipe.zadd(self.CREATED, {key: created_at})
+        pipe.zadd(self._user(user_id), {key: created_at})
+        pipe.hincrby(self.USAGE, user_id, size)
+        if "archived_at" in row:
+            pipe.zadd(self.ARCHIVED, {key: created_at})
+        if "sha256" in row:
+            verified_at = float(row.get("verified_at", created_at))
+            pipe.zadd(self.SCRUB, {key: verified_at})
+        if pack := row.get("pack"):
+            pipe.zadd(self._pack_files(pack), {key: int(row.get("pack_offset", 0))})
+            pipe.hincrby(self.PACK_LIVE, pack, size)
+
+    def _unlink(self, pipe: Any, row: dict[str, str]) -> None:
+        key = row["key"]
+        user_id = row["user_id"]
+        size = int(row["size"])
+        pipe.delete(self._file(key))
+        pipe.zrem(self.KEYS, key)
+        pipe.zrem(self.CREATED, key)
+        pipe.zrem(self._user(user_id), key)
+        pipe.zrem(self.ARCHIVED, key)
+        pipe.zrem(self.SCRUB, key)
+        pipe.hincrby(self.USAGE, user_id, -size)
+        if pack := row.get("pack"):
+            pipe.zrem(self._pack_files(pack), key)
+            pipe.hincrby(self.PACK_LIVE, pack, -size)
+
+    def _add_pack(self, pipe: Any, pack: str, *, user_id: int | str, size: int) -> None:
+        pipe.hset(self.PACK_OWNERS, pack, user_id)
+        pipe.hset(self.PACK_SIZES, pack, size)
+        pipe.sadd(self._user_packs(user_id), pack)
+
+    def _drop_pack(self, pipe: Any, pack: str, *, user_id: int | str) -> None:
+        pipe.hdel(self.PACK_OWNERS, pack)
+        pipe.hdel(self.PACK_SIZES, pack)
+        pipe.hdel(self.PACK_LIVE, pack)
+        pipe.delete(self._pack_files(pack))
+        pipe.srem(self._user_packs(user_id), pack)
+
+    async def add_file(
+        self,
+        *,
+        user_id: int,
+        key: str,
+        size: int,
+        pack: str | None = None,
+        pack_offset: int | None = None,
+        sha256: str | None = None,
+        media_type: str | None = None,
+    ) -> None:
+        row = {
+            "key": key,
+            "user_id": str(user_id),
+            "size": str(size),
+            "created_at": str(time.time()),
+        }
+        optional = {
+            "pack": pack,
+            "pack_offset": pack_offset,
+            "sha256": sha256,
+            "media_type": media_type,
+        }
+        row.update(
+            {name: str(value) for name, value in optional.items() if value is not None}
+        )
+
+        pipe = self.redis.pipeline(transaction=True)
+        # Как INSERT OR REPLACE: прежняя запись с тем же ключом заменяется
+        for old in await self._load([key]):
+            self._unlink(pipe, old)
+        self._write(pipe, row)
+        if pack is not None:
+            self._add_pack(pipe, pack, user_id=user_id, size=(pack_offset or 0) + size)
+        await pipe.execute()
+
+    async def keys_with_prefix(self, prefix: str) -> set[str]:
+        # Верхняя граница, как и в SQLite, - префикс с максимальным символом
+        keys = await self.redis.zrangebylex(
+            self.KEYS,
+            b"[" + prefix.encode(),
+            b"(" + (prefix + "\U0010ffff").encode(),
+        )
+        return set(self._decode(keys))
+
+    async def get_file(self, key: str) -> StoredObject | None:
+        rows = await self._load([key])
+        return self._to_object(rows[0]) if rows else None
+
+    async def remove_files(self, keys: Iterable[str]) -> None:
+        rows = await self._load(list(keys))
+        pipe = self.redis.pipeline(transaction=True)
+        for row in rows:
+            self._unlink(pipe, row)
+        await pipe.execute()
+
+    async def remove_user(self, user_id: int) -> int:
+        rows = await self._load_range(self._user(user_id), "-inf", "+inf")
+        packs = self._decode(await self.redis.smembers(self._user_packs(user_id)))
+
+        pipe = self.redis.pipeline(transaction=True)
+        for row in rows:
+            self._unlink(pipe, row)
+        for pack in packs:
+            self._drop_pack(pipe, pack, user_id=user_id)
+        pipe.hdel(self.USAGE, user_id)
+        await pipe.execute()
+        return len(rows)
+
+    async def rename_keys(
+        self,
+        renames: Iterable[tuple[str, str]],
+        *,
+        user_id: int,
+        old_prefix: str,
+        new_prefix: str,
+    ) -> None:
+        renamed = dict(renames)
+        rows = await self._load_range(self._user(user_id), "-inf", "+inf")
+        packs = self._decode(await self.redis.smembers(self._user_packs(user_id)))
+        pack_sizes = await self.redis.hmget(self.PACK_SIZES, packs) if packs else []
+
+        # Записи пользователя удаляются и добавляются заново под новыми ключами
+        # одной транзакцией
+        pipe = self.redis.pipeline(transaction=True)
+        for row in rows:
+            self._unlink(pipe, row)
+        for pack, pack_size in zip(packs, pack_sizes, strict=True):
+            self._drop_pack(pipe, pack, user_id=user_id)
+            self._add_pack(
+                pipe,
+                renamed.get(pack, pack),
+                user_id=user_id,
+                size=int(pack_size or 0),
+            )
+        for row in rows:
+            key = row["key"]
+            if key in renamed:
+                key = renamed[key]
+            elif key.startswith(f"{old_prefix}/"):
+                # Ключи файлов внутри пакетов не соответствуют файлам на диске:
+                # переносим их по префиксу
+                key = new_prefix + key[len(old_prefix) :]
+            row = {**row, "key": key}
+            if "pack" in row:
+                row["pack"] = renamed.get(row["pack"], row["pack"])
+            self._write(pipe, row)
+        await pipe.execute()
+
+    async def list_user_files(
+        self,
+        user_id: int,
+        *,
+        media_types: Iterable[str] = (),
+        created_from: float | None = None,
+        created_to: float | None = None,
+        min_size: int | None = None,
+        max_size: int | None = None,
+    ) -> list[StoredObject]:
+        types = set(media_types)
+        rows = await self._load_range(
+            self._user(user_id),
+            "-inf" if created_from is None else created_from,
+            "+inf" if created_to is None else f"({created_to}",
+        )
+        return [
+            self._to_object(row)
+            for row in rows
+            if (not types or row.get("media_type") in types)
+            and (min_size is None or int(row["size"]) >= min_size)
+            and (max_size is None or int(row["size"]) <= max_size)
+        ]
+
+    async def users_with_files(
+        self, *, created_from: float, created_to: float
+    ) -> list[int]:
+        rows = await self._load_range(self.CREATED, created_from, f"({created_to}")
+        return list({int(row["user_id"]) for row in rows})
+
+    async def mark_archived(self, keys: Iterable[str]) -> None:
+        now = str(time.time())
+        rows = await self._load(list(keys))
+        pipe = self.redis.pipeline(transaction=True)
+        for row in rows:
+            pipe.hset(self._file(row["key"]), "archived_at", now)
+            pipe.zadd(self.ARCHIVED, {row["key"]: float(row["created_at"])})
+        await pipe.execute()
+
+    async def select_for_eviction(
+        self,
+        *,
+        limit: int,
+        created_before: float | None = None,
+        archived: bool = False,
+        user_id: int | None = None,
+    ) -> list[tuple[str, int, int, str | None]]:
+        # Обходим самое узкое множество, упорядоченное по времени сохранения,
+        # и отбрасываем файлы, не подходящие под остальные условия
+        if user_id is not None:
+            source = self._user(user_id)
+        elif archived:
+            source = self.ARCHIVED
+        else:
+            source = self.CREATED
+        high = "+inf" if created_before is None else f"({created_before}"
+
+        selected: list[tuple[str, int, int, str | None]] = []
+        start = 0
+        while len(selected) < limit:
+            keys = self._decode(
+                await self.redis.zrangebyscore(
+                    source, "-inf", high, start=start, num=self.PAGE_SIZE
+                )
+            )
+            if not keys:
+                break
+            start += len(keys)
+            for row in await self._load(keys):
+                if archived and "archived_at" not in row:
+                    continue
+                selected.append(
+                    (row["key"], int(row["user_id"]), int(row["size"]), row.get("pack"))
+                )
+                if len(selected) == limit:
+                    break
+        return selected
+
+    async def users_over_quota(self, max_bytes: int) -> list[tuple[int, int]]:
+        usage = await self.redis.hgetall(self.USAGE)
+        return [
+            (int(user_id), int(size))
+            for user_id, size in usage.items()
+            if int(size) > max_bytes
+        ]
+
+    async def fragmented_packs(self, ratio: float) -> list[tuple[str, int]]:
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hgetall(self.PACK_OWNERS)
+        pipe.hgetall(self.PACK_SIZES)
+        pipe.hgetall(self.PACK_LIVE)
+        owners, sizes, live = await pipe.execute()
+        fragmented = []
+        for pack, user_id in owners.items():
+            size = int(sizes.get(pack, 0))
+            if size - int(live.get(pack, 0)) > ratio * size:
+                fragmented.append((pack.decode(), int(user_id)))
+        return fragmented
+
+    async def list_pack_files(self, pack: str) -> list[StoredObject]:
+        rows = await self._load_range(self._pack_files(pack), "-inf", "+inf")
+        return [self._to_object(row) for row in rows]
+
+    async def replace_pack(
+        self,
+        pack: str,
+        *,
+        new_pack: str,
+        user_id: int,
+        size: int,
+        offsets: list[tuple[str, int]],
+    ) -> None:
+        live = await self.redis.hget(self.PACK_LIVE, pack)
+
+        pipe = self.redis.pipeline(transaction=True)
+        for key, offset in offsets:
+            pipe.hset(
+                self._file(key), mapping={"pack": new_pack, "pack_offset": offset}
+            )
+            pipe.zadd(self._pack_files(new_pack), {key: offset})
+        self._drop_pack(pipe, pack, user_id=user_id)
+        if size:
+            self._add_pack(pipe, new_pack, user_id=user_id, size=size)
+            # Живые файлы переезжают целиком, их объём не меняется
+            pipe.hset(self.PACK_LIVE, new_pack, int(live or 0))
+        await pipe.execute()
+
+    async def select_for_scrub(
+        self, *, limit: int, verified_before: float
+    ) -> list[StoredObject]:
+        keys = self._decode(
+            await self.redis.zrangebyscore(
+                self.SCRUB, "-inf", f"({verified_before}", start=0, num=limit
+            )
+        )
+        return [self._to_object(row) for row in await self._load(keys)]
+
+    async def mark_verified(
+        self, keys: Iterable[str], *, verified_at: float | None = None
+    ) -> None:
+        if verified_at is None:
+            verified_at = time.time()
+        rows = await self._load(list(keys))
+        pipe = self.redis.pipeline(transaction=True)
+        for row in rows:
+            pipe.hset(self._file(row["key"]), "verified_at", str(verified_at))
+            if "sha256" in row:
+                pipe.zadd(self.SCRUB, {row["key"]: verified_at})
+        await pipe.execute()
+
+    async def ensure_populated(self) -> None:
+        if await self.redis.exists(self.POPULATED):
+            return
+
+        # Реплики запускаются одновременно: заполняет первая, остальные ждут её
+        # и не добавляют файлы по устаревшему списку
+        async with redis_lock(f"{self.PREFIX}:populate"):
+            if await self.redis.exists(self.POPULATED):
+                return
+
+            files = await self._stored_files()
+            added = 0
+            for start in range(0, len(files), self.PAGE_SIZE):
+                batch = files[start : start + self.PAGE_SIZE]
+                pipe = self.redis.pipeline(transaction=False)
+                for key, *_rest in batch:
+                    pipe.exists(self._file(key))
+                exists = await pipe.execute()
+
+                pipe = self.redis.pipeline(transaction=True)
+                for (key, user_id, size, created_at), present in zip(
+                    batch, exists, strict=True
+                ):
+                    # Как INSERT OR IGNORE: уже сохранённые ботом файлы не трогаем
+                    if present:
+                        continue
+                    row = {
+                        "key": key,
+                        "user_id": str(user_id),
+                        "size": str(size),
+                        "created_at": str(created_at),
+                    }
+                    self._write(pipe, row)
+                    added += 1
+                await pipe.execute()
+
+            await self.redis.set(self.POPULATED, 1)
+            logger.info("В индекс добавлено {} файлов", added)
+
+    def close(self) -> None:
+        # Клиент Redis общий с FSM-хранилищем и блокировками
+        pass
+
+
+def create_index() -> FileIndex:
+    """
+    Создаёт индекс файлов по настройкам.
+
+    Returns:
+        Индекс в Redis при INDEX_BACKEND=redis (по умолчанию, если задан
+        REDIS_URL), иначе - в SQLite
+    """
+    backend = settings.INDEX_BACKEND or ("redis" if redis is not None else "sqlite")
+    if backend == "redis":
+        return RedisFileIndex(redis)
+    return SqliteFileIndex(
+        settings.INDEX_DB_PATH or Path(settings.FILES_DIR) / "index.sqlite3"
+    )
+
+
+file_index = create_index()
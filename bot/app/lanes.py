@@ -0,0 +1,42 @@
+"""
+Упорядоченная обработка обновлений каждого пользователя.
+
+aiogram обрабатывает обновления параллельно, поэтому `/clear` пользователя мог
+выполниться, пока ещё сохраняется присланный им файл, а два `/archive` -
+собираться одновременно. Обновления одного пользователя выстраиваются в очередь
+(lane): они обрабатываются по одному в порядке поступления, а обновления разных
+пользователей - параллельно.
+"""
+
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+
+from aiogram.fsm.storage.base import BaseEventIsolation, StorageKey
+from config import settings
+from locks import KeyedLock
+
+
+class UserLaneIsolation(BaseEventIsolation):
+    """
+    Изоляция событий диспетчера: одна очередь на пользователя.
+
+    Передаётся в `Dispatcher(events_isolation=...)`. Встроенный
+    FSMContextMiddleware захватывает её до чтения состояния FSM, поэтому порядок
+    сохраняется и с RedisStorage, где чтение состояния - сетевой запрос.
+    Обновления без пользователя и чата (например, опросы каналов) проходят без
+    очереди.
+
+    Очереди действуют в пределах реплики; файловые операции одного
+    пользователя на разных репликах разделяет `locks.user_lock`.
+    """
+
+    def __init__(self) -> None:
+        self.lanes = KeyedLock("updates", max_idle=settings.USER_LANES_MAX_IDLE)
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncGenerator[None, None]:
+        async with self.lanes.hold(key.user_id):
+            yield
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,317 @@
+import asyncio
+import fcntl
+import os
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Callable, Coroutine, Hashable
+from contextlib import asynccontextmanager, suppress
+from pathlib import Path
+from typing import Any
+
+from config import settings
+from fileio import run_io
+from loguru import logger
+from metrics import counter, gauge
+
+lane_acquisitions = counter(
+    "archiver_lane_acquisitions_total",
+    "Захваты блокировок по ключу (пользователю)",
+)
+lane_contended = counter(
+    "archiver_lane_contended_total",
+    "Захваты блокировок по ключу, которым пришлось ждать",
+)
+lane_wait_seconds = counter(
+    "archiver_lane_wait_seconds_total",
+    "Суммарное время ожидания блокировок по ключу, секунд",
+)
+lane_waiting = gauge(
+    "archiver_lane_waiting",
+    "Операции, ожидающие блокировку по ключу",
+)
+lane_count = gauge(
+    "archiver_lanes",
+    "Блокировки по ключу в памяти (занятые и простаивающие)",
+)
+
+
+class _Lane:
+    __slots__ = ("lock", "users")
+
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        # Сколько операций держат или ждут блокировку
+        self.users = 0
+
+
+class KeyedLock:
+    """
+    Асинхронные блокировки по ключу (например, по ID пользователя).
+
+    Операции с одним ключом выполняются по одной в порядке захвата (asyncio.Lock
+    пропускает ожидающих по очереди), с разными ключами - параллельно.
+    Простаивающие блокировки хранятся в LRU и вытесняются, когда их больше
+    `max_idle`. Ожидание публикуется в метриках `archiver_lane_*` с меткой `name`.
+
+    Args:
+        name: Имя набора блокировок для метрик
+        max_idle: Сколько простаивающих блокировок держать в памяти
+    """
+
+    def __init__(self, name: str, max_idle: int) -> None:
+        self.name = name
+        self.max_idle = max_idle
+        self._lanes: OrderedDict[Hashable, _Lane] = OrderedDict()
+        # Количество блокировок, которые сейчас держат или ждут
+        self._busy = 0
+
+    def locked(self, key: Hashable) -> bool:
+        """Проверяет, занята ли блокировка ключа."""
+        lane = self._lanes.get(key)
+        return lane is not None and lane.lock.locked()
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        """Удерживает блокировку ключа на время блока `async with`."""
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = _Lane()
+        self._lanes.move_to_end(key)
+        if not lane.users:
+            self._busy += 1
+        lane.users += 1
+
+        lane_acquisitions.inc(lane=self.name)
+        contended = lane.lock.locked()
+        if contended:
+            lane_contended.inc(lane=self.name)
+            lane_waiting.inc(lane=self.name)
+        started = time.perf_counter()
+        try:
+            async with lane.lock:
+                if contended:
+                    lane_waiting.inc(-1, lane=self.name)
+                    lane_wait_seconds.inc(time.perf_counter() - started, lane=self.name)
+                    contended = False
+                yield
+        finally:
+            if contended:
+                # Ожидание прервано (например, отменой задачи)
+                lane_waiting.inc(-1, lane=self.name)
+            lane.users -= 1
+            if not lane.users:
+                self._busy -= 1
+                self._reclaim()
+
+    def _reclaim(self) -> None:
+        excess = len(self._lanes) - self._busy - self.max_idle
+        if excess > 0:
+            # Вытесняем самые давно использованные простаивающие блокировки;
+            # занятые обычно в конце очереди, поэтому просмотр короткий
+            reclaimed = []
+            for key, lane in self._lanes.items():
+                if not lane.users:
+                    reclaimed.append(key)
+                    if len(reclaimed) == excess:
+                        break
+            for key in reclaimed:
+                del self._lanes[key]
+        lane_count.set(len(self._lanes), lane=self.name)
+
+
+def create_redis() -> Any:
+    """
+    Создаёт общий клиент Redis, если задан REDIS_URL.
+
+    Returns:
+        Клиент `redis.asyncio.Redis` или None
+    """
+    if not settings.REDIS_URL:
+        return None
+
+    try:
+        from redis.asyncio import BlockingConnectionPool, Redis
+    except ImportError as e:  # pragma: no cover
+        raise RuntimeError(
+            "Для REDIS_URL установите зависимость: uv sync --extra redis"
+        ) from e
+
+    # Обычный пул при исчерпании соединений сразу выбрасывает ошибку, и при
+    # всплеске обновлений их обработка падала бы; блокирующий пул ждёт
+    # освободившееся соединение
+    pool = BlockingConnectionPool.from_url(
+        settings.REDIS_URL,
+        max_connections=settings.REDIS_POOL_SIZE,
+        timeout=settings.USER_LOCK_TIMEOUT,
+    )
+    return Redis(connection_pool=pool)
+
+
+# Клиент используется и для FSM-хранилища, и для блокировок пользователей
+redis = create_redis()
+
+# Локальные блокировки на случай работы одной репликой без Redis
+_local_locks = KeyedLock("files", max_idle=settings.USER_LANES_MAX_IDLE)
+
+# Пауза между попытками захватить файловую блокировку, секунд
+FILE_LOCK_POLL_INTERVAL = 0.05
+
+# Число файлов блокировок: пользователи распределяются по ним по остатку от
+# деления ID, поэтому директория не растёт с числом пользователей
+FILE_LOCK_STRIPES = 1024
+
+
+def _open_lock_file(path: Path) -> int:
+    try:
+        return os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    except FileNotFoundError:
+        # Директория создаётся один раз, а не при каждом захвате
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+
+def _close_opened(opening: "asyncio.Future[int]") -> None:
+    if not opening.cancelled() and opening.exception() is None:
+        os.close(opening.result())
+
+
+@asynccontextmanager
+async def _file_user_lock(user_id: int) -> AsyncIterator[None]:
+    # Блокировка flock на файле в FILES_DIR/.locks разделяет процессы одного
+    # хоста (бот и migrate_layout.py). Файлов фиксированное число: пользователи
+    # с одним остатком делят файл и изредка ждут друг друга, но блокировка
+    # никогда не берётся для двух пользователей сразу, так что взаимной
+    # блокировки не возникает. Файлы не удаляются - иначе два процесса могут
+    # заблокировать разные файлы с одним именем
+    path = Path(settings.FILES_DIR) / ".locks" / f"{user_id % FILE_LOCK_STRIPES}.lock"
+    # Открытие (и создание директории) - обращение к диску, поэтому выполняется
+    # в пуле файловых операций
+    opening = run_io(_open_lock_file, path)
+    try:
+        fd = await asyncio.shield(opening)
+    except asyncio.CancelledError:
+        # Файл всё равно откроется в пуле - закрываем его, когда это произойдёт
+        opening.add_done_callback(_close_opened)
+        raise
+    try:
+        # Сам захват неблокирующий и не обращается к диску, поэтому повторяется
+        # в цикле событий, не занимая поток на время ожидания
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(FILE_LOCK_POLL_INTERVAL)
+        yield
+    finally:
+        # Закрытие дескриптора снимает блокировку
+        await run_io(os.close, fd)
+
+
+@asynccontextmanager
+async def redis_lock(name: str) -> AsyncIterator[None]:
+    """
+    Распределённая блокировка в Redis, продлеваемая, пока её держат.
+
+    Если реплика упадёт, блокировка истечёт через USER_LOCK_TIMEOUT секунд.
+    Используется только при заданном REDIS_URL.
+
+    Args:
+        name: Ключ блокировки в Redis
+    """
+    lock = redis.lock(name, timeout=settings.USER_LOCK_TIMEOUT)
+    await lock.acquire()
+
+    async def keep_alive() -> None:
+        # Продлеваем блокировку, пока операция выполняется
+        while True:
+            await asyncio.sleep(settings.USER_LOCK_TIMEOUT / 3)
+            try:
+                await lock.reacquire()
+            except Exception as e:
+                logger.error("Не удалось продлить блокировку {}: {}", name, e)
+                return
+
+    keep_alive_task = asyncio.create_task(keep_alive())
+    try:
+        yield
+    finally:
+        keep_alive_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await keep_alive_task
+        try:
+            await lock.release()
+        except Exception as e:
+            logger.error("Ошибка при снятии блокировки {}: {}", name, e)
+
+
+@asynccontextmanager
+async def user_lock(user_id: int) -> AsyncIterator[None]:
+    """
+    Блокировка файлов пользователя на время сохранения, архивации или удаления.
+
+    При заданном REDIS_URL блокировка распределённая и действует на все реплики
+    бота, иначе - на процессы текущего хоста (бот и `migrate_layout.py`).
+
+    Args:
+        user_id: ID пользователя
+    """
+    if redis is None:
+        # Сначала блокировка процесса: файловую ждёт не больше одной задачи
+        async with _local_locks.hold(user_id), _file_user_lock(user_id):
+            yield
+    else:
+        async with redis_lock(f"archiver:user-lock:{user_id}"):
+            yield
+
+
+async def run_as_leader(
+    name: str, job: Callable[[], Coroutine[Any, Any, None]]
+) -> None:
+    """
+    Выполняет фоновую задачу только на одной реплике.
+
+    При заданном REDIS_URL реплики соревнуются за блокировку `name` в Redis;
+    задачу выполняет та, что её захватила, продлевая блокировку, пока задача
+    работает. Если продлить не удалось (реплика потеряла связь с Redis),
+    задача отменяется, а блокировку через USER_LOCK_TIMEOUT секунд захватывает
+    другая реплика. Без Redis задача просто выполняется.
+
+    Args:
+        name: Имя задачи (общее для всех реплик)
+        job: Функция, возвращающая корутину задачи
+    """
+    if redis is None:
+        await job()
+        return
+
+    interval = settings.USER_LOCK_TIMEOUT / 3
+    lock = redis.lock(f"archiver:leader:{name}", timeout=settings.USER_LOCK_TIMEOUT)
+    while True:
+        if not await lock.acquire(blocking=False):
+            await asyncio.sleep(interval)
+            continue
+
+        logger.info("Фоновая задача {} выполняется на этой реплике", name)
+        task = asyncio.create_task(job())
+        try:
+            while True:
+                done, _pending = await asyncio.wait({task}, timeout=interval)
+                if done:
+                    # Задача завершилась сама (например, отключена настройками)
+                    await task
+                    return
+                try:
+                    await lock.reacquire()
+                except Exception as e:
+                    logger.error(
+                        "Не удалось продлить блокировку задачи {}: {}", name, e
+                    )
+                    break
+        finally:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+            # Блокировка могла уже истечь
+            with suppress(Exception):
+                await lock.release()
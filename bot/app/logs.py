@@ -0,0 +1,174 @@
+"""
+Настройка логов: запись в отдельном потоке, ограничение частоты и вывод в JSON.
+
+Сообщения ниже LOG_LEVEL отбрасываются до форматирования
+(`logger.debug("Сохранён файл {}", key)` при уровне INFO почти ничего не стоит),
+а остальные loguru форматирует до фильтров, поэтому ограничение частоты не
+экономит форматирование: частые сообщения пишутся на уровне DEBUG, а дорогие
+аргументы передаются через `logger.opt(lazy=True)`. Готовые строки пишет в
+stderr отдельный поток, поэтому медленный вывод (например, `docker logs`) не
+задерживает цикл событий.
+"""
+
+import json
+import queue
+import sys
+import threading
+import time
+import traceback
+from typing import TYPE_CHECKING, Any, TextIO
+
+from config import settings
+from loguru import logger
+from metrics import counter
+
+if TYPE_CHECKING:
+    from loguru import Record
+
+# Формат loguru по умолчанию
+TEXT_FORMAT = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | "
+    "<level>{level: <8}</level> | "
+    "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - "
+    "<level>{message}</level>"
+)
+
+log_suppressed = counter(
+    "archiver_log_suppressed_total",
+    "Сообщения лога, пропущенные ограничением частоты",
+)
+log_dropped = counter(
+    "archiver_log_dropped_total",
+    "Сообщения лога, отброшенные из-за переполнения очереди записи",
+)
+
+
+def _to_json(record: "Record") -> str:
+    data = {
+        "time": record["time"].isoformat(),
+        "level": record["level"].name,
+        "message": record["message"],
+        "logger": record["name"],
+        "function": record["function"],
+        "line": record["line"],
+        **record["extra"],
+    }
+    if record["exception"] is not None:
+        data["exception"] = "".join(traceback.format_exception(*record["exception"]))
+    return json.dumps(data, ensure_ascii=False, default=str) + "\n"
+
+
+class _BackgroundWriter:
+    """
+    Приёмник loguru, который пишет строки в поток вывода из отдельного потока.
+
+    Встроенный `enqueue=True` передаёт сообщения через очередь multiprocessing
+    и сериализует каждое pickle в вызывающем потоке, что дороже самой записи.
+    Здесь в цикле событий остаётся только постановка строки в очередь; JSON
+    тоже собирается в потоке записи. При переполнении очереди сообщения
+    отбрасываются (метрика `archiver_log_dropped_total`).
+    """
+
+    def __init__(self, stream: TextIO, *, maxsize: int, serialize: bool) -> None:
+        self._stream = stream
+        self._serialize = serialize
+        self._queue: queue.Queue[Any] = queue.Queue(maxsize)
+        self._thread = threading.Thread(
+            target=self._run, name="log-writer", daemon=True
+        )
+        self._thread.start()
+
+    def isatty(self) -> bool:
+        # По нему loguru решает, раскрашивать ли вывод
+        return self._stream.isatty()
+
+    def write(self, message: Any) -> None:
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            log_dropped.inc()
+
+    def stop(self) -> None:
+        """Дописывает оставшиеся сообщения (loguru вызывает при удалении приёмника)."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while (message := self._queue.get()) is not None:
+            if self._serialize:
+                message = _to_json(message.record)
+            self._stream.write(message)
+            if self._queue.empty():
+                self._stream.flush()
+        self._stream.flush()
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated", "suppressed")
+
+    def __init__(self, tokens: float, updated: float) -> None:
+        self.tokens = tokens
+        self.updated = updated
+        self.suppressed = 0
+
+
+class _RateLimit:
+    """
+    Фильтр loguru: не больше `rate` сообщений в секунду с одного места в коде.
+
+    Короткий всплеск такого же размера пропускается целиком. Предупреждения и
+    ошибки не ограничиваются. Первое сообщение после паузы получает приписку с
+    числом пропущенных, а пропуски видны в метрике `archiver_log_suppressed_total`.
+    """
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.burst = max(rate, 1.0)
+        self._buckets: dict[tuple[str | None, int], _Bucket] = {}
+        self._min_level = logger.level("WARNING").no
+
+    def __call__(self, record: "Record") -> bool:
+        if record["level"].no >= self._min_level:
+            return True
+
+        key = (record["name"], record["line"])
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket(self.burst, now)
+        bucket.tokens = min(
+            self.burst, bucket.tokens + (now - bucket.updated) * self.rate
+        )
+        bucket.updated = now
+
+        if bucket.tokens < 1:
+            bucket.suppressed += 1
+            log_suppressed.inc(source=f"{record['name']}:{record['line']}")
+            return False
+
+        bucket.tokens -= 1
+        if bucket.suppressed:
+            record["message"] += f" (пропущено похожих: {bucket.suppressed})"
+            bucket.suppressed = 0
+        return True
+
+
+def setup_logging() -> None:
+    """
+    Заменяет стандартный вывод loguru в stderr на настроенный по Settings.
+
+    Вызывается при запуске до подключения Sentry: его интеграция с loguru
+    добавляет свои приёмники, которые `logger.remove()` удалил бы.
+    """
+    serialize = settings.LOG_FORMAT == "json"
+    rate_limit = settings.LOG_RATE_LIMIT
+
+    logger.remove()
+    logger.add(
+        _BackgroundWriter(
+            sys.stderr, maxsize=settings.LOG_QUEUE_SIZE, serialize=serialize
+        ),
+        level=settings.LOG_LEVEL,
+        format="{message}" if serialize else TEXT_FORMAT,
+        filter=_RateLimit(rate_limit) if rate_limit else None,
+    )
@@ -1,15 +1,39 @@
 import asyncio
+import signal
+from typing import Any
 
-import sentry_sdk
+import fileio
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Update
 from config import settings
 from handlers import router
+from index import file_index
+from lanes import UserLaneIsolation
+from locks import redis, run_as_leader
+from logs import setup_logging
 from loguru import logger
+from metrics import start_metrics_server
+from prebuild import run_prebuild_scheduler
+from scrubber import run_scrubber
+from session import TunedAiohttpSession
+from storage import storage
+from sweeper import run_sweeper
+from throttling import OutboundScheduler
+
+
+def init_sentry() -> None:
+    """
+    Подключает Sentry/Bugsink для отслеживания ошибок.
+
+    sentry_sdk импортируется только здесь: без SENTRY_DSN он не нужен, а его
+    импорт заметно удлиняет запуск.
+    """
+    import sentry_sdk
 
-if settings.SENTRY_DSN:
-    # Инициализация Sentry/Bugsink для отслеживания ошибок
     sentry_sdk.init(
         dsn=settings.SENTRY_DSN,
         send_default_pii=True,
@@ -17,19 +41,174 @@ if settings.SENTRY_DSN:
         traces_sample_rate=0,
     )
 
-dp = Dispatcher()
+
+setup_logging()
+if settings.SENTRY_DSN:
+    init_sentry()
+
+
+def create_fsm_storage() -> BaseStorage:
+    """
+    Создаёт FSM-хранилище: общее в Redis для нескольких реплик или в памяти.
+
+    Returns:
+        FSM-хранилище для диспетчера
+    """
+    if redis is None:
+        return MemoryStorage()
+
+    from aiogram.fsm.storage.redis import RedisStorage
+
+    return RedisStorage(redis=redis)
+
+
+# Сколько ждать обработки принятых обновлений при остановке в режиме вебхука;
+# меньше времени, которое Docker даёт на остановку до SIGKILL (10 секунд)
+SHUTDOWN_TIMEOUT = 8
+
+
+class TrackingDispatcher(Dispatcher):
+    """
+    Диспетчер, который помнит задачи, обрабатывающие обновления.
+
+    Нужен для остановки вебхука: обработчик вебхука отвечает Telegram сразу и
+    обрабатывает обновление в фоновой задаче. Задача отмечается при входе в
+    `feed_update`, до ожидания очереди пользователя (UserLaneIsolation), поэтому
+    в `in_flight` попадают и обновления, ещё стоящие в очереди; middleware
+    диспетчера их бы не увидел - он вызывается уже внутри очереди.
+    """
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.in_flight: set[asyncio.Task[Any]] = set()
+
+    async def feed_update(self, bot: Bot, update: Update, **kwargs: Any) -> Any:
+        task = asyncio.current_task()
+        # Задача снимается с учёта по завершении, вместе с отправкой ответа на
+        # обновление, а не сразу после обработчика
+        if task is not None and task not in self.in_flight:
+            self.in_flight.add(task)
+            task.add_done_callback(self.in_flight.discard)
+        return await super().feed_update(bot, update, **kwargs)
+
+
+dp = TrackingDispatcher(
+    storage=create_fsm_storage(), events_isolation=UserLaneIsolation()
+)
 dp.include_router(router)
+dp.shutdown.register(storage.close)
+
+
+async def on_webhook_startup(bot: Bot) -> None:
+    """Регистрирует вебхук в Telegram при запуске в режиме вебхука."""
+    await bot.set_webhook(
+        url=f"{settings.WEBHOOK_URL}{settings.WEBHOOK_PATH}",
+        secret_token=settings.WEBHOOK_SECRET,
+    )
+    logger.info("Вебхук установлен: {}{}", settings.WEBHOOK_URL, settings.WEBHOOK_PATH)
+
+
+async def run_webhook(bot: Bot) -> None:
+    """
+    Принимает обновления через вебхук.
+
+    Несколько реплик могут работать за одним балансировщиком: FSM-хранилище и
+    блокировки пользователей общие (Redis), файлы - в общем хранилище (S3).
+    """
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+    from aiohttp import web
+
+    dp.startup.register(on_webhook_startup)
+
+    app = web.Application()
+    handler = SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=settings.WEBHOOK_SECRET,
+    )
+    handler.register(app, path=settings.WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host=settings.WEBHOOK_HOST, port=settings.WEBHOOK_PORT)
+    await site.start()
+    logger.info(
+        "Сервер вебхука запущен на {}:{}", settings.WEBHOOK_HOST, settings.WEBHOOK_PORT
+    )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+
+    try:
+        await stop.wait()
+        # Новые обновления больше не принимаются, а принятые дорабатываются:
+        # иначе они потерялись бы, а блокировки их пользователей в Redis
+        # оставались бы занятыми до истечения USER_LOCK_TIMEOUT
+        await site.stop()
+        # Обновления обрабатываются в фоновых задачах обработчика вебхука
+        pending = set(dp.in_flight)
+        if pending:
+            logger.info("Остановка: ожидание обработки {} обновлений", len(pending))
+            _done, pending = await asyncio.wait(pending, timeout=SHUTDOWN_TIMEOUT)
+        for task in pending:
+            # Отмена снимает блокировки в блоках finally
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    finally:
+        await runner.cleanup()
 
 
 async def main() -> None:
-    logger.debug("Using token: {}", settings.TELEGRAM_BOT_TOKEN)
     bot = Bot(
         token=settings.TELEGRAM_BOT_TOKEN,
+        session=TunedAiohttpSession(),
         default=DefaultBotProperties(parse_mode=ParseMode.HTML),
     )
+    bot.session.middleware(OutboundScheduler())
     logger.info("🚀 Bot started")
-    await dp.start_polling(bot)
+
+    await file_index.ensure_populated()
+    metrics_runner = await start_metrics_server()
+    # С несколькими репликами фоновые задачи выполняет только одна из них
+    sweeper_task = asyncio.create_task(run_as_leader("sweeper", run_sweeper))
+    scrubber_task = asyncio.create_task(run_as_leader("scrubber", run_scrubber))
+    prebuild_task = asyncio.create_task(
+        run_as_leader("prebuild", run_prebuild_scheduler)
+    )
+
+    try:
+        if settings.WEBHOOK_URL:
+            await run_webhook(bot)
+        else:
+            await dp.start_polling(bot)
+    finally:
+        sweeper_task.cancel()
+        scrubber_task.cancel()
+        prebuild_task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        file_index.close()
+        fileio.shutdown()
+
+
+def run() -> None:
+    """Запускает бота в стандартном цикле событий asyncio или в uvloop."""
+    if not settings.USE_UVLOOP:
+        asyncio.run(main())
+        return
+
+    try:
+        import uvloop
+    except ImportError as e:  # pragma: no cover
+        raise RuntimeError(
+            "Для USE_UVLOOP установите зависимость: uv sync --extra uvloop"
+        ) from e
+
+    uvloop.run(main())
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    run()
@@ -0,0 +1,96 @@
+from collections.abc import Callable
+from typing import TYPE_CHECKING
+
+from config import settings
+from loguru import logger
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+
+class Metric:
+    """
+    Метрика в формате Prometheus: счётчик (counter) или текущее значение (gauge).
+
+    Значения хранятся отдельно для каждого набора меток.
+    """
+
+    def __init__(self, name: str, description: str, kind: str = "counter") -> None:
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self._values: dict[tuple[tuple[str, str], ...], float] = {}
+        self._callback: Callable[[], float] | None = None
+
+    def inc(self, value: float = 1, **labels: str) -> None:
+        """Увеличивает значение метрики."""
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, value: float, **labels: str) -> None:
+        """Устанавливает значение метрики."""
+        self._values[tuple(sorted(labels.items()))] = value
+
+    def set_function(self, callback: Callable[[], float]) -> None:
+        """Вычислять значение метрики без меток при каждом запросе."""
+        self._callback = callback
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        values = dict(self._values)
+        if self._callback is not None:
+            values[()] = self._callback()
+        for labels, value in values.items():
+            label_text = ",".join(f'{name}="{label}"' for name, label in labels)
+            suffix = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{self.name}{suffix} {value:g}")
+        return lines
+
+
+_registry: dict[str, Metric] = {}
+
+
+def counter(name: str, description: str) -> Metric:
+    """Регистрирует счётчик (или возвращает уже зарегистрированный)."""
+    return _registry.setdefault(name, Metric(name, description, "counter"))
+
+
+def gauge(name: str, description: str) -> Metric:
+    """Регистрирует метрику текущего значения (или возвращает уже зарегистрированную)."""
+    return _registry.setdefault(name, Metric(name, description, "gauge"))
+
+
+def render_metrics() -> str:
+    """Возвращает все метрики в текстовом формате Prometheus."""
+    lines = []
+    for metric in _registry.values():
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def start_metrics_server() -> "web.AppRunner | None":
+    """
+    Запускает HTTP-сервер с метриками на METRICS_PORT, если порт задан.
+
+    Returns:
+        Запущенный сервер (для остановки через `cleanup()`) или None
+    """
+    if settings.METRICS_PORT is None:
+        return None
+
+    # Серверная часть aiohttp нужна только при включённых метриках
+    from aiohttp import web
+
+    async def metrics_handler(request: web.Request) -> web.Response:
+        return web.Response(text=render_metrics(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host="0.0.0.0", port=settings.METRICS_PORT).start()
+    logger.info("Метрики доступны на порту {}: /metrics", settings.METRICS_PORT)
+    return runner
@@ -0,0 +1,135 @@
+"""
+Перенос директорий пользователей из плоской раскладки в шардированную.
+
+Работает без остановки бота: каждый пользователь переносится под его блокировкой
+(общей с ботом: при заданном REDIS_URL - в Redis, иначе - файловой блокировкой
+в FILES_DIR/.locks на том же хосте), а сама директория
+переносится атомарным переименованием. Пока перенос не завершён, бот находит
+файлы пользователя в старой директории (см. `storage.resolve_user_dir`).
+
+Порядок действий:
+
+1. Задать FILES_LAYOUT=sharded и перезапустить бота
+2. Запустить `uv run ./app/migrate_layout.py`
+"""
+
+import argparse
+import asyncio
+import os
+from pathlib import Path
+
+from config import settings
+from index import file_index
+from locks import user_lock
+from logs import setup_logging
+from loguru import logger
+from storage import flat_user_dir, sharded_user_dir
+
+
+def _unique_path(path: Path) -> Path:
+    counter = 1
+    candidate = path
+    while candidate.exists():
+        candidate = path.with_name(f"{path.stem}_{counter}{path.suffix}")
+        counter += 1
+    return candidate
+
+
+def _migrate_user_sync(root: Path, user_id: int) -> list[tuple[str, str]]:
+    """Переносит директорию пользователя и возвращает пары (старый ключ, новый ключ)."""
+    source = root / flat_user_dir(user_id)
+    target = root / sharded_user_dir(user_id)
+    files = [path for path in source.rglob("*") if path.is_file()]
+
+    def key(path: Path) -> str:
+        return path.relative_to(root).as_posix()
+
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        # Основной случай: директории в новой раскладке ещё нет
+        os.rename(source, target)
+        return [(key(path), key(target / path.relative_to(source))) for path in files]
+    except OSError:
+        pass
+
+    # Пользователь уже успел сохранить файлы в новую директорию: сливаем
+    renames = []
+    for path in files:
+        destination = _unique_path(target / path.relative_to(source))
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        os.rename(path, destination)
+        renames.append((key(path), key(destination)))
+    for directory in sorted(source.rglob("*"), reverse=True):
+        directory.rmdir()
+    source.rmdir()
+    return renames
+
+
+async def migrate(*, dry_run: bool, delay: float) -> None:
+    """
+    Переносит всех пользователей из плоской раскладки в шардированную.
+
+    Args:
+        dry_run: Только показать, что будет перенесено
+        delay: Пауза между пользователями, секунд
+    """
+    root = Path(settings.FILES_DIR)
+    # Двухсимвольные директории - первый уровень шардов, а не ID пользователей
+    user_ids = sorted(
+        int(path.name)
+        for path in await asyncio.to_thread(lambda: list(root.iterdir()))
+        if path.is_dir() and path.name.isdigit() and len(path.name) > 2
+    )
+    logger.info("Найдено {} директорий пользователей для переноса", len(user_ids))
+
+    migrated_users = 0
+    migrated_files = 0
+    for user_id in user_ids:
+        if dry_run:
+            logger.info("{} -> {}", flat_user_dir(user_id), sharded_user_dir(user_id))
+            continue
+
+        try:
+            async with user_lock(user_id):
+                if not (root / flat_user_dir(user_id)).is_dir():
+                    continue
+                renames = await asyncio.to_thread(_migrate_user_sync, root, user_id)
+                await file_index.rename_keys(
+                    renames,
+                    user_id=user_id,
+                    old_prefix=flat_user_dir(user_id),
+                    new_prefix=sharded_user_dir(user_id),
+                )
+        except Exception as e:
+            logger.error("Ошибка при переносе файлов пользователя {}: {}", user_id, e)
+            continue
+
+        migrated_users += 1
+        migrated_files += len(renames)
+        logger.debug("Перенесено {} файлов пользователя {}", len(renames), user_id)
+        await asyncio.sleep(delay)
+
+    logger.info(
+        "Перенесено {} пользователей, {} файлов", migrated_users, migrated_files
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dry-run", action="store_true", help="ничего не переносить")
+    parser.add_argument(
+        "--delay", type=float, default=0.0, help="пауза между пользователями, с"
+    )
+    args = parser.parse_args()
+    setup_logging()
+
+    if settings.STORAGE_BACKEND != "local":
+        raise SystemExit("Перенос поддерживается только для STORAGE_BACKEND=local")
+    if settings.FILES_LAYOUT != "sharded":
+        raise SystemExit("Сначала задайте FILES_LAYOUT=sharded и перезапустите бота")
+
+    asyncio.run(migrate(dry_run=args.dry_run, delay=args.delay))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Пакеты для небольших файлов.
+
+Стикеры, голосовые сообщения и небольшие фото занимают единицы килобайт, но
+каждый отдельный файл - это inode и несколько системных вызовов при сохранении и
+архивации. В режиме PACK_SMALL_FILES файлы не больше PACK_MAX_FILE_SIZE
+дописываются в пакет пользователя за день (`<директория>/.packs/YYYY-MM-DD.pack`),
+а смещение и размер хранятся в индексе. Крупные файлы сохраняются как обычно.
+
+Пакеты поддерживаются только локальным хранилищем: S3 не умеет дописывать
+объекты.
+"""
+
+import asyncio
+import hashlib
+import os
+import uuid
+import zipfile
+from collections.abc import AsyncIterator, Iterator
+from datetime import date
+from pathlib import Path
+
+from config import settings
+from fileio import open_creating_dirs, run_io
+from index import file_index
+from locks import user_lock
+from loguru import logger
+from storage import LocalStorage, StoredObject, storage
+
+PACKS_DIR = ".packs"
+
+# Сколько данных пакета читать и записывать в архив за одно обращение к потоку
+READ_BATCH_SIZE = 4 * 1024 * 1024
+
+
+def should_pack(file_size: int | None) -> bool:
+    """Проверяет, нужно ли сохранить файл такого размера в пакет."""
+    return (
+        settings.PACK_SMALL_FILES
+        and isinstance(storage, LocalStorage)
+        and file_size is not None
+        and file_size <= settings.PACK_MAX_FILE_SIZE
+    )
+
+
+def _pack_path(pack: str) -> Path:
+    assert isinstance(storage, LocalStorage)
+    path: Path = storage.root / pack
+    return path
+
+
+def _append_sync(path: Path, data: bytes, digest: "hashlib._Hash | None") -> int:
+    if digest is not None:
+        digest.update(data)
+    with open_creating_dirs(path, "ab") as file:
+        offset: int = file.seek(0, os.SEEK_END)
+        file.write(data)
+    return offset
+
+
+async def append_to_pack(
+    *,
+    user_dir: str,
+    chunks: AsyncIterator[bytes],
+    digest: "hashlib._Hash | None" = None,
+) -> tuple[str, int, int]:
+    """
+    Дописывает файл в сегодняшний пакет пользователя.
+
+    Вызывается под блокировкой пользователя, поэтому запись в пакет
+    последовательна.
+
+    Args:
+        user_dir: Директория пользователя
+        chunks: Поток блоков содержимого
+        digest: Хеш, который нужно обновить содержимым файла
+
+    Returns:
+        Кортеж (ключ пакета, смещение, размер)
+    """
+    data = b"".join([chunk async for chunk in chunks])
+    pack = f"{user_dir}/{PACKS_DIR}/{date.today():%Y-%m-%d}.pack"
+    offset = await run_io(_append_sync, _pack_path(pack), data, digest)
+    return pack, offset, len(data)
+
+
+def _read_sync(path: Path, offset: int, size: int) -> bytes:
+    with open(path, "rb") as file:
+        file.seek(offset)
+        return file.read(size)
+
+
+async def read_packed(obj: StoredObject) -> bytes:
+    """Читает содержимое файла из пакета."""
+    assert obj.pack is not None
+    return await asyncio.to_thread(
+        _read_sync, _pack_path(obj.pack), obj.pack_offset, obj.size
+    )
+
+
+def iter_read_batches(
+    entries: list[StoredObject],
+) -> Iterator[list[StoredObject]]:
+    """Делит файлы пакета на пачки для чтения за одно обращение."""
+    batch: list[StoredObject] = []
+    batch_size = 0
+    for obj in entries:
+        batch.append(obj)
+        batch_size += obj.size
+        if batch_size >= READ_BATCH_SIZE:
+            yield batch
+            batch = []
+            batch_size = 0
+    if batch:
+        yield batch
+
+
+def write_packed_to_zip(
+    zip_file: zipfile.ZipFile,
+    pack: str,
+    entries: list[tuple[StoredObject, zipfile.ZipInfo]],
+) -> None:
+    """
+    Переписывает файлы из пакета в архив (блокирующая функция).
+
+    Файлы должны быть упорядочены по смещению: тогда пакет читается
+    последовательно, без лишних переходов.
+    """
+    with open(_pack_path(pack), "rb") as file:
+        for obj, zip_info in entries:
+            if file.tell() != obj.pack_offset:
+                file.seek(obj.pack_offset)
+            data = file.read(obj.size)
+            if len(data) != obj.size:
+                raise OSError(f"Пакет {pack} повреждён: не найден файл {obj.key}")
+            zip_file.writestr(zip_info, data)
+
+
+def _compact_sync(
+    pack: str, entries: list[StoredObject]
+) -> tuple[str, int, list[tuple[str, int]]]:
+    source = _pack_path(pack)
+    stem = source.name.split(".")[0]
+    new_pack = f"{pack.rsplit('/', 1)[0]}/{stem}.{uuid.uuid4().hex[:8]}.pack"
+
+    offsets = []
+    if entries:
+        with open(source, "rb") as src, open(_pack_path(new_pack), "wb") as dst:
+            for obj in entries:
+                src.seek(obj.pack_offset)
+                offsets.append((obj.key, dst.tell()))
+                dst.write(src.read(obj.size))
+            size = dst.tell()
+    else:
+        size = 0
+    return new_pack, size, offsets
+
+
+async def compact_packs() -> int:
+    """
+    Уплотняет пакеты, в которых после удаления файлов много пустого места.
+
+    Живые файлы копируются в новый пакет, индекс переключается на него одной
+    транзакцией, и только затем старый пакет удаляется: сбой на любом шаге не
+    портит уже сохранённые файлы.
+
+    Returns:
+        Количество освобождённых байт
+    """
+    if not settings.PACK_SMALL_FILES or not isinstance(storage, LocalStorage):
+        return 0
+
+    freed = 0
+    for pack, user_id in await file_index.fragmented_packs(settings.PACK_COMPACT_RATIO):
+        try:
+            async with user_lock(user_id):
+                entries = await file_index.list_pack_files(pack)
+                old_size = (await asyncio.to_thread(_pack_path(pack).stat)).st_size
+                new_pack, size, offsets = await asyncio.to_thread(
+                    _compact_sync, pack, entries
+                )
+                await file_index.replace_pack(
+                    pack, new_pack=new_pack, user_id=user_id, size=size, offsets=offsets
+                )
+                await asyncio.to_thread(_pack_path(pack).unlink, missing_ok=True)
+        except Exception as e:
+            logger.error("Ошибка при уплотнении пакета {}: {}", pack, e)
+            continue
+
+        freed += old_size - size
+        logger.debug("Пакет {} уплотнён: {} -> {} байт", pack, old_size, size)
+    return freed
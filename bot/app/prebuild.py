@@ -0,0 +1,117 @@
+"""
+Заранее собирает архивы за прошедший день в непиковое время.
+
+Большинство запросов `/archive YYYY-MM-DD` приходится на вчерашний день и
+приходит утром, одновременно. В ARCHIVE_PREBUILD_TIME планировщик собирает
+вчерашние архивы всех пользователей, сохранявших в тот день файлы, в кэш
+(`archive_cache.py`), и утренние запросы отдаются из него.
+
+Сжатие выполняется в отдельном потоке с пониженным приоритетом
+(ARCHIVE_PREBUILD_NICE), а между архивами планировщик делает паузы, чтобы сборка
+занимала не больше ARCHIVE_PREBUILD_BUDGET времени.
+"""
+
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+import archive_cache
+from config import settings
+from index import file_index
+from locks import user_lock
+from loguru import logger
+from services import ArchiveFilter, prebuild_user_archive
+
+
+def _lower_priority() -> None:
+    # В Linux приоритет (nice) задаётся для потока, а не для всего процесса, и
+    # по умолчанию от него же зависит приоритет ввода-вывода
+    os.nice(settings.ARCHIVE_PREBUILD_NICE)
+
+
+def _day_bounds(day: date) -> tuple[float, float]:
+    start = datetime.combine(day, datetime.min.time())
+    return start.timestamp(), (start + timedelta(days=1)).timestamp()
+
+
+async def prebuild_archives(day: date, executor: ThreadPoolExecutor) -> int:
+    """
+    Собирает в кэш архивы за указанный день для всех пользователей с файлами за него.
+
+    Args:
+        day: День, за который собираются архивы
+        executor: Пул потоков для сжатия
+
+    Returns:
+        Количество собранных архивов
+    """
+    created_from, created_to = _day_bounds(day)
+    user_ids = await file_index.users_with_files(
+        created_from=created_from, created_to=created_to
+    )
+    logger.info("Предварительная сборка архивов за {}: {} польз.", day, len(user_ids))
+
+    budget = settings.ARCHIVE_PREBUILD_BUDGET
+    built = 0
+    for user_id in user_ids:
+        started = time.monotonic()
+        try:
+            # Под блокировкой пользователя: иначе /clear во время сборки удалил бы
+            # файлы, а их архив всё равно попал бы в кэш
+            async with user_lock(user_id):
+                prebuilt = await prebuild_user_archive(
+                    user_id,
+                    ArchiveFilter(date_from=day, date_to=day),
+                    executor=executor,
+                )
+            if prebuilt:
+                built += 1
+        except Exception as e:
+            logger.error(
+                "Ошибка при сборке архива за {} пользователя {}: {}", day, user_id, e
+            )
+
+        # Пауза пропорциональна времени сборки: доля работы не превышает бюджет
+        elapsed = time.monotonic() - started
+        await asyncio.sleep(elapsed * (1 - budget) / budget)
+
+    logger.info("Собрано заранее {} архивов за {}", built, day)
+    return built
+
+
+def _seconds_until(run_at: datetime) -> float:
+    return max((run_at - datetime.now()).total_seconds(), 0)
+
+
+async def run_prebuild_scheduler() -> None:
+    """Фоновая задача: раз в сутки в ARCHIVE_PREBUILD_TIME собирает вчерашние архивы."""
+    if settings.ARCHIVE_PREBUILD_TIME is None:
+        return
+
+    logger.info(
+        "Предварительная сборка архивов запускается в {}",
+        settings.ARCHIVE_PREBUILD_TIME,
+    )
+    executor = ThreadPoolExecutor(
+        max_workers=1,
+        thread_name_prefix="archive-prebuild",
+        initializer=_lower_priority,
+    )
+    try:
+        while True:
+            now = datetime.now()
+            run_at = datetime.combine(now.date(), settings.ARCHIVE_PREBUILD_TIME)
+            if run_at <= now:
+                run_at += timedelta(days=1)
+            await asyncio.sleep(_seconds_until(run_at))
+
+            try:
+                await archive_cache.purge_expired()
+                await prebuild_archives(run_at.date() - timedelta(days=1), executor)
+            except Exception as e:
+                logger.error("Ошибка при предварительной сборке архивов: {}", e)
+    finally:
+        # Не ждём завершения сжатия, чтобы не блокировать остановку бота
+        executor.shutdown(wait=False, cancel_futures=True)
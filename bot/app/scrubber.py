@@ -0,0 +1,117 @@
+"""
+Фоновая проверка целостности сохранённых файлов.
+
+Файлы перечитываются и сверяются с контрольной суммой, записанной в индекс при
+скачивании. Скорость чтения ограничена SCRUB_BYTES_PER_SECOND, чтобы проверка не
+мешала сохранению файлов и сборке архивов; каждый файл перепроверяется не чаще
+раза в SCRUB_INTERVAL секунд.
+"""
+
+import asyncio
+import hashlib
+import time
+from collections.abc import AsyncIterator
+
+from config import settings
+from index import file_index
+from loguru import logger
+from metrics import counter
+from packs import read_packed
+from storage import StoredObject, storage
+
+verified_bytes = counter(
+    "archiver_scrubber_verified_bytes_total",
+    "Объём файлов, проверенных по контрольной сумме, байт",
+)
+corrupted_files = counter(
+    "archiver_scrubber_corrupted_files_total",
+    "Количество файлов, не прошедших проверку контрольной суммы",
+)
+
+# Пауза, когда все файлы недавно проверены
+IDLE_DELAY = 60 * 60
+# Через сколько повторить проверку файла, который не удалось прочитать
+RETRY_DELAY = 60 * 60
+
+
+async def _read(obj: StoredObject) -> AsyncIterator[bytes]:
+    if obj.pack:
+        yield await read_packed(obj)
+        return
+    async for chunk in storage.open_stream(
+        obj.key, chunk_size=settings.ARCHIVE_CHUNK_SIZE
+    ):
+        yield chunk
+
+
+async def _verify(obj: StoredObject, rate: int) -> str | None:
+    """Проверяет файл и возвращает причину ошибки или None, если файл цел."""
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async for chunk in _read(obj):
+            # Хеширование больших блоков отпускает GIL, поэтому идёт в потоке
+            await asyncio.to_thread(digest.update, chunk)
+            size += len(chunk)
+            verified_bytes.inc(len(chunk))
+            await asyncio.sleep(len(chunk) / rate)
+    except FileNotFoundError:
+        return "missing"
+
+    if size != obj.size:
+        return "size"
+    if digest.hexdigest() != obj.sha256:
+        return "sha256"
+    return None
+
+
+async def scrub_batch(rate: int) -> int:
+    """
+    Проверяет очередную пачку файлов.
+
+    Args:
+        rate: Ограничение скорости чтения, байт/с
+
+    Returns:
+        Количество проверенных файлов
+    """
+    objects = await file_index.select_for_scrub(
+        limit=settings.SWEEP_BATCH_SIZE,
+        verified_before=time.time() - settings.SCRUB_INTERVAL,
+    )
+    for obj in objects:
+        try:
+            reason = await _verify(obj, rate)
+        except Exception as e:
+            logger.warning("Не удалось проверить файл {}: {}", obj.key, e)
+            # Откладываем повторную проверку, иначе файл снова попадёт в
+            # начало следующей пачки и проверка зациклится
+            await file_index.mark_verified(
+                [obj.key],
+                verified_at=time.time() - settings.SCRUB_INTERVAL + RETRY_DELAY,
+            )
+            continue
+
+        # Файл могли удалить или перенести в другой пакет во время проверки
+        if reason is not None and await file_index.get_file(obj.key) == obj:
+            corrupted_files.inc(reason=reason)
+            logger.error("Файл {} повреждён ({})", obj.key, reason)
+
+        await file_index.mark_verified([obj.key])
+    return len(objects)
+
+
+async def run_scrubber() -> None:
+    """Фоновая задача: непрерывно проверяет файлы с ограничением скорости."""
+    rate = settings.SCRUB_BYTES_PER_SECOND
+    if rate is None:
+        return
+
+    logger.info("Проверка целостности файлов запущена: до {} байт/с", rate)
+    while True:
+        try:
+            if await scrub_batch(rate):
+                continue
+        except Exception as e:
+            logger.error("Ошибка при проверке целостности файлов: {}", e)
+        await asyncio.sleep(IDLE_DELAY)
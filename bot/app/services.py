@@ -1,9 +1,20 @@
-import shutil
+import asyncio
+import hashlib
+import re
 import tempfile
 import zipfile
-from datetime import datetime
+from collections import deque
+from collections.abc import AsyncGenerator, AsyncIterator, Callable, Iterable
+from concurrent.futures import Executor
+from contextlib import aclosing
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from functools import partial
+from itertools import groupby
 from pathlib import Path
+from typing import Any, Literal, get_args
 
+import archive_cache
 from aiogram import Bot
 from aiogram.types import (
     Audio,
@@ -16,7 +27,26 @@ from aiogram.types import (
     Voice,
 )
 from config import settings
+from index import file_index
 from loguru import logger
+from packs import append_to_pack, iter_read_batches, should_pack, write_packed_to_zip
+from session import download_stream
+from storage import (
+    StoredObject,
+    candidate_user_dirs,
+    resolve_user_dir,
+    storage,
+)
+
+# Тип вложения, из которого сохранён файл
+MediaType = Literal[
+    "document", "photo", "audio", "video", "voice", "video_note", "sticker"
+]
+
+
+def has_user_files(message: Message) -> bool:
+    """Проверяет, есть ли в сообщении вложения, которые сохраняет бот."""
+    return any(getattr(message, media_type) for media_type in get_args(MediaType))
 
 
 async def save_user_files(
@@ -32,56 +62,61 @@ async def save_user_files(
         bot: Экземпляр бота для скачивания файлов
 
     Returns:
-        Список путей к сохраненным файлам
+        Список ключей сохранённых файлов в хранилище
     """
     if not message.from_user:
         logger.error("Получено сообщение без данных пользователя")
         return []
 
     user_id = message.from_user.id
-    user_dir = Path(settings.FILES_DIR) / str(user_id)
-
-    # Создаем директорию пользователя, если её нет
-    user_dir.mkdir(parents=True, exist_ok=True)
+    user_dir = await resolve_user_dir(user_id)
 
     saved_files = []
 
     # Обработка документов
     if message.document:
         file_path = await _save_document(
-            document=message.document, user_dir=user_dir, bot=bot
+            document=message.document, user_id=user_id, user_dir=user_dir, bot=bot
         )
         if file_path:
             saved_files.append(file_path)
 
     # Обработка изображений
     if message.photo:
-        file_path = await _save_photo(photos=message.photo, user_dir=user_dir, bot=bot)
+        file_path = await _save_photo(
+            photos=message.photo, user_id=user_id, user_dir=user_dir, bot=bot
+        )
         if file_path:
             saved_files.append(file_path)
 
     # Обработка аудио
     if message.audio:
-        file_path = await _save_audio(audio=message.audio, user_dir=user_dir, bot=bot)
+        file_path = await _save_audio(
+            audio=message.audio, user_id=user_id, user_dir=user_dir, bot=bot
+        )
         if file_path:
             saved_files.append(file_path)
 
     # Обработка видео
     if message.video:
-        file_path = await _save_video(video=message.video, user_dir=user_dir, bot=bot)
+        file_path = await _save_video(
+            video=message.video, user_id=user_id, user_dir=user_dir, bot=bot
+        )
         if file_path:
             saved_files.append(file_path)
 
     # Обработка голосовых сообщений
     if message.voice:
-        file_path = await _save_voice(voice=message.voice, user_dir=user_dir, bot=bot)
+        file_path = await _save_voice(
+            voice=message.voice, user_id=user_id, user_dir=user_dir, bot=bot
+        )
         if file_path:
             saved_files.append(file_path)
 
     # Обработка видеозаметок
     if message.video_note:
         file_path = await _save_video_note(
-            video_note=message.video_note, user_dir=user_dir, bot=bot
+            video_note=message.video_note, user_id=user_id, user_dir=user_dir, bot=bot
         )
         if file_path:
             saved_files.append(file_path)
@@ -89,13 +124,15 @@ async def save_user_files(
     # Обработка стикеров
     if message.sticker:
         file_path = await _save_sticker(
-            sticker=message.sticker, user_dir=user_dir, bot=bot
+            sticker=message.sticker, user_id=user_id, user_dir=user_dir, bot=bot
         )
         if file_path:
             saved_files.append(file_path)
 
     if saved_files:
-        logger.info(f"Сохранено {len(saved_files)} файлов для пользователя {user_id}")
+        logger.debug(
+            "Сохранено {} файлов для пользователя {}", len(saved_files), user_id
+        )
 
     return saved_files
 
@@ -110,66 +147,131 @@ async def clear_user_files(user_id: int) -> int:
     Returns:
         Количество удаленных файлов
     """
-    user_dir = Path(settings.FILES_DIR) / str(user_id)
+    try:
+        # Удаляем все файлы пользователя, в том числе ещё не перенесённые
+        # в новую раскладку директорий
+        for user_dir in candidate_user_dirs(user_id):
+            await storage.delete_prefix(user_dir)
+        # Файлы из пакетов не видны в хранилище по отдельности, поэтому
+        # считаем удалённые файлы по индексу
+        files_count: int = await file_index.remove_user(user_id)
+        await archive_cache.remove_user(user_id)
+
+        if files_count == 0:
+            logger.debug("У пользователя {} нет сохранённых файлов", user_id)
+            return 0
+
+        logger.info("Удалено {} файлов для пользователя {}", files_count, user_id)
+        return files_count
 
-    if not user_dir.exists():
-        logger.debug(f"Директория пользователя {user_id} не существует")
+    except Exception as e:
+        logger.error("Ошибка при удалении файлов пользователя {}: {}", user_id, e)
         return 0
 
-    try:
-        # Подсчитываем количество файлов перед удалением
-        files_count = sum(1 for file in user_dir.rglob("*") if file.is_file())
 
-        # Удаляем всю директорию пользователя
-        shutil.rmtree(user_dir)
+async def _unique_key(*, user_dir: str, filename: str) -> str:
+    """Подбирает свободный ключ, добавляя к имени файла суффикс при совпадении."""
+    key = f"{user_dir}/{filename}"
+    original_path = Path(filename)
+    name = original_path.stem
+    suffix = original_path.suffix
 
-        logger.info(f"Удалено {files_count} файлов для пользователя {user_id}")
-        return files_count
+    # Все занятые варианты имени получаем одним запросом к индексу
+    taken = await file_index.keys_with_prefix(f"{user_dir}/{name}")
 
-    except Exception as e:
-        logger.error(f"Ошибка при удалении файлов пользователя {user_id}: {e}")
-        return 0
+    # Если файл с таким именем уже существует, добавляем суффикс
+    counter = 1
+    while key in taken:
+        key = f"{user_dir}/{name}_{counter}{suffix}"
+        counter += 1
+
+    return key
+
+
+async def _download_to_storage(
+    *,
+    bot: Bot,
+    telegram_path: str,
+    file_size: int | None,
+    user_id: int,
+    user_dir: str,
+    filename: str,
+    media_type: MediaType,
+) -> str:
+    """
+    Скачивает файл из Telegram прямо в хранилище, добавляет в индекс и возвращает ключ.
+
+    SHA-256 считается по ходу скачивания, без повторного чтения файла.
+    """
+    key = await _unique_key(user_dir=user_dir, filename=filename)
+    digest = hashlib.sha256()
+    chunks = download_stream(bot=bot, telegram_path=telegram_path, file_size=file_size)
+
+    # Небольшие файлы дописываются в пакет вместо отдельного файла
+    if should_pack(file_size):
+        pack, offset, size = await append_to_pack(
+            user_dir=user_dir, chunks=chunks, digest=digest
+        )
+        await file_index.add_file(
+            user_id=user_id,
+            key=key,
+            size=size,
+            pack=pack,
+            pack_offset=offset,
+            sha256=digest.hexdigest(),
+            media_type=media_type,
+        )
+        return key
+
+    size = await storage.put_stream(key, chunks, digest=digest)
+    await file_index.add_file(
+        user_id=user_id,
+        key=key,
+        size=size,
+        sha256=digest.hexdigest(),
+        media_type=media_type,
+    )
+    return key
 
 
 async def _save_document(
     *,
     document: Document,
-    user_dir: Path,
+    user_id: int,
+    user_dir: str,
     bot: Bot,
 ) -> str | None:
     """Сохраняет документ."""
     try:
         file = await bot.get_file(document.file_id)
         if not file.file_path:
-            logger.error(f"Не удалось получить путь к файлу {document.file_id}")
+            logger.error("Не удалось получить путь к файлу {}", document.file_id)
             return None
 
         # Используем оригинальное имя файла или генерируем по file_id
         filename = document.file_name or f"{document.file_id}.bin"
-        file_path = user_dir / filename
-
-        # Если файл с таким именем уже существует, добавляем суффикс
-        counter = 1
-        original_path = file_path
-        while file_path.exists():
-            name = original_path.stem
-            suffix = original_path.suffix
-            file_path = user_dir / f"{name}_{counter}{suffix}"
-            counter += 1
-
-        await bot.download_file(file.file_path, file_path)
-        logger.debug(f"Сохранён документ: {file_path}")
-        return str(file_path)
+        key = await _download_to_storage(
+            bot=bot,
+            telegram_path=file.file_path,
+            file_size=file.file_size,
+            user_id=user_id,
+            user_dir=user_dir,
+            filename=filename,
+            media_type="document",
+        )
+        logger.debug("Сохранён документ: {}", key)
+        return key
 
     except Exception as e:
-        logger.error(f"Ошибка при сохранении документа: {e}")
+        logger.error("Ошибка при сохранении документа: {}", e)
         return None
 
 
 async def _save_photo(
     *,
     photos: list[PhotoSize],
-    user_dir: Path,
+    user_id: int,
+    user_dir: str,
     bot: Bot,
 ) -> str | None:
     """Сохраняет фото (выбирает максимальное разрешение)."""
@@ -179,103 +281,99 @@ async def _save_photo(
 
         file = await bot.get_file(photo.file_id)
         if not file.file_path:
-            logger.error(f"Не удалось получить путь к фото {photo.file_id}")
+            logger.error("Не удалось получить путь к фото {}", photo.file_id)
             return None
 
         # Определяем расширение по пути файла или используем .jpg по умолчанию
         extension = Path(file.file_path).suffix or ".jpg"
         filename = f"{photo.file_id}{extension}"
-        file_path = user_dir / filename
-
-        # Если файл уже существует, добавляем суффикс
-        counter = 1
-        original_path = file_path
-        while file_path.exists():
-            name = original_path.stem
-            suffix = original_path.suffix
-            file_path = user_dir / f"{name}_{counter}{suffix}"
-            counter += 1
-
-        await bot.download_file(file.file_path, file_path)
-        logger.debug(f"Сохранено фото: {file_path}")
-        return str(file_path)
+        key = await _download_to_storage(
+            bot=bot,
+            telegram_path=file.file_path,
+            file_size=file.file_size,
+            user_id=user_id,
+            user_dir=user_dir,
+            filename=filename,
+            media_type="photo",
+        )
+        logger.debug("Сохранено фото: {}", key)
+        return key
 
     except Exception as e:
-        logger.error(f"Ошибка при сохранении фото: {e}")
+        logger.error("Ошибка при сохранении фото: {}", e)
         return None
 
 
 async def _save_audio(
     *,
     audio: Audio,
-    user_dir: Path,
+    user_id: int,
+    user_dir: str,
     bot: Bot,
 ) -> str | None:
     """Сохраняет аудио файл."""
     try:
         file = await bot.get_file(audio.file_id)
         if not file.file_path:
-            logger.error(f"Не удалось получить путь к аудио {audio.file_id}")
+            logger.error("Не удалось получить путь к аудио {}", audio.file_id)
             return None
 
         # Используем оригинальное имя или генерируем
         filename = audio.file_name or f"{audio.file_id}.mp3"
-        file_path = user_dir / filename
-
-        counter = 1
-        original_path = file_path
-        while file_path.exists():
-            name = original_path.stem
-            suffix = original_path.suffix
-            file_path = user_dir / f"{name}_{counter}{suffix}"
-            counter += 1
-
-        await bot.download_file(file.file_path, file_path)
-        logger.debug(f"Сохранено аудио: {file_path}")
-        return str(file_path)
+        key = await _download_to_storage(
+            bot=bot,
+            telegram_path=file.file_path,
+            file_size=file.file_size,
+            user_id=user_id,
+            user_dir=user_dir,
+            filename=filename,
+            media_type="audio",
+        )
+        logger.debug("Сохранено аудио: {}", key)
+        return key
 
     except Exception as e:
-        logger.error(f"Ошибка при сохранении аудио: {e}")
+        logger.error("Ошибка при сохранении аудио: {}", e)
         return None
 
 
 async def _save_video(
     *,
     video: Video,
-    user_dir: Path,
+    user_id: int,
+    user_dir: str,
     bot: Bot,
 ) -> str | None:
     """Сохраняет видео файл."""
     try:
         file = await bot.get_file(video.file_id)
         if not file.file_path:
-            logger.error(f"Не удалось получить путь к видео {video.file_id}")
+            logger.error("Не удалось получить путь к видео {}", video.file_id)
             return None
 
         filename = video.file_name or f"{video.file_id}.mp4"
-        file_path = user_dir / filename
-
-        counter = 1
-        original_path = file_path
-        while file_path.exists():
-            name = original_path.stem
-            suffix = original_path.suffix
-            file_path = user_dir / f"{name}_{counter}{suffix}"
-            counter += 1
-
-        await bot.download_file(file.file_path, file_path)
-        logger.debug(f"Сохранено видео: {file_path}")
-        return str(file_path)
+        key = await _download_to_storage(
+            bot=bot,
+            telegram_path=file.file_path,
+            file_size=file.file_size,
+            user_id=user_id,
+            user_dir=user_dir,
+            filename=filename,
+            media_type="video",
+        )
+        logger.debug("Сохранено видео: {}", key)
+        return key
 
     except Exception as e:
-        logger.error(f"Ошибка при сохранении видео: {e}")
+        logger.error("Ошибка при сохранении видео: {}", e)
         return None
 
 
 async def _save_voice(
     *,
     voice: Voice,
-    user_dir: Path,
+    user_id: int,
+    user_dir: str,
     bot: Bot,
 ) -> str | None:
     """Сохраняет голосовое сообщение."""
@@ -283,34 +381,33 @@ async def _save_voice(
         file = await bot.get_file(voice.file_id)
         if not file.file_path:
             logger.error(
-                f"Не удалось получить путь к голосовому сообщению {voice.file_id}"
+                "Не удалось получить путь к голосовому сообщению {}", voice.file_id
             )
             return None
 
         filename = f"{voice.file_id}.ogg"
-        file_path = user_dir / filename
-
-        counter = 1
-        original_path = file_path
-        while file_path.exists():
-            name = original_path.stem
-            suffix = original_path.suffix
-            file_path = user_dir / f"{name}_{counter}{suffix}"
-            counter += 1
-
-        await bot.download_file(file.file_path, file_path)
-        logger.debug(f"Сохранено голосовое сообщение: {file_path}")
-        return str(file_path)
+        key = await _download_to_storage(
+            bot=bot,
+            telegram_path=file.file_path,
+            file_size=file.file_size,
+            user_id=user_id,
+            user_dir=user_dir,
+            filename=filename,
+            media_type="voice",
+        )
+        logger.debug("Сохранено голосовое сообщение: {}", key)
+        return key
 
     except Exception as e:
-        logger.error(f"Ошибка при сохранении голосового сообщения: {e}")
+        logger.error("Ошибка при сохранении голосового сообщения: {}", e)
         return None
 
 
 async def _save_video_note(
     *,
     video_note: VideoNote,
-    user_dir: Path,
+    user_id: int,
+    user_dir: str,
     bot: Bot,
 ) -> str | None:
     """Сохраняет видеозаметку."""
@@ -318,189 +415,546 @@ async def _save_video_note(
         file = await bot.get_file(video_note.file_id)
         if not file.file_path:
             logger.error(
-                f"Не удалось получить путь к видеозаметке {video_note.file_id}"
+                "Не удалось получить путь к видеозаметке {}", video_note.file_id
             )
             return None
 
         filename = f"{video_note.file_id}.mp4"
-        file_path = user_dir / filename
-
-        counter = 1
-        original_path = file_path
-        while file_path.exists():
-            name = original_path.stem
-            suffix = original_path.suffix
-            file_path = user_dir / f"{name}_{counter}{suffix}"
-            counter += 1
-
-        await bot.download_file(file.file_path, file_path)
-        logger.debug(f"Сохранена видеозаметка: {file_path}")
-        return str(file_path)
+        key = await _download_to_storage(
+            bot=bot,
+            telegram_path=file.file_path,
+            file_size=file.file_size,
+            user_id=user_id,
+            user_dir=user_dir,
+            filename=filename,
+            media_type="video_note",
+        )
+        logger.debug("Сохранена видеозаметка: {}", key)
+        return key
 
     except Exception as e:
-        logger.error(f"Ошибка при сохранении видеозаметки: {e}")
+        logger.error("Ошибка при сохранении видеозаметки: {}", e)
         return None
 
 
 async def _save_sticker(
     *,
     sticker: Sticker,
-    user_dir: Path,
+    user_id: int,
+    user_dir: str,
     bot: Bot,
 ) -> str | None:
     """Сохраняет стикер."""
     try:
         file = await bot.get_file(sticker.file_id)
         if not file.file_path:
-            logger.error(f"Не удалось получить путь к стикеру {sticker.file_id}")
+            logger.error("Не удалось получить путь к стикеру {}", sticker.file_id)
             return None
 
         # Определяем расширение: .webp для обычных стикеров, .tgs для анимированных
         extension = ".tgs" if sticker.is_animated else ".webp"
         filename = f"{sticker.file_id}{extension}"
-        file_path = user_dir / filename
-
-        counter = 1
-        original_path = file_path
-        while file_path.exists():
-            name = original_path.stem
-            suffix = original_path.suffix
-            file_path = user_dir / f"{name}_{counter}{suffix}"
-            counter += 1
-
-        await bot.download_file(file.file_path, file_path)
-        logger.debug(f"Сохранён стикер: {file_path}")
-        return str(file_path)
+        key = await _download_to_storage(
+            bot=bot,
+            telegram_path=file.file_path,
+            file_size=file.file_size,
+            user_id=user_id,
+            user_dir=user_dir,
+            filename=filename,
+            media_type="sticker",
+        )
+        logger.debug("Сохранён стикер: {}", key)
+        return key
 
     except Exception as e:
-        logger.error(f"Ошибка при сохранении стикера: {e}")
+        logger.error("Ошибка при сохранении стикера: {}", e)
         return None
 
 
-async def create_user_archive(user_id: int) -> str | None:
+@dataclass(frozen=True)
+class UserArchive:
     """
-    Создаёт zip-архив со всеми файлами пользователя.
+    Собранный архив: путь к файлу и ключи вошедших в него файлов.
 
-    Args:
-        user_id: ID пользователя
-
-    Returns:
-        Путь к созданному архиву или None, если файлов нет или произошла ошибка
+    Архив из кэша (`cached`) после отправки не удаляется.
     """
-    user_dir = Path(settings.FILES_DIR) / str(user_id)
 
-    if not user_dir.exists():
-        logger.debug(f"Директория пользователя {user_id} не существует")
-        return None
+    path: str
+    keys: list[str]
+    cached: bool = False
 
-    # Находим все файлы пользователя
-    user_files = list(user_dir.rglob("*"))
-    user_files = [f for f in user_files if f.is_file()]
 
-    if not user_files:
-        logger.debug(f"У пользователя {user_id} нет сохранённых файлов")
-        return None
+async def _read_ahead(
+    objects: Iterable[StoredObject],
+) -> AsyncGenerator[tuple[StoredObject, AsyncIterator[bytes]], None]:
+    """
+    Читает файлы из хранилища с упреждением.
+
+    Пока архиватор обрабатывает текущий файл, следующие ARCHIVE_READ_AHEAD файлов
+    уже скачиваются в ограниченные очереди, что скрывает задержку удалённого
+    хранилища. Поток каждого файла нужно дочитать до конца перед переходом к
+    следующему.
+    """
+    pending: deque[tuple[StoredObject, asyncio.Queue, asyncio.Task]] = deque()
+    objects_iter = iter(objects)
 
+    async def prefetch(obj: StoredObject, queue: asyncio.Queue) -> None:
+        try:
+            async for chunk in storage.open_stream(
+                obj.key, chunk_size=settings.ARCHIVE_CHUNK_SIZE
+            ):
+                await queue.put(chunk)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(None)
+
+    def start_next() -> None:
+        obj = next(objects_iter, None)
+        if obj is None:
+            return
+        # Очередь ограничена, чтобы упреждающее чтение не занимало много памяти
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2)
+        pending.append((obj, queue, asyncio.create_task(prefetch(obj, queue))))
+
+    async def drain(queue: asyncio.Queue) -> AsyncIterator[bytes]:
+        while (item := await queue.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    # Чтение файла, который сейчас дочитывает архиватор: при ошибке записи его
+    # тоже нужно отменить, иначе оно навсегда зависнет на заполненной очереди
+    current: asyncio.Task | None = None
     try:
-        # Создаём временный файл для архива
-        temp_archive = tempfile.NamedTemporaryFile(
-            delete=False, suffix=".zip", prefix=f"user_{user_id}_"
-        )
-        archive_path = temp_archive.name
-        temp_archive.close()
+        for _ in range(settings.ARCHIVE_READ_AHEAD):
+            start_next()
 
-        # Создаём zip-архив
-        with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            for file_path in user_files:
-                # Добавляем файл в архив с относительным путём
-                arcname = file_path.relative_to(user_dir)
-                zip_file.write(file_path, arcname)
+        while pending:
+            obj, queue, current = pending.popleft()
+            start_next()
+            yield obj, drain(queue)
+    finally:
+        if current is not None:
+            current.cancel()
+        for _obj, _queue, task in pending:
+            task.cancel()
 
-        logger.info(
-            f"Создан архив {archive_path} с {len(user_files)} файлами для пользователя {user_id}"
-        )
-        return archive_path
 
-    except Exception as e:
-        logger.error(f"Ошибка при создании архива для пользователя {user_id}: {e}")
-        return None
+# Файл с контрольными суммами в корне архива (формат `sha256sum -c`). Имя
+# зарезервировано: файл пользователя с таким именем попадает в архив под другим
+MANIFEST_NAME = "MANIFEST.sha256"
+
+
+def _archive_names(objects: list[StoredObject], user_dir: str) -> dict[str, str]:
+    """
+    Возвращает пути файлов в архиве (относительно директории пользователя).
+
+    Файл пользователя с именем манифеста получает, как при сохранении, первое
+    свободное имя с суффиксом (`MANIFEST_1.sha256`).
+    """
+    names = {obj.key: obj.key.removeprefix(f"{user_dir}/") for obj in objects}
+    taken = set(names.values())
+    if MANIFEST_NAME in taken:
+        reserved = Path(MANIFEST_NAME)
+        counter = 1
+        while (name := f"{reserved.stem}_{counter}{reserved.suffix}") in taken:
+            counter += 1
+        key = next(key for key, value in names.items() if value == MANIFEST_NAME)
+        names[key] = name
+    return names
+
+
+def _zip_info(obj: StoredObject, name: str) -> zipfile.ZipInfo:
+    zip_info = zipfile.ZipInfo(name, date_time=obj.created_at.timetuple()[:6])
+    zip_info.compress_type = zipfile.ZIP_DEFLATED
+    return zip_info
 
 
-async def create_user_archive_by_date(
+def _manifest_line(sha256: str, name: str) -> str:
+    # Как в sha256sum: строка с именем, содержащим "\" или перевод строки,
+    # начинается с "\", а сами символы экранируются
+    if "\\" in name or "\n" in name:
+        escaped = name.replace("\\", "\\\\").replace("\n", "\\n")
+        return f"\\{sha256}  {escaped}\n"
+    return f"{sha256}  {name}\n"
+
+
+def _manifest(objects: list[StoredObject], names: dict[str, str]) -> str:
+    """
+    Составляет манифест по контрольным суммам из индекса, не перечитывая файлы.
+
+    Файлы, сохранённые до появления контрольных сумм, в манифест не попадают.
+    """
+    lines = [
+        _manifest_line(obj.sha256, names[obj.key]) for obj in objects if obj.sha256
+    ]
+    return "".join(lines)
+
+
+async def _build_archive(
     *,
-    user_id: int,
-    target_date: str,
-) -> str | None:
+    user_dir: str,
+    objects: list[StoredObject],
+    prefix: str,
+    directory: Path | None = None,
+    executor: Executor | None = None,
+) -> str:
     """
-    Создаёт zip-архив с файлами пользователя за указанную дату.
+    Собирает zip-архив из файлов хранилища во временный файл и возвращает путь к нему.
 
     Args:
-        user_id: ID пользователя
-        target_date: Дата в формате YYYY-MM-DD
-
-    Returns:
-        Путь к созданному архиву или None, если файлов нет или произошла ошибка
+        user_dir: Директория пользователя
+        objects: Файлы архива
+        prefix: Префикс имени временного файла
+        directory: Директория временного файла (по умолчанию системная)
+        executor: Пул потоков для сжатия и записи (по умолчанию общий)
     """
-    user_dir = Path(settings.FILES_DIR) / str(user_id)
+    loop = asyncio.get_running_loop()
 
-    if not user_dir.exists():
-        logger.debug(f"Директория пользователя {user_id} не существует")
-        return None
+    async def run(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
 
-    # Находим все файлы пользователя
-    user_files = list(user_dir.rglob("*"))
-    user_files = [f for f in user_files if f.is_file()]
+    # Создаём временный файл для архива
+    temp_archive = tempfile.NamedTemporaryFile(
+        delete=False, suffix=".zip", prefix=prefix, dir=directory
+    )
+    archive_path = temp_archive.name
+    temp_archive.close()
 
-    if not user_files:
-        logger.debug(f"У пользователя {user_id} нет сохранённых файлов")
-        return None
+    names = _archive_names(objects, user_dir)
 
-    # Фильтруем файлы по дате
-    files_for_date = []
-    for file_path in user_files:
+    try:
+        zip_file = await run(zipfile.ZipFile, archive_path, "w", zipfile.ZIP_DEFLATED)
         try:
-            # Получаем дату создания файла
-            file_ctime = datetime.fromtimestamp(file_path.stat().st_ctime)
-            file_date = file_ctime.strftime("%Y-%m-%d")
+            # Файлы из пакетов читаются последовательно, пачками за одно
+            # обращение к потоку
+            packed = sorted(
+                (obj for obj in objects if obj.pack),
+                key=lambda obj: (obj.pack or "", obj.pack_offset),
+            )
+            for pack, pack_objects in groupby(packed, key=lambda obj: obj.pack):
+                for batch in iter_read_batches(list(pack_objects)):
+                    await run(
+                        write_packed_to_zip,
+                        zip_file,
+                        pack or "",
+                        [(obj, _zip_info(obj, names[obj.key])) for obj in batch],
+                    )
+
+            loose = [obj for obj in objects if not obj.pack]
+            async with aclosing(_read_ahead(loose)) as files:
+                async for obj, chunks in files:
+                    zip_info = _zip_info(obj, names[obj.key])
+                    entry = await run(zip_file.open, zip_info, "w", force_zip64=True)
+                    try:
+                        async for chunk in chunks:
+                            await run(entry.write, chunk)
+                    finally:
+                        await run(entry.close)
+
+            if manifest := _manifest(objects, names):
+                zip_info = zipfile.ZipInfo(
+                    MANIFEST_NAME, date_time=datetime.now().timetuple()[:6]
+                )
+                zip_info.compress_type = zipfile.ZIP_DEFLATED
+                await run(zip_file.writestr, zip_info, manifest)
+        finally:
+            await run(zip_file.close)
+
+    except BaseException:
+        Path(archive_path).unlink(missing_ok=True)
+        raise
+
+    return archive_path
+
+
+# Названия типов вложений в фильтрах /archive
+MEDIA_TYPE_ALIASES: dict[str, MediaType] = {
+    "doc": "document",
+    "docs": "document",
+    "documents": "document",
+    "photos": "photo",
+    "videos": "video",
+    "videonote": "video_note",
+    "note": "video_note",
+    "stickers": "sticker",
+    **{media_type: media_type for media_type in get_args(MediaType)},
+}
+
+MEDIA_TYPE_NAMES: dict[MediaType, str] = {
+    "document": "документы",
+    "photo": "фото",
+    "audio": "аудио",
+    "video": "видео",
+    "voice": "голосовые",
+    "video_note": "видеозаметки",
+    "sticker": "стикеры",
+}
+
+SIZE_UNITS = {
+    "": 1,
+    "b": 1,
+    "б": 1,
+    "k": 1024,
+    "kb": 1024,
+    "кб": 1024,
+    "m": 1024**2,
+    "mb": 1024**2,
+    "мб": 1024**2,
+    "g": 1024**3,
+    "gb": 1024**3,
+    "гб": 1024**3,
+}
+
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+SIZE_PATTERN = re.compile(r"([<>])(\d+(?:\.\d+)?)([a-zа-я]*)")
+
+
+@dataclass(frozen=True)
+class ArchiveFilter:
+    """Условия отбора файлов в архив; пустой фильтр - все файлы."""
+
+    media_types: tuple[MediaType, ...] = ()
+    date_from: date | None = None
+    date_to: date | None = None
+    min_size: int | None = None
+    max_size: int | None = None
+
+    def __bool__(self) -> bool:
+        return self != ArchiveFilter()
+
+    def describe(self) -> str:
+        """Описание фильтра для сообщений пользователю."""
+        parts = []
+        if self.media_types:
+            parts.append(", ".join(MEDIA_TYPE_NAMES[t] for t in self.media_types))
+        if self.date_from is not None and self.date_from == self.date_to:
+            parts.append(f"за {self.date_from:%Y-%m-%d}")
+        else:
+            if self.date_from is not None:
+                parts.append(f"с {self.date_from:%Y-%m-%d}")
+            if self.date_to is not None:
+                parts.append(f"по {self.date_to:%Y-%m-%d}")
+        if self.min_size is not None:
+            parts.append(f"от {format_file_size(self.min_size)}")
+        if self.max_size is not None:
+            parts.append(f"до {format_file_size(self.max_size)}")
+        return " ".join(parts)
+
+    def filename_suffix(self) -> str:
+        """Суффикс имени файла архива."""
+        parts: list[str] = list(self.media_types)
+        if self.date_from is not None:
+            parts.append(f"{self.date_from:%Y-%m-%d}")
+        if self.date_to is not None and self.date_to != self.date_from:
+            parts.append(f"{self.date_to:%Y-%m-%d}")
+        return "".join(f"_{part}" for part in parts)
+
+
+def parse_archive_filter(args: list[str]) -> ArchiveFilter:
+    """
+    Разбирает аргументы команды /archive.
 
-            if file_date == target_date:
-                files_for_date.append(file_path)
-        except Exception as e:
-            logger.error(f"Ошибка при обработке файла {file_path}: {e}")
-            continue
+    Поддерживаются типы вложений (`photo`, `doc`, ...), дата `YYYY-MM-DD` или
+    период `YYYY-MM-DD..YYYY-MM-DD` и границы размера (`>10MB`, `<500KB`).
 
-    if not files_for_date:
-        logger.debug(f"У пользователя {user_id} нет файлов за дату {target_date}")
-        return None
+    Args:
+        args: Аргументы команды
 
+    Returns:
+        Фильтр архива
+
+    Raises:
+        ValueError: Аргумент не распознан; текст ошибки можно показать пользователю
+    """
+    media_types: list[MediaType] = []
+    date_from = date_to = None
+    min_size = max_size = None
+
+    for arg in args:
+        token = arg.lower()
+        if token in MEDIA_TYPE_ALIASES:
+            if MEDIA_TYPE_ALIASES[token] not in media_types:
+                media_types.append(MEDIA_TYPE_ALIASES[token])
+        elif DATE_PATTERN.match(token):
+            try:
+                first, _, last = token.partition("..")
+                date_from = datetime.strptime(first, "%Y-%m-%d").date()
+                date_to = datetime.strptime(last or first, "%Y-%m-%d").date()
+            except ValueError:
+                raise ValueError(
+                    "Неверный формат даты. Используйте формат YYYY-MM-DD "
+                    "(например: 2024-01-15)"
+                ) from None
+        elif (match := SIZE_PATTERN.fullmatch(token)) and match[3] in SIZE_UNITS:
+            size = int(float(match[2]) * SIZE_UNITS[match[3]])
+            if match[1] == ">":
+                min_size = size
+            else:
+                max_size = size
+        else:
+            raise ValueError(
+                f"Неизвестный фильтр «{arg}». Примеры: /archive photo, "
+                "/archive doc 2024-01-15, /archive video >10MB"
+            )
+
+    return ArchiveFilter(
+        media_types=tuple(media_types),
+        date_from=date_from,
+        date_to=date_to,
+        min_size=min_size,
+        max_size=max_size,
+    )
+
+
+async def _select_files(
+    user_id: int, archive_filter: ArchiveFilter
+) -> list[StoredObject]:
+    """Отбирает файлы пользователя по фильтру одним запросом к индексу."""
+    # Границы дат - локальные сутки, как и в статистике по датам
+    created_from = created_to = None
+    if archive_filter.date_from is not None:
+        created_from = datetime.combine(
+            archive_filter.date_from, datetime.min.time()
+        ).timestamp()
+    if archive_filter.date_to is not None:
+        created_to = datetime.combine(
+            archive_filter.date_to + timedelta(days=1), datetime.min.time()
+        ).timestamp()
+
+    objects: list[StoredObject] = await file_index.list_user_files(
+        user_id,
+        media_types=archive_filter.media_types,
+        created_from=created_from,
+        created_to=created_to,
+        min_size=archive_filter.min_size,
+        max_size=archive_filter.max_size,
+    )
+    return objects
+
+
+async def create_user_archive(
+    user_id: int,
+    archive_filter: ArchiveFilter | None = None,
+) -> UserArchive | None:
+    """
+    Создаёт zip-архив с файлами пользователя.
+
+    Файлы отбираются по фильтру одним запросом к индексу. Если архив с таким же
+    набором файлов собран заранее, он берётся из кэша.
+
+    Args:
+        user_id: ID пользователя
+        archive_filter: Условия отбора файлов (None - все файлы)
+
+    Returns:
+        Созданный архив или None, если файлов нет или произошла ошибка
+    """
+    archive_filter = archive_filter or ArchiveFilter()
+    description = archive_filter.describe() or "все файлы"
     try:
-        # Создаём временный файл для архива
-        temp_archive = tempfile.NamedTemporaryFile(
-            delete=False, suffix=".zip", prefix=f"user_{user_id}_{target_date}_"
-        )
-        archive_path = temp_archive.name
-        temp_archive.close()
+        user_files = await _select_files(user_id, archive_filter)
 
-        # Создаём zip-архив
-        with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            for file_path in files_for_date:
-                # Добавляем файл в архив с относительным путём
-                arcname = file_path.relative_to(user_dir)
-                zip_file.write(file_path, arcname)
+        if not user_files:
+            logger.debug("У пользователя {} нет файлов ({})", user_id, description)
+            return None
+
+        keys = [obj.key for obj in user_files]
+        if cached := await archive_cache.lookup(user_id, user_files):
+            logger.info(
+                "Архив ({}) для пользователя {} взят из кэша: {}",
+                description,
+                user_id,
+                cached,
+            )
+            return UserArchive(path=str(cached), keys=keys, cached=True)
+
+        archive_path = await _build_archive(
+            user_dir=await resolve_user_dir(user_id),
+            objects=user_files,
+            prefix=f"user_{user_id}{archive_filter.filename_suffix()}_",
+        )
 
         logger.info(
-            f"Создан архив {archive_path} с {len(files_for_date)} файлами за {target_date} для пользователя {user_id}"
+            "Создан архив {} с {} файлами ({}) для пользователя {}",
+            archive_path,
+            len(user_files),
+            description,
+            user_id,
         )
-        return archive_path
+        return UserArchive(path=archive_path, keys=keys)
 
     except Exception as e:
         logger.error(
-            f"Ошибка при создании архива за {target_date} для пользователя {user_id}: {e}"
+            "Ошибка при создании архива ({}) для пользователя {}: {}",
+            description,
+            user_id,
+            e,
         )
         return None
 
 
-def get_user_files_stats(
+async def prebuild_user_archive(
+    user_id: int,
+    archive_filter: ArchiveFilter,
+    *,
+    executor: Executor | None = None,
+) -> bool:
+    """
+    Заранее собирает архив пользователя в кэш.
+
+    Вызывается под `user_lock(user_id)`, как и остальные операции с файлами
+    пользователя: отбор файлов, сборка и запись в кэш не должны пересекаться с
+    /clear, очисткой и уплотнением пакетов.
+
+    Args:
+        user_id: ID пользователя
+        archive_filter: Условия отбора файлов
+        executor: Пул потоков для сжатия
+
+    Returns:
+        True, если архив собран; False, если файлов нет или архив уже в кэше
+    """
+    user_files = await _select_files(user_id, archive_filter)
+    if not user_files:
+        return False
+    path = archive_cache.cache_path(user_id, user_files)
+    if await asyncio.to_thread(path.is_file):
+        return False
+
+    directory = archive_cache.cache_dir()
+    await asyncio.to_thread(directory.mkdir, parents=True, exist_ok=True)
+    archive_path = await _build_archive(
+        user_dir=await resolve_user_dir(user_id),
+        objects=user_files,
+        prefix=".tmp_",
+        directory=directory,
+        executor=executor,
+    )
+    await archive_cache.store(archive_path, path)
+    logger.debug(
+        "Заранее собран архив ({}) пользователя {}", archive_filter.describe(), user_id
+    )
+    return True
+
+
+async def mark_archive_sent(archive: UserArchive) -> None:
+    """
+    Отмечает файлы архива как отправленные пользователю.
+
+    При RETENTION_DELETE_AFTER_ARCHIVE такие файлы удаляются при очистке.
+
+    Args:
+        archive: Отправленный архив
+    """
+    try:
+        await file_index.mark_archived(archive.keys)
+    except Exception as e:
+        logger.error("Ошибка при отметке файлов архива {}: {}", archive.path, e)
+
+
+async def get_user_files_stats(
     *,
     user_id: int,
 ) -> dict:
@@ -513,23 +967,12 @@ def get_user_files_stats(
     Returns:
         Словарь со статистикой файлов
     """
-    user_dir = Path(settings.FILES_DIR) / str(user_id)
-
-    if not user_dir.exists():
-        logger.debug(f"Директория пользователя {user_id} не существует")
-        return {
-            "total_files": 0,
-            "total_size": 0,
-            "files_by_date": {},
-        }
-
     try:
         # Находим все файлы пользователя
-        user_files = list(user_dir.rglob("*"))
-        user_files = [f for f in user_files if f.is_file()]
+        user_files = await file_index.list_user_files(user_id)
 
         if not user_files:
-            logger.debug(f"У пользователя {user_id} нет сохранённых файлов")
+            logger.debug("У пользователя {} нет сохранённых файлов", user_id)
             return {
                 "total_files": 0,
                 "total_size": 0,
@@ -537,27 +980,19 @@ def get_user_files_stats(
             }
 
         total_size = 0
-        files_by_date = {}
-
-        for file_path in user_files:
-            try:
-                # Получаем размер файла
-                file_size = file_path.stat().st_size
-                total_size += file_size
+        files_by_date: dict[str, dict[str, int]] = {}
 
-                # Получаем дату создания файла
-                file_ctime = datetime.fromtimestamp(file_path.stat().st_ctime)
-                date_key = file_ctime.strftime("%Y-%m-%d")
+        for obj in user_files:
+            total_size += obj.size
 
-                if date_key not in files_by_date:
-                    files_by_date[date_key] = {"count": 0, "size": 0}
+            # Группируем по дате создания файла
+            date_key = obj.created_at.strftime("%Y-%m-%d")
 
-                files_by_date[date_key]["count"] += 1
-                files_by_date[date_key]["size"] += file_size
+            if date_key not in files_by_date:
+                files_by_date[date_key] = {"count": 0, "size": 0}
 
-            except Exception as e:
-                logger.error(f"Ошибка при обработке файла {file_path}: {e}")
-                continue
+            files_by_date[date_key]["count"] += 1
+            files_by_date[date_key]["size"] += obj.size
 
         # Сортируем даты по убыванию
         files_by_date = dict(sorted(files_by_date.items(), reverse=True))
@@ -568,11 +1003,13 @@ def get_user_files_stats(
             "files_by_date": files_by_date,
         }
 
-        logger.debug(f"Получена статистика для пользователя {user_id}: {stats}")
+        logger.debug("Получена статистика для пользователя {}: {}", user_id, stats)
         return stats
 
     except Exception as e:
-        logger.error(f"Ошибка при получении статистики для пользователя {user_id}: {e}")
+        logger.error(
+            "Ошибка при получении статистики для пользователя {}: {}", user_id, e
+        )
         return {
             "total_files": 0,
             "total_size": 0,
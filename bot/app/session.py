@@ -0,0 +1,129 @@
+import asyncio
+from collections.abc import AsyncIterator
+from typing import Any
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import ClientError, ClientPayloadError, ClientResponseError, ClientTimeout
+from config import settings
+from loguru import logger
+
+
+class TunedAiohttpSession(AiohttpSession):
+    """
+    Сессия aiohttp с настройками пула соединений из Settings.
+
+    Одна сессия используется и для запросов к Bot API, и для скачивания файлов,
+    поэтому соединения с серверами Telegram переиспользуются.
+    """
+
+    def __init__(self, **kwargs: Any) -> None:
+        if settings.TELEGRAM_API_URL and "api" not in kwargs:
+            kwargs["api"] = TelegramAPIServer.from_base(settings.TELEGRAM_API_URL)
+        super().__init__(
+            proxy=settings.HTTP_PROXY,
+            limit=settings.HTTP_POOL_SIZE,
+            timeout=settings.HTTP_TIMEOUT,
+            **kwargs,
+        )
+        self._connector_init.update(
+            limit=settings.HTTP_POOL_SIZE,
+            limit_per_host=settings.HTTP_POOL_PER_HOST,
+            keepalive_timeout=settings.HTTP_KEEPALIVE_TIMEOUT,
+        )
+
+
+def _download_timeout(file_size: int | None) -> ClientTimeout:
+    """Общий таймаут скачивания растёт с размером файла."""
+    total = None
+    if file_size:
+        total = settings.DOWNLOAD_TIMEOUT + file_size / settings.DOWNLOAD_MIN_SPEED
+    return ClientTimeout(
+        total=total,
+        sock_connect=settings.HTTP_TIMEOUT,
+        sock_read=settings.DOWNLOAD_TIMEOUT,
+    )
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, ClientResponseError):
+        # Ошибки клиента (кроме 429) повтором не исправить
+        return error.status >= 500 or error.status == 429
+    return isinstance(error, ClientError | asyncio.TimeoutError)
+
+
+async def download_stream(
+    *,
+    bot: Bot,
+    telegram_path: str,
+    file_size: int | None = None,
+) -> AsyncIterator[bytes]:
+    """
+    Скачивает файл с серверов Telegram потоком блоков.
+
+    При сетевой ошибке повторяет запрос с экспоненциальной задержкой и докачивает
+    файл с места обрыва через заголовок Range.
+
+    Args:
+        bot: Экземпляр бота
+        telegram_path: Путь к файлу на серверах Telegram
+        file_size: Размер файла, если известен (для таймаута и проверки полноты)
+
+    Returns:
+        Асинхронный итератор блоков содержимого
+    """
+    if not isinstance(bot.session, AiohttpSession):
+        raise RuntimeError("Скачивание файлов поддерживается только для AiohttpSession")
+
+    url = bot.session.api.file_url(bot.token, telegram_path)
+    timeout = _download_timeout(file_size)
+    received = 0
+    attempt = 0
+
+    while True:
+        session = await bot.session.create_session()
+        headers = {"Range": f"bytes={received}-"} if received else {}
+        try:
+            async with session.get(
+                url, headers=headers, timeout=timeout, raise_for_status=True
+            ) as resp:
+                # Если сервер проигнорировал Range, пропускаем уже полученное
+                skip = received if received and resp.status != 206 else 0
+                async for chunk in resp.content.iter_chunked(
+                    settings.DOWNLOAD_CHUNK_SIZE
+                ):
+                    if skip:
+                        if len(chunk) <= skip:
+                            skip -= len(chunk)
+                            continue
+                        chunk = chunk[skip:]
+                        skip = 0
+                    received += len(chunk)
+                    yield chunk
+
+            if file_size is not None and received < file_size:
+                raise ClientPayloadError(
+                    f"Получено {received} из {file_size} байт файла {telegram_path}"
+                )
+            return
+
+        except Exception as e:
+            attempt += 1
+            if not _is_retryable(e) or attempt > settings.DOWNLOAD_MAX_RETRIES:
+                raise
+
+            delay = min(
+                settings.DOWNLOAD_RETRY_DELAY * 2 ** (attempt - 1),
+                settings.DOWNLOAD_RETRY_MAX_DELAY,
+            )
+            logger.warning(
+                "Ошибка при скачивании {} ({} байт получено): "
+                "{!r}, повтор через {:.1f} с (попытка {})",
+                telegram_path,
+                received,
+                e,
+                delay,
+                attempt,
+            )
+            await asyncio.sleep(delay)
@@ -0,0 +1,591 @@
+import asyncio
+import hashlib
+import shutil
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from collections.abc import AsyncIterator
+from contextlib import AsyncExitStack
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, BinaryIO
+
+from config import settings
+from fileio import open_creating_dirs, run_io
+from loguru import logger
+
+
+@dataclass(frozen=True)
+class StoredObject:
+    """
+    Файл в хранилище.
+
+    Небольшие файлы могут храниться внутри пакета (см. `packs.py`): тогда `pack` -
+    ключ пакета, а `pack_offset` - смещение содержимого в нём. `sha256` -
+    контрольная сумма, вычисленная при скачивании (известна только индексу).
+    """
+
+    key: str
+    size: int
+    created_at: datetime
+    pack: str | None = None
+    pack_offset: int = 0
+    sha256: str | None = None
+
+
+class StorageBackend(ABC):
+    """
+    Интерфейс хранилища файлов пользователей.
+
+    Ключи имеют вид `<директория пользователя>/<имя файла>` и не зависят от
+    конкретного бэкенда; директорию пользователя вычисляет `resolve_user_dir`.
+    """
+
+    @abstractmethod
+    async def put_stream(
+        self,
+        key: str,
+        chunks: AsyncIterator[bytes],
+        *,
+        digest: "hashlib._Hash | None" = None,
+    ) -> int:
+        """
+        Сохраняет файл, читая содержимое из асинхронного потока блоков.
+
+        Args:
+            key: Ключ файла
+            chunks: Поток блоков содержимого
+            digest: Хеш, который нужно обновить содержимым файла по ходу записи
+
+        Returns:
+            Количество записанных байт
+        """
+
+    @abstractmethod
+    async def list_objects(self, prefix: str) -> list[StoredObject]:
+        """
+        Возвращает все файлы, ключи которых начинаются с `prefix/`.
+
+        Args:
+            prefix: Префикс ключей (например, директория пользователя);
+                пустая строка - все файлы хранилища
+
+        Returns:
+            Список файлов
+        """
+
+    @abstractmethod
+    async def stat(self, key: str) -> StoredObject | None:
+        """
+        Возвращает сведения о файле.
+
+        Args:
+            key: Ключ файла
+
+        Returns:
+            Сведения о файле или None, если файла нет
+        """
+
+    @abstractmethod
+    async def has_prefix(self, prefix: str) -> bool:
+        """
+        Проверяет, есть ли файлы с ключами, начинающимися с `prefix/`.
+
+        Args:
+            prefix: Префикс ключей
+
+        Returns:
+            True, если есть хотя бы один файл
+        """
+
+    @abstractmethod
+    def open_stream(self, key: str, chunk_size: int) -> AsyncIterator[bytes]:
+        """
+        Открывает файл на чтение в виде асинхронного потока блоков.
+
+        Args:
+            key: Ключ файла
+            chunk_size: Размер блока в байтах
+
+        Returns:
+            Асинхронный итератор блоков содержимого
+        """
+
+    @abstractmethod
+    async def delete(self, keys: list[str]) -> None:
+        """
+        Удаляет файлы по ключам; отсутствующие файлы пропускаются.
+
+        Args:
+            keys: Ключи файлов
+        """
+
+    @abstractmethod
+    async def delete_prefix(self, prefix: str) -> int:
+        """
+        Удаляет все файлы, ключи которых начинаются с `prefix/`.
+
+        Args:
+            prefix: Префикс ключей
+
+        Returns:
+            Количество удалённых файлов
+        """
+
+    async def disk_usage(self) -> tuple[int, int] | None:
+        """
+        Возвращает объём и свободное место на диске хранилища.
+
+        Returns:
+            Кортеж (всего байт, свободно байт) или None, если для бэкенда неприменимо
+        """
+        return None
+
+    async def close(self) -> None:
+        """Освобождает ресурсы бэкенда."""
+        return None
+
+
+# MARK: Local
+class LocalStorage(StorageBackend):
+    """Хранилище в локальной директории: ключ соответствует пути относительно корня."""
+
+    # Суффикс недокачанных файлов. Они, как и всё, что начинается с точки
+    # (например, директория пакетов), не видны в листинге
+    PARTIAL_SUFFIX = ".part"
+
+    def __init__(self, root: str | Path) -> None:
+        self.root = Path(root)
+
+    def _path(self, key: str) -> Path:
+        return self.root / key
+
+    def _is_hidden(self, path: Path) -> bool:
+        return any(part.startswith(".") for part in path.relative_to(self.root).parts)
+
+    @staticmethod
+    def _discard_sync(file: BinaryIO, partial_path: Path) -> None:
+        file.close()
+        partial_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def _write_sync(
+        file: BinaryIO, chunk: bytes, digest: "hashlib._Hash | None"
+    ) -> None:
+        # Хеширование и запись блока - одно обращение к пулу
+        if digest is not None:
+            digest.update(chunk)
+        file.write(chunk)
+
+    @staticmethod
+    def _commit_sync(file: BinaryIO, partial_path: Path, path: Path) -> None:
+        file.close()
+        # Файл появляется под своим именем только после полной загрузки
+        partial_path.replace(path)
+
+    async def put_stream(
+        self,
+        key: str,
+        chunks: AsyncIterator[bytes],
+        *,
+        digest: "hashlib._Hash | None" = None,
+    ) -> int:
+        path = self._path(key)
+        partial_path = path.with_name(f".{path.name}{self.PARTIAL_SUFFIX}")
+
+        file = await run_io(open_creating_dirs, partial_path, "wb")
+        size = 0
+        # Блок записывается в пуле, пока из сети читается следующий
+        pending: asyncio.Future[None] | None = None
+        try:
+            async for chunk in chunks:
+                if pending is not None:
+                    await pending
+                pending = run_io(self._write_sync, file, chunk, digest)
+                size += len(chunk)
+            if pending is not None:
+                await pending
+        except BaseException:
+            if pending is not None:
+                await asyncio.wait([pending])
+            await run_io(self._discard_sync, file, partial_path)
+            raise
+
+        await run_io(self._commit_sync, file, partial_path, path)
+        return size
+
+    def _list_sync(self, prefix: str) -> list[StoredObject]:
+        base = self._path(prefix)
+        if not base.is_dir():
+            return []
+
+        objects = []
+        for path in base.rglob("*"):
+            if self._is_hidden(path):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if not path.is_file():
+                continue
+            objects.append(
+                StoredObject(
+                    key=path.relative_to(self.root).as_posix(),
+                    size=stat.st_size,
+                    created_at=datetime.fromtimestamp(stat.st_ctime),
+                )
+            )
+        return objects
+
+    async def list_objects(self, prefix: str) -> list[StoredObject]:
+        return await asyncio.to_thread(self._list_sync, prefix)
+
+    def _stat_sync(self, key: str) -> StoredObject | None:
+        path = self._path(key)
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+        return StoredObject(
+            key=key,
+            size=stat.st_size,
+            created_at=datetime.fromtimestamp(stat.st_ctime),
+        )
+
+    async def stat(self, key: str) -> StoredObject | None:
+        return await asyncio.to_thread(self._stat_sync, key)
+
+    async def has_prefix(self, prefix: str) -> bool:
+        return await asyncio.to_thread(self._path(prefix).is_dir)
+
+    async def open_stream(self, key: str, chunk_size: int) -> AsyncIterator[bytes]:
+        file = await asyncio.to_thread(open, self._path(key), "rb")
+        try:
+            while chunk := await asyncio.to_thread(file.read, chunk_size):
+                yield chunk
+        finally:
+            await asyncio.to_thread(file.close)
+
+    def _delete_sync(self, keys: list[str]) -> None:
+        for key in keys:
+            self._path(key).unlink(missing_ok=True)
+
+    async def delete(self, keys: list[str]) -> None:
+        await asyncio.to_thread(self._delete_sync, keys)
+
+    async def disk_usage(self) -> tuple[int, int] | None:
+        usage = await asyncio.to_thread(shutil.disk_usage, self.root)
+        return usage.total, usage.free
+
+    def _delete_prefix_sync(self, prefix: str) -> int:
+        base = self._path(prefix)
+        if not base.exists():
+            return 0
+
+        files_count = sum(
+            1
+            for path in base.rglob("*")
+            if path.is_file() and not self._is_hidden(path)
+        )
+        shutil.rmtree(base)
+        return files_count
+
+    async def delete_prefix(self, prefix: str) -> int:
+        return await asyncio.to_thread(self._delete_prefix_sync, prefix)
+
+
+# MARK: S3
+class S3Storage(StorageBackend):
+    """
+    Хранилище в S3-совместимом бакете (AWS S3, MinIO, moto).
+
+    Файлы больше `part_size` загружаются по частям (multipart upload) по мере
+    скачивания, поэтому целиком в памяти не держатся.
+    """
+
+    # Максимальное число ключей в одном запросе DeleteObjects
+    DELETE_BATCH_SIZE = 1000
+
+    def __init__(
+        self,
+        *,
+        bucket: str,
+        endpoint_url: str | None = None,
+        region: str | None = None,
+        access_key_id: str | None = None,
+        secret_access_key: str | None = None,
+        part_size: int = 8 * 1024 * 1024,
+    ) -> None:
+        try:
+            from aiobotocore.session import get_session
+        except ImportError as e:  # pragma: no cover
+            raise RuntimeError(
+                "Для STORAGE_BACKEND=s3 установите зависимость: uv sync --extra s3"
+            ) from e
+
+        self.bucket = bucket
+        self.part_size = part_size
+        self._session = get_session()
+        self._client_kwargs = {
+            "endpoint_url": endpoint_url,
+            "region_name": region,
+            "aws_access_key_id": access_key_id,
+            "aws_secret_access_key": secret_access_key,
+        }
+        self._exit_stack: AsyncExitStack | None = None
+        self._client: Any = None
+        self._client_lock = asyncio.Lock()
+
+    async def _get_client(self) -> Any:
+        # Клиент создаётся один раз и переиспользует пул соединений
+        async with self._client_lock:
+            if self._client is None:
+                self._exit_stack = AsyncExitStack()
+                self._client = await self._exit_stack.enter_async_context(
+                    self._session.create_client("s3", **self._client_kwargs)
+                )
+            return self._client
+
+    async def close(self) -> None:
+        if self._exit_stack is not None:
+            await self._exit_stack.aclose()
+            self._exit_stack = None
+            self._client = None
+
+    async def put_stream(
+        self,
+        key: str,
+        chunks: AsyncIterator[bytes],
+        *,
+        digest: "hashlib._Hash | None" = None,
+    ) -> int:
+        client = await self._get_client()
+        buffer = bytearray()
+        size = 0
+        upload_id: str | None = None
+        parts: list[dict[str, Any]] = []
+
+        async def hash_data(data: bytes) -> None:
+            # Хешируем целыми частями, вне цикла событий
+            if digest is not None:
+                await asyncio.to_thread(digest.update, data)
+
+        async def upload_part(data: bytes) -> None:
+            nonlocal upload_id
+            await hash_data(data)
+            if upload_id is None:
+                response = await client.create_multipart_upload(
+                    Bucket=self.bucket, Key=key
+                )
+                upload_id = response["UploadId"]
+            part_number = len(parts) + 1
+            response = await client.upload_part(
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=data,
+            )
+            parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+        try:
+            async for chunk in chunks:
+                buffer.extend(chunk)
+                size += len(chunk)
+                while len(buffer) >= self.part_size:
+                    await upload_part(bytes(buffer[: self.part_size]))
+                    del buffer[: self.part_size]
+
+            if upload_id is None:
+                # Небольшой файл: хватает одного PutObject
+                await hash_data(bytes(buffer))
+                await client.put_object(Bucket=self.bucket, Key=key, Body=bytes(buffer))
+                return size
+
+            if buffer:
+                await upload_part(bytes(buffer))
+            await client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+            return size
+
+        except BaseException:
+            if upload_id is not None:
+                try:
+                    await client.abort_multipart_upload(
+                        Bucket=self.bucket, Key=key, UploadId=upload_id
+                    )
+                except Exception as e:
+                    logger.error("Ошибка при отмене multipart-загрузки {}: {}", key, e)
+            raise
+
+    async def list_objects(self, prefix: str) -> list[StoredObject]:
+        client = await self._get_client()
+        paginator = client.get_paginator("list_objects_v2")
+
+        objects = []
+        async for page in paginator.paginate(
+            Bucket=self.bucket, Prefix=f"{prefix}/" if prefix else ""
+        ):
+            for item in page.get("Contents", []):
+                objects.append(
+                    StoredObject(
+                        key=item["Key"],
+                        size=item["Size"],
+                        created_at=item["LastModified"]
+                        .astimezone()
+                        .replace(tzinfo=None),
+                    )
+                )
+        return objects
+
+    async def stat(self, key: str) -> StoredObject | None:
+        from botocore.exceptions import ClientError
+
+        client = await self._get_client()
+        try:
+            response = await client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                return None
+            raise
+        return StoredObject(
+            key=key,
+            size=response["ContentLength"],
+            created_at=response["LastModified"].astimezone().replace(tzinfo=None),
+        )
+
+    async def has_prefix(self, prefix: str) -> bool:
+        client = await self._get_client()
+        response = await client.list_objects_v2(
+            Bucket=self.bucket, Prefix=f"{prefix}/", MaxKeys=1
+        )
+        return bool(response.get("KeyCount"))
+
+    async def open_stream(self, key: str, chunk_size: int) -> AsyncIterator[bytes]:
+        from botocore.exceptions import ClientError
+
+        client = await self._get_client()
+        try:
+            response = await client.get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            # Как и локальное хранилище, сообщаем об отсутствии файла через
+            # FileNotFoundError
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                raise FileNotFoundError(key) from e
+            raise
+        async with response["Body"] as body:
+            while chunk := await body.read(chunk_size):
+                yield chunk
+
+    async def delete(self, keys: list[str]) -> None:
+        client = await self._get_client()
+        for start in range(0, len(keys), self.DELETE_BATCH_SIZE):
+            batch = keys[start : start + self.DELETE_BATCH_SIZE]
+            await client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+            )
+
+    async def delete_prefix(self, prefix: str) -> int:
+        keys = [obj.key for obj in await self.list_objects(prefix)]
+        await self.delete(keys)
+        return len(keys)
+
+
+def create_storage() -> StorageBackend:
+    """
+    Создаёт бэкенд хранилища по настройкам.
+
+    Returns:
+        Экземпляр бэкенда, выбранного в STORAGE_BACKEND
+    """
+    if settings.STORAGE_BACKEND == "s3":
+        if not settings.S3_BUCKET:
+            raise RuntimeError("Для STORAGE_BACKEND=s3 необходимо задать S3_BUCKET")
+        return S3Storage(
+            bucket=settings.S3_BUCKET,
+            endpoint_url=settings.S3_ENDPOINT_URL,
+            region=settings.S3_REGION,
+            access_key_id=settings.S3_ACCESS_KEY_ID,
+            secret_access_key=settings.S3_SECRET_ACCESS_KEY,
+            part_size=settings.S3_MULTIPART_CHUNK_SIZE,
+        )
+    return LocalStorage(settings.FILES_DIR)
+
+
+storage = create_storage()
+
+
+# MARK: Layout
+def flat_user_dir(user_id: int) -> str:
+    """Директория пользователя в плоской раскладке: `<user_id>`."""
+    return str(user_id)
+
+
+def sharded_user_dir(user_id: int) -> str:
+    """Директория пользователя в шардированной раскладке: `ab/cd/<user_id>`."""
+    digest = hashlib.sha256(str(user_id).encode()).hexdigest()
+    return f"{digest[:2]}/{digest[2:4]}/{user_id}"
+
+
+def candidate_user_dirs(user_id: int) -> list[str]:
+    """
+    Возвращает возможные директории пользователя, начиная с основной.
+
+    В шардированной раскладке к основной директории добавляется плоская: пока
+    идёт миграция, часть пользователей ещё хранится по-старому.
+
+    Args:
+        user_id: ID пользователя
+
+    Returns:
+        Список префиксов ключей
+    """
+    if settings.FILES_LAYOUT == "sharded":
+        return [sharded_user_dir(user_id), flat_user_dir(user_id)]
+    return [flat_user_dir(user_id)]
+
+
+# Пользователи, чьи файлы уже лежат в основной директории: повторно не проверяем.
+# Кэш ограничен (вытесняются давно не обращавшиеся пользователи), чтобы не расти
+# с числом пользователей; после вытеснения директория проверяется заново
+RESOLVED_USER_DIRS_MAX = 10_000
+_resolved_user_dirs: OrderedDict[int, None] = OrderedDict()
+
+
+async def resolve_user_dir(user_id: int) -> str:
+    """
+    Определяет директорию пользователя в хранилище.
+
+    Все операции с файлами пользователя должны получать префикс ключей отсюда.
+
+    Args:
+        user_id: ID пользователя
+
+    Returns:
+        Префикс ключей файлов пользователя
+    """
+    primary, *legacy = candidate_user_dirs(user_id)
+    if not legacy:
+        return primary
+    if user_id in _resolved_user_dirs:
+        _resolved_user_dirs.move_to_end(user_id)
+        return primary
+
+    if await storage.has_prefix(primary):
+        _resolved_user_dirs[user_id] = None
+        if len(_resolved_user_dirs) > RESOLVED_USER_DIRS_MAX:
+            _resolved_user_dirs.popitem(last=False)
+        return primary
+
+    # Пользователь ещё не перенесён в новую раскладку
+    for user_dir in legacy:
+        if await storage.has_prefix(user_dir):
+            return user_dir
+
+    return primary
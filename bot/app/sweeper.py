@@ -0,0 +1,180 @@
+import asyncio
+import time
+from collections import defaultdict
+
+import archive_cache
+from config import settings
+from index import file_index
+from locks import user_lock
+from loguru import logger
+from metrics import counter
+from packs import compact_packs
+from storage import storage
+
+reclaimed_bytes = counter(
+    "archiver_sweeper_reclaimed_bytes_total",
+    "Объём файлов, удалённых очисткой, байт",
+)
+deleted_files = counter(
+    "archiver_sweeper_deleted_files_total",
+    "Количество файлов, удалённых очисткой",
+)
+
+
+async def _delete_batch(
+    rows: list[tuple[str, int, int, str | None]], reason: str
+) -> int:
+    """
+    Удаляет пачку файлов под блокировками их владельцев.
+
+    Returns:
+        Освобождённый объём. Место файлов из пакетов освобождается только при
+        уплотнении (см. `_compact`), поэтому здесь не учитывается
+    """
+    by_user: dict[int, list[tuple[str, int, str | None]]] = defaultdict(list)
+    for key, user_id, size, pack in rows:
+        by_user[user_id].append((key, size, pack))
+
+    freed = 0
+    for user_id, files in by_user.items():
+        keys = [key for key, _size, _pack in files]
+        async with user_lock(user_id):
+            await storage.delete(keys)
+            await file_index.remove_files(keys)
+
+        size = sum(size for _key, size, pack in files if pack is None)
+        freed += size
+        reclaimed_bytes.inc(size, reason=reason)
+        deleted_files.inc(len(keys), reason=reason)
+
+    logger.debug("Очистка ({}): удалено {} файлов, {} байт", reason, len(rows), freed)
+    # Ограничиваем темп удаления, чтобы не нагружать диск
+    await asyncio.sleep(settings.SWEEP_BATCH_DELAY)
+    return freed
+
+
+async def _compact(reason: str) -> int:
+    """Уплотняет пакеты и возвращает действительно освобождённый объём."""
+    freed: int = await compact_packs()
+    reclaimed_bytes.inc(freed, reason=reason)
+    return freed
+
+
+async def _sweep_archived() -> int:
+    freed = 0
+    while rows := await file_index.select_for_eviction(
+        limit=settings.SWEEP_BATCH_SIZE, archived=True
+    ):
+        freed += await _delete_batch(rows, "archived")
+    return freed
+
+
+async def _sweep_expired(max_age_days: int) -> int:
+    created_before = time.time() - max_age_days * 24 * 60 * 60
+    freed = 0
+    while rows := await file_index.select_for_eviction(
+        limit=settings.SWEEP_BATCH_SIZE, created_before=created_before
+    ):
+        freed += await _delete_batch(rows, "age")
+    return freed
+
+
+async def _sweep_user_quotas(max_bytes: int) -> int:
+    freed = 0
+    for user_id, total_size in await file_index.users_over_quota(max_bytes):
+        # Удаляем самые старые файлы, пока пользователь не уложится в квоту
+        excess = total_size - max_bytes
+        while excess > 0:
+            rows = await file_index.select_for_eviction(
+                limit=settings.SWEEP_BATCH_SIZE, user_id=user_id
+            )
+            if not rows:
+                break
+
+            batch = []
+            for row in rows:
+                batch.append(row)
+                excess -= row[2]
+                if excess <= 0:
+                    break
+            freed += await _delete_batch(batch, "quota")
+    return freed
+
+
+async def _sweep_disk_pressure(low: float, high: float) -> int:
+    usage = await storage.disk_usage()
+    if usage is None:
+        return 0
+
+    total, free = usage
+    if free / total >= low:
+        return 0
+
+    # Место на исходе: сначала удаляем архивы из кэша - их можно собрать заново
+    target = high * total
+    cache_freed: int = await archive_cache.trim(int(target - free))
+    reclaimed_bytes.inc(cache_freed, reason="archive_cache")
+    if cache_freed:
+        # Кэш может лежать на другом диске (ARCHIVE_CACHE_DIR): перемеряем
+        usage = await storage.disk_usage()
+        if usage is None:
+            return cache_freed
+        total, free = usage
+        if free >= target:
+            return cache_freed
+
+    # Затем самые старые файлы всех пользователей, пока свободное место не
+    # вырастет до верхней границы
+    logger.warning(
+        "Свободно {:.1%} диска, удаляем старые файлы до {:.0%}", free / total, high
+    )
+    freed = 0
+    while free + freed < target:
+        rows = await file_index.select_for_eviction(limit=settings.SWEEP_BATCH_SIZE)
+        if not rows:
+            break
+        freed += await _delete_batch(rows, "disk")
+        if any(pack for _key, _user_id, _size, pack in rows):
+            # Без уплотнения удаление файлов из пакетов не освобождает место
+            freed += await _compact("disk")
+    return cache_freed + freed
+
+
+async def sweep() -> int:
+    """
+    Выполняет один проход очистки по правилам хранения.
+
+    Кандидаты выбираются из индекса файлов, без обхода хранилища.
+
+    Returns:
+        Освобождённый объём в байтах
+    """
+    freed = 0
+    # Устаревшие архивы из кэша удаляются и без ночной сборки архивов
+    await archive_cache.purge_expired()
+    if settings.RETENTION_DELETE_AFTER_ARCHIVE:
+        freed += await _sweep_archived()
+    if settings.RETENTION_MAX_AGE_DAYS:
+        freed += await _sweep_expired(settings.RETENTION_MAX_AGE_DAYS)
+    if settings.RETENTION_MAX_USER_BYTES:
+        freed += await _sweep_user_quotas(settings.RETENTION_MAX_USER_BYTES)
+    if settings.DISK_FREE_LOW_WATERMARK:
+        freed += await _sweep_disk_pressure(
+            settings.DISK_FREE_LOW_WATERMARK, settings.DISK_FREE_HIGH_WATERMARK
+        )
+    # Место удалённых из пакетов файлов освобождается только при уплотнении
+    freed += await _compact("compaction")
+    return freed
+
+
+async def run_sweeper() -> None:
+    """Фоновая задача: периодически запускает очистку."""
+    logger.info("Очистка файлов запускается каждые {} с", settings.SWEEP_INTERVAL)
+    while True:
+        try:
+            freed = await sweep()
+            if freed:
+                logger.info("Очистка освободила {} байт", freed)
+        except Exception as e:
+            logger.error("Ошибка при очистке файлов: {}", e)
+        await asyncio.sleep(settings.SWEEP_INTERVAL)
@@ -0,0 +1,347 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import suppress
+from typing import Any, cast
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    EditMessageCaption,
+    EditMessageText,
+    Response,
+    SendAudio,
+    SendDocument,
+    SendMediaGroup,
+    SendVideo,
+    TelegramMethod,
+)
+from aiogram.methods.base import TelegramType
+from config import settings
+from locks import redis
+from loguru import logger
+
+# Приоритеты запросов: меньшее значение обслуживается раньше
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 1
+
+# Загрузки крупных файлов уступают очередь коротким ответам
+LOW_PRIORITY_METHODS = (SendDocument, SendVideo, SendAudio, SendMediaGroup)
+
+# Изменения одного и того же сообщения, которые можно схлопнуть
+COALESCED_METHODS = (EditMessageText, EditMessageCaption)
+
+
+class TokenBucket:
+    """
+    Ведро токенов с очередью ожидания по приоритету.
+
+    Токены пополняются со скоростью `rate` в секунду до `capacity`. Если токена
+    нет, запрос встаёт в очередь; из очереди первым выходит запрос с меньшим
+    приоритетом, при равных приоритетах - пришедший раньше.
+    """
+
+    def __init__(self, *, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiters: list[tuple[int, int, asyncio.Future[None]]] = []
+        self._counter = itertools.count()
+        self._dispatcher: asyncio.Task | None = None
+        self._wakeup = asyncio.Event()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    @property
+    def idle(self) -> bool:
+        """Ведро полно и никто не ждёт: его можно удалить без потери состояния."""
+        self._refill()
+        return (
+            not self._waiters
+            and self._tokens >= self.capacity
+            and self._blocked_until <= time.monotonic()
+        )
+
+    def _try_take(self) -> bool:
+        self._refill()
+        if self._blocked_until > time.monotonic() or self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    async def _take(self) -> float:
+        """Берёт токен: возвращает 0 или сколько ждать до следующей попытки."""
+        if self._try_take():
+            return 0.0
+        return max(
+            self._blocked_until - time.monotonic(),
+            (1 - self._tokens) / self.rate,
+        )
+
+    async def acquire(self, priority: int = PRIORITY_HIGH) -> None:
+        """Ждёт свободный токен."""
+        if not self._waiters and not await self._take():
+            return
+
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    def release(self) -> None:
+        """Возвращает неиспользованный токен."""
+        self._refill()
+        self._tokens = min(self.capacity, self._tokens + 1)
+        self._wakeup.set()
+
+    def block(self, seconds: float) -> None:
+        """Приостанавливает выдачу токенов, например по ответу `retry_after`."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    def _grant(self) -> None:
+        # Токен получает первый в очереди неотменённый запрос
+        while self._waiters:
+            _priority, _order, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.release()
+
+    async def _dispatch(self) -> None:
+        while self._waiters:
+            _priority, _order, future = self._waiters[0]
+            if future.done():
+                # Ожидающий запрос отменён
+                heapq.heappop(self._waiters)
+                continue
+
+            delay = await self._take()
+            if not delay:
+                # Пока брали токен, очередь могла измениться
+                self._grant()
+                continue
+
+            # Ждём пополнения токенов или их досрочного возврата
+            self._wakeup.clear()
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+
+
+# Ведро токенов в Redis: пополнение считается по часам Redis, общим для реплик.
+# Возвращает 0 или время до появления токена (строкой: числа Lua в ответе
+# Redis округлялись бы до целых)
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(state[1]) or capacity
+local updated_at = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Ведро токенов в Redis, общее для всех реплик бота.
+
+    Токены берутся атомарным Lua-скриптом, поэтому лимит действует на все
+    реплики вместе; очередь по приоритету у каждой реплики своя. Если Redis
+    недоступен, токены выдаются по локальному ведру с той же скоростью, то есть
+    лимит временно действует на каждую реплику отдельно.
+
+    Args:
+        name: Имя ведра в Redis
+    """
+
+    def __init__(self, name: str, *, rate: float, capacity: float) -> None:
+        super().__init__(rate=rate, capacity=capacity)
+        self._key = f"archiver:throttle:{name}"
+        self._script = redis.register_script(TAKE_SCRIPT)
+
+    async def _take(self) -> float:
+        if self._blocked_until > time.monotonic():
+            return self._blocked_until - time.monotonic()
+        try:
+            wait = await self._script(keys=[self._key], args=[self.rate, self.capacity])
+        except Exception as e:
+            logger.error("Не удалось взять токен {} из Redis: {}", self._key, e)
+            return await super()._take()
+        return float(wait)
+
+    def release(self) -> None:
+        # Токены общего ведра не возвращаются: их могли уже взять другие реплики
+        self._wakeup.set()
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """
+    Планировщик исходящих запросов к Bot API с учётом лимитов Telegram.
+
+    - общий лимит и лимит на чат (в группах строже) через вёдра токенов;
+      при заданном REDIS_URL общий лимит - один на все реплики
+    - автоматический повтор после `TelegramRetryAfter` с паузой для всего чата
+    - загрузка документов и видео уступает очередь коротким ответам
+    - изменения одного сообщения, ожидающие своей очереди, схлопываются:
+      отправляется только последнее
+    """
+
+    # Держим в памяти не больше стольких вёдер чатов, лишние простаивающие удаляем
+    MAX_CHAT_BUCKETS = 10_000
+
+    def __init__(self) -> None:
+        self._global_bucket: TokenBucket
+        if redis is None:
+            self._global_bucket = TokenBucket(
+                rate=settings.THROTTLE_GLOBAL_RATE,
+                capacity=settings.THROTTLE_GLOBAL_RATE,
+            )
+        else:
+            self._global_bucket = SharedTokenBucket(
+                "global",
+                rate=settings.THROTTLE_GLOBAL_RATE,
+                capacity=settings.THROTTLE_GLOBAL_RATE,
+            )
+        self._chat_buckets: dict[int | str, TokenBucket] = {}
+        self._pending_edits: dict[tuple[Any, Any], asyncio.Future[Any]] = {}
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is not None:
+            return bucket
+
+        if len(self._chat_buckets) >= self.MAX_CHAT_BUCKETS:
+            self._chat_buckets = {
+                key: value
+                for key, value in self._chat_buckets.items()
+                if not value.idle
+            }
+
+        # Отрицательные ID у групп и каналов, для них лимит строже
+        is_group = isinstance(chat_id, str) or chat_id < 0
+        rate = settings.THROTTLE_GROUP_RATE if is_group else settings.THROTTLE_CHAT_RATE
+        bucket = TokenBucket(rate=rate, capacity=settings.THROTTLE_CHAT_BURST)
+        self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # Служебные запросы (getFile, getUpdates и т.п.) не ограничиваем
+            return await self._send_with_retry(make_request, bot, method, None)
+
+        priority = (
+            PRIORITY_LOW if isinstance(method, LOW_PRIORITY_METHODS) else PRIORITY_HIGH
+        )
+        chat_bucket = self._chat_bucket(chat_id)
+
+        message_id = getattr(method, "message_id", None)
+        coalesce = isinstance(method, COALESCED_METHODS) and message_id is not None
+        if not coalesce:
+            await chat_bucket.acquire(priority)
+            await self._global_bucket.acquire(priority)
+            return await self._send_with_retry(make_request, bot, method, chat_bucket)
+
+        return await self._send_coalesced(
+            make_request, bot, method, chat_bucket, (chat_id, message_id)
+        )
+
+    async def _send_coalesced(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+        chat_bucket: TokenBucket,
+        key: tuple[Any, Any],
+    ) -> Response[TelegramType]:
+        future: asyncio.Future[Response[TelegramType]] = (
+            asyncio.get_running_loop().create_future()
+        )
+        self._pending_edits[key] = future
+        try:
+            await chat_bucket.acquire(PRIORITY_HIGH)
+
+            latest = self._pending_edits.get(key)
+            if latest is not None and latest is not future:
+                # Пока ждали очереди, пришло более новое изменение этого сообщения:
+                # текущее не отправляем и возвращаем результат нового
+                chat_bucket.release()
+                logger.debug("Схлопнуто изменение сообщения {}", key)
+                response = cast(Response[TelegramType], await asyncio.shield(latest))
+            else:
+                await self._global_bucket.acquire(PRIORITY_HIGH)
+                response = await self._send_with_retry(
+                    make_request, bot, method, chat_bucket
+                )
+
+            future.set_result(response)
+            return response
+
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(e)
+                # Исключение уже получит вызывающий код, не логируем его повторно
+                future.exception()
+            raise
+        finally:
+            if self._pending_edits.get(key) is future:
+                del self._pending_edits[key]
+
+    async def _send_with_retry(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+        chat_bucket: TokenBucket | None,
+    ) -> Response[TelegramType]:
+        attempt = 0
+        while True:
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > settings.THROTTLE_MAX_RETRIES:
+                    raise
+
+                logger.warning(
+                    "Превышен лимит Telegram для {}, повтор через {} с (попытка {})",
+                    type(method).__name__,
+                    e.retry_after,
+                    attempt,
+                )
+                # Приостанавливаем весь чат, чтобы остальные запросы не получили тот же отказ
+                bucket = chat_bucket or self._global_bucket
+                bucket.block(e.retry_after)
+                await bucket.acquire(PRIORITY_HIGH)
+                if chat_bucket is not None:
+                    # Повтор - такой же запрос к Telegram и расходует общий лимит
+                    await self._global_bucket.acquire(PRIORITY_HIGH)
@@ -0,0 +1,88 @@
+"""
+Замер скорости скачивания файлов через поддельный Bot API.
+
+Сравнивает стандартный путь aiogram (AiohttpSession + bot.download_file) с
+настроенной сессией (TunedAiohttpSession + session.download_stream).
+
+Запуск из директории bot/:
+
+    uv run python bench/download.py --files 1000 --size 262144
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import sys
+import time
+from pathlib import Path
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "42:FAKE")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from fake_api import TOKEN, FakeBotAPI, file_id  # noqa: E402
+from session import TunedAiohttpSession, download_stream  # noqa: E402
+
+
+async def _run(bot: Bot, *, tuned: bool, files: int, size: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def download(index: int) -> None:
+        async with semaphore:
+            file = await bot.get_file(file_id(f"f{index}", size))
+            assert file.file_path is not None
+            if tuned:
+                received = 0
+                async for chunk in download_stream(
+                    bot=bot, telegram_path=file.file_path, file_size=file.file_size
+                ):
+                    received += len(chunk)
+            else:
+                buffer = io.BytesIO()
+                await bot.download_file(file.file_path, destination=buffer)
+                received = buffer.getbuffer().nbytes
+            assert received == size
+
+    started = time.perf_counter()
+    await asyncio.gather(*(download(i) for i in range(files)))
+    return time.perf_counter() - started
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=256 * 1024)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.01)
+    args = parser.parse_args()
+
+    api = FakeBotAPI(latency=args.latency)
+    url = await api.start()
+    server = TelegramAPIServer.from_base(url)
+
+    for name, session, tuned in (
+        ("aiogram default", AiohttpSession(api=server), False),
+        ("tuned session", TunedAiohttpSession(api=server), True),
+    ):
+        async with Bot(TOKEN, session=session) as bot:
+            elapsed = await _run(
+                bot,
+                tuned=tuned,
+                files=args.files,
+                size=args.size,
+                concurrency=args.concurrency,
+            )
+        total_mb = args.files * args.size / 1024 / 1024
+        print(
+            f"{name:>16}: {elapsed:.2f} с, {args.files / elapsed:.0f} файлов/с, "
+            f"{total_mb / elapsed:.1f} Мб/с"
+        )
+
+    await api.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,217 @@
+"""
+Поддельный Bot API для нагрузочных замеров.
+
+Отвечает на getFile и отдаёт содержимое файлов (с поддержкой Range), выдаёт
+боту обновления из очереди `updates` через getUpdates, на остальные методы
+возвращает правдоподобный ответ. Идентификатор файла имеет вид `<имя>:<размер>`,
+содержимое генерируется детерминированно.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import time
+from typing import Any
+
+from aiohttp import web
+
+TOKEN = "42:FAKE"
+
+
+def file_id(name: str, size: int) -> str:
+    return f"{name}:{size}"
+
+
+def _file_content(path: str, size: int) -> bytes:
+    pattern = (path.encode() + b"\n") * 64
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+class FakeBotAPI:
+    """
+    Сервер поддельного Bot API.
+
+    Args:
+        latency: Задержка ответа на каждый запрос, секунд
+        fail_every: Обрывать каждую N-ю отдачу файла на середине (0 - не обрывать)
+    """
+
+    def __init__(self, *, latency: float = 0.0, fail_every: int = 0) -> None:
+        self.latency = latency
+        self.fail_every = fail_every
+        self.requests = 0
+        self.file_requests = 0
+        self._message_id = 0
+        # Обновления для ближайшего getUpdates
+        self.updates: list[dict[str, Any]] = []
+        # Время (perf_counter) первого getUpdates и первого отправленного сообщения
+        self.polled_at: float | None = None
+        self.sent_at: float | None = None
+        self.sent = asyncio.Event()
+        self._runner: web.AppRunner | None = None
+        self.url = ""
+
+        self.app = web.Application()
+        self.app.router.add_get("/file/bot{token}/{path:.+}", self._file)
+        self.app.router.add_post("/bot{token}/{method}", self._method)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        server = site._server
+        assert server is not None
+        sockets = getattr(server, "sockets", None) or []
+        self.url = f"http://{host}:{sockets[0].getsockname()[1]}"
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _method(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        method = request.match_info["method"].lower()
+        data = await request.post()
+        result: Any = True
+
+        if method == "getfile":
+            name, size = str(data["file_id"]).rsplit(":", 1)
+            result = {
+                "file_id": data["file_id"],
+                "file_unique_id": name,
+                "file_size": int(size),
+                "file_path": f"documents/{name}-{size}.bin",
+            }
+        elif method == "getme":
+            result = {
+                "id": 42,
+                "is_bot": True,
+                "first_name": "Fake",
+                "username": "fake_bot",
+            }
+        elif method == "getupdates":
+            if self.polled_at is None:
+                self.polled_at = time.perf_counter()
+            result, self.updates = self.updates, []
+            if not result:
+                # Long polling: ждём, но недолго, чтобы бот быстро останавливался
+                await asyncio.sleep(min(float(str(data.get("timeout", 0))), 1.0))
+        elif method.startswith("send") or method.startswith("edit"):
+            if method.startswith("send") and self.sent_at is None:
+                self.sent_at = time.perf_counter()
+                self.sent.set()
+            self._message_id += 1
+            result = {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(str(data.get("chat_id", 1))), "type": "private"},
+                "text": str(data.get("text", "")),
+            }
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def _file(self, request: web.Request) -> web.StreamResponse:
+        self.file_requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        path = request.match_info["path"]
+        size = int(path.rsplit("-", 1)[1].removesuffix(".bin"))
+        content = _file_content(path, size)
+
+        start = 0
+        status = 200
+        if range_header := request.headers.get("Range"):
+            start = int(range_header.removeprefix("bytes=").split("-")[0])
+            status = 206
+
+        body = content[start:]
+        response = web.StreamResponse(status=status)
+        response.content_length = len(body)
+        await response.prepare(request)
+
+        if self.fail_every and self.file_requests % self.fail_every == 0 and start == 0:
+            # Отдаём половину и обрываем соединение
+            await response.write(body[: len(body) // 2])
+            assert request.transport is not None
+            request.transport.close()
+            return response
+
+        await response.write(body)
+        await response.write_eof()
+        return response
+
+
+def command_update(update_id: int, text: str, *, user_id: int = 1) -> dict[str, Any]:
+    """Возвращает обновление с командой от пользователя в личном чате."""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+        },
+    }
+
+
+def document_update(
+    update_id: int, name: str, size: int, *, user_id: int = 1
+) -> dict[str, Any]:
+    """Возвращает обновление с документом от пользователя в личном чате."""
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "document": {
+                "file_id": file_id(name, size),
+                "file_unique_id": name,
+                "file_name": f"{name}.bin",
+                "file_size": size,
+            },
+        },
+    }
+
+
+def _serve(latency: float, fail_every: int, nice: int, connection: Any) -> None:
+    os.nice(nice)
+
+    async def serve() -> None:
+        api = FakeBotAPI(latency=latency, fail_every=fail_every)
+        connection.send(await api.start())
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def start_in_subprocess(
+    *, latency: float = 0.0, fail_every: int = 0, nice: int = 0
+) -> tuple[str, multiprocessing.Process]:
+    """
+    Запускает поддельный Bot API в отдельном процессе.
+
+    Нужно для замеров задержки цикла событий: отдача файлов в том же процессе
+    занимала бы тот же цикл и тот же GIL. С `nice` > 0 сервер уступает процессор
+    боту: иначе на машине с одним ядром в задержку цикла попадало бы и время,
+    которое процессор отдаёт поддельному серверу (настоящий Telegram работает
+    на других машинах).
+
+    Returns:
+        Адрес сервера и процесс (остановить через `terminate()`)
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(
+        target=_serve, args=(latency, fail_every, nice, child), daemon=True
+    )
+    process.start()
+    return parent.recv(), process
@@ -0,0 +1,253 @@
+"""
+Замер масштабирования: пропускная способность сохранения файлов на 1-4 репликах.
+
+Запускает N процессов `app/main.py` в режиме вебхука с общими Redis (в нём же
+хранится индекс файлов) и FILES_DIR. Вместо Redis по умолчанию используется
+fakeredis (TCP-сервер в отдельном процессе, нужна группа зависимостей bench),
+вместо Telegram - поддельный Bot API. Обновления с документами раздаются
+репликам по очереди, как это делал бы балансировщик; замер длится, пока все
+файлы не появятся в общем индексе.
+
+Запуск из директории bot/:
+
+    uv run --group bench python bench/replicas.py --replicas 1 2 4 --files 2000
+
+Реплики делят процессор хоста: прирост от числа реплик есть, только пока
+на хосте есть свободные ядра (а на практике - при репликах на разных хостах).
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+import aiohttp
+from fake_api import TOKEN, document_update, start_in_subprocess
+from redis import Redis
+
+BOT_DIR = Path(__file__).resolve().parent.parent
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return int(sock.getsockname()[1])
+
+
+def _serve_fakeredis(port: int) -> None:
+    from fakeredis import TcpFakeServer
+
+    TcpFakeServer(("127.0.0.1", port)).serve_forever()
+
+
+def start_fakeredis() -> tuple[str, multiprocessing.Process]:
+    """
+    Запускает fakeredis, доступный по сети, в отдельном процессе.
+
+    Returns:
+        REDIS_URL и процесс (остановить через `terminate()`)
+    """
+    port = _free_port()
+    process = multiprocessing.Process(
+        target=_serve_fakeredis, args=(port,), daemon=True
+    )
+    process.start()
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+    # TCP-сервер fakeredis закрывает соединение после ответа с ошибкой, а
+    # блокировки redis-py загружают свои Lua-скрипты как раз после ошибки
+    # NoScript: загружаем их заранее
+    from redis.lock import Lock
+
+    with Redis(port=port) as client:
+        for script in (
+            Lock.LUA_RELEASE_SCRIPT,
+            Lock.LUA_EXTEND_SCRIPT,
+            Lock.LUA_REACQUIRE_SCRIPT,
+        ):
+            client.script_load(script)
+    return f"redis://127.0.0.1:{port}/0", process
+
+
+def _cpu_seconds(pid: int) -> tuple[float, float]:
+    """Возвращает процессорное время процесса, секунд (Linux)."""
+    fields = Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def _indexed(client: Any) -> int:
+    # Число файлов в индексе (см. RedisFileIndex)
+    return int(client.zcard("archiver:index:keys"))
+
+
+def _check_alive(processes: list[asyncio.subprocess.Process]) -> None:
+    for process in processes:
+        if process.returncode is not None:
+            raise RuntimeError(f"Реплика завершилась с кодом {process.returncode}")
+
+
+async def _wait_ready(
+    http: aiohttp.ClientSession,
+    url: str,
+    processes: list[asyncio.subprocess.Process],
+    timeout: float,
+) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with http.get(url):
+                return
+        except aiohttp.ClientConnectionError:
+            _check_alive(processes)
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def _run(
+    *,
+    replicas: int,
+    files: int,
+    size: int,
+    users: int,
+    concurrency: int,
+    api_url: str,
+    redis_url: str,
+    timeout: float,
+) -> tuple[float, float]:
+    """
+    Возвращает пропускную способность N реплик (файлов в секунду) и
+    процессорное время реплик на файл (секунд).
+    """
+    http = aiohttp.ClientSession()
+    processes: list[asyncio.subprocess.Process] = []
+    with tempfile.TemporaryDirectory(prefix="replicas_") as files_dir:
+        # Индекс и блокировки прошлого замера не должны попасть в этот
+        client = Redis.from_url(redis_url)
+        client.flushdb()
+        env: dict[str, Any] = {
+            **os.environ,
+            "TELEGRAM_BOT_TOKEN": TOKEN,
+            "TELEGRAM_API_URL": api_url,
+            "FILES_DIR": files_dir,
+            "REDIS_URL": redis_url,
+            "WEBHOOK_URL": "http://127.0.0.1",
+            "LOG_LEVEL": os.environ.get("BENCH_LOG_LEVEL", "WARNING"),
+        }
+        webhooks = []
+        try:
+            for _ in range(replicas):
+                port = _free_port()
+                webhooks.append(f"http://127.0.0.1:{port}/webhook")
+                processes.append(
+                    await asyncio.create_subprocess_exec(
+                        sys.executable,
+                        "app/main.py",
+                        cwd=BOT_DIR,
+                        env={**env, "WEBHOOK_PORT": str(port)},
+                        stdout=asyncio.subprocess.DEVNULL,
+                    )
+                )
+            for url in webhooks:
+                await _wait_ready(http, url, processes, timeout)
+
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def post(index: int) -> None:
+                update = document_update(
+                    index + 1, f"f{index}", size, user_id=1000 + index % users
+                )
+                # Раздаём обновления по очереди, как балансировщик
+                async with (
+                    semaphore,
+                    http.post(webhooks[index % replicas], json=update) as response,
+                ):
+                    response.raise_for_status()
+
+            cpu_started = sum(_cpu_seconds(process.pid) for process in processes)
+            started = time.perf_counter()
+            await asyncio.gather(*(post(i) for i in range(files)))
+            # Файл сохранён, когда он появился в общем индексе
+            deadline = time.monotonic() + timeout
+            while (saved := _indexed(client)) < files:
+                _check_alive(processes)
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Сохранено {saved} файлов из {files}")
+                await asyncio.sleep(0.01)
+            elapsed = time.perf_counter() - started
+            cpu = sum(_cpu_seconds(process.pid) for process in processes) - cpu_started
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                await process.wait()
+            await http.close()
+            client.close()
+
+    return files / elapsed, cpu / files
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--replicas", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--size", type=int, default=64 * 1024)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument(
+        "--redis-url", help="настоящий Redis вместо fakeredis (будет изменён)"
+    )
+    args = parser.parse_args()
+    print(f"Ядер процессора: {os.cpu_count()}")
+
+    api_url, api_process = start_in_subprocess(latency=args.latency)
+    redis_process = None
+    if args.redis_url:
+        redis_url = args.redis_url
+    else:
+        redis_url, redis_process = start_fakeredis()
+
+    try:
+        baseline = None
+        for replicas in args.replicas:
+            throughput, cpu_per_file = await _run(
+                replicas=replicas,
+                files=args.files,
+                size=args.size,
+                users=args.users,
+                concurrency=args.concurrency,
+                api_url=api_url,
+                redis_url=redis_url,
+                timeout=args.timeout,
+            )
+            baseline = baseline or throughput
+            print(
+                f"Реплик: {replicas}: {throughput:.0f} файлов/с "
+                f"(x{throughput / baseline:.2f}), "
+                f"ЦП реплик {cpu_per_file * 1000:.1f} мс на файл",
+                flush=True,
+            )
+    finally:
+        api_process.terminate()
+        if redis_process is not None:
+            redis_process.terminate()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,123 @@
+"""
+Замер холодного запуска бота: время до ответа на первое обновление и память в простое.
+
+Запускает `app/main.py` отдельным процессом с поддельным Bot API
+(`TELEGRAM_API_URL`) и пустой FILES_DIR во временной директории, отдаёт ему
+команду /start и измеряет:
+
+- время от запуска процесса до первого getUpdates (бот готов принимать обновления)
+- время до ответа на /start (time-to-first-update)
+- RSS процесса после `--idle` секунд простоя
+
+Запуск из директории bot/:
+
+    uv run python bench/startup.py --runs 5
+    uv run python bench/startup.py --runs 5 --uvloop
+
+Дополнительные переменные окружения бота передаются через `--env`, например
+`--env SENTRY_DSN=https://key@example.com/1`.
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from fake_api import TOKEN, FakeBotAPI, command_update
+
+BOT_DIR = Path(__file__).resolve().parent.parent
+
+
+def _rss_mb(pid: int) -> float:
+    """Возвращает RSS процесса в мегабайтах (Linux)."""
+    for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+        if line.startswith("VmRSS:"):
+            return int(line.split()[1]) / 1024
+    raise RuntimeError(f"Нет VmRSS для процесса {pid}")
+
+
+async def _run(
+    *, env: dict[str, str], idle: float, timeout: float
+) -> tuple[float, float, float]:
+    api = FakeBotAPI()
+    url = await api.start()
+    api.updates.append(command_update(1, "/start"))
+
+    with tempfile.TemporaryDirectory(prefix="startup_") as files_dir:
+        started = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "app/main.py",
+            cwd=BOT_DIR,
+            env={
+                **os.environ,
+                "TELEGRAM_BOT_TOKEN": TOKEN,
+                "TELEGRAM_API_URL": url,
+                "FILES_DIR": files_dir,
+                **env,
+            },
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        try:
+            await asyncio.wait_for(api.sent.wait(), timeout)
+            assert api.polled_at is not None and api.sent_at is not None
+            await asyncio.sleep(idle)
+            rss = _rss_mb(process.pid)
+        finally:
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), 10)
+            except TimeoutError:
+                process.kill()
+                await process.wait()
+            await api.stop()
+
+    return api.polled_at - started, api.sent_at - started, rss
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--idle", type=float, default=3.0, help="простой перед замером RSS, с"
+    )
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--uvloop", action="store_true", help="запуск с USE_UVLOOP")
+    parser.add_argument(
+        "--env",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE",
+        help="переменная окружения бота (можно указать несколько раз)",
+    )
+    args = parser.parse_args()
+
+    env = dict(item.split("=", 1) for item in args.env)
+    env["USE_UVLOOP"] = "true" if args.uvloop else "false"
+
+    ready, first_update, rss = [], [], []
+    for run in range(1, args.runs + 1):
+        result = await _run(env=env, idle=args.idle, timeout=args.timeout)
+        ready.append(result[0])
+        first_update.append(result[1])
+        rss.append(result[2])
+        print(
+            f"Запуск {run}: getUpdates через {result[0]:.2f} с, "
+            f"ответ на /start через {result[1]:.2f} с, RSS {result[2]:.1f} Мб"
+        )
+
+    print(
+        f"Медиана по {args.runs} запускам: готов через "
+        f"{statistics.median(ready):.2f} с, первое обновление обработано через "
+        f"{statistics.median(first_update):.2f} с, RSS в простое "
+        f"{statistics.median(rss):.1f} Мб"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
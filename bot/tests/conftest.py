@@ -0,0 +1,44 @@
+"""
+Общие фикстуры тестов.
+
+Модули бота создают настройки, хранилище и индекс при импорте, поэтому
+окружение задаётся до их импорта, а каждый тест получает свою директорию файлов
+и свою базу индекса.
+"""
+
+import os
+import tempfile
+from collections.abc import Iterator
+from pathlib import Path
+
+import pytest
+
+os.environ.update(
+    TELEGRAM_BOT_TOKEN="42:TEST",
+    FILES_DIR=tempfile.mkdtemp(prefix="archiver-tests-"),
+    STORAGE_BACKEND="local",
+    LOG_LEVEL="WARNING",
+)
+# Тесты работают без Redis: блокировки и индекс - локальные
+os.environ.pop("REDIS_URL", None)
+os.environ.pop("INDEX_BACKEND", None)
+
+from config import settings  # noqa: E402
+from index import SqliteFileIndex, file_index  # noqa: E402
+from storage import LocalStorage, storage  # noqa: E402
+
+
+@pytest.fixture
+def files_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Iterator[Path]:
+    """Пустая директория файлов и пустой индекс для одного теста."""
+    assert isinstance(storage, LocalStorage)
+    assert isinstance(file_index, SqliteFileIndex)
+    root = tmp_path / "files"
+    root.mkdir()
+    monkeypatch.setattr(settings, "FILES_DIR", str(root))
+    monkeypatch.setattr(storage, "root", root)
+
+    file_index.close()
+    monkeypatch.setattr(file_index, "path", tmp_path / "index.sqlite3")
+    yield root
+    file_index.close()
@@ -0,0 +1,80 @@
+import asyncio
+import hashlib
+import subprocess
+import zipfile
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from services import MANIFEST_NAME, _build_archive
+from storage import StoredObject
+
+
+def _store(root: Path, key: str, data: bytes) -> StoredObject:
+    path = root / key
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return StoredObject(
+        key=key,
+        size=len(data),
+        created_at=datetime(2024, 1, 15, 12),
+        sha256=hashlib.sha256(data).hexdigest(),
+    )
+
+
+def _archive(root: Path, files: dict[str, bytes], tmp_path: Path) -> zipfile.ZipFile:
+    objects = [_store(root, f"user/{name}", data) for name, data in files.items()]
+    path = asyncio.run(
+        _build_archive(
+            user_dir="user", objects=objects, prefix="test_", directory=tmp_path
+        )
+    )
+    return zipfile.ZipFile(path)
+
+
+def test_user_file_named_like_manifest_is_renamed(
+    files_dir: Path, tmp_path: Path
+) -> None:
+    files = {
+        MANIFEST_NAME: b"user data",
+        "MANIFEST_1.sha256": b"more user data",
+        "photo.jpg": b"jpeg",
+    }
+    with _archive(files_dir, files, tmp_path) as archive:
+        names = archive.namelist()
+        assert len(names) == len(set(names)) == 4
+        assert archive.read("MANIFEST_2.sha256") == b"user data"
+        assert archive.read("MANIFEST_1.sha256") == b"more user data"
+        manifest = archive.read(MANIFEST_NAME).decode()
+
+    assert "  MANIFEST_2.sha256\n" in manifest
+    assert f"  {MANIFEST_NAME}\n" not in manifest
+
+
+def test_manifest_escapes_names_like_sha256sum(files_dir: Path, tmp_path: Path) -> None:
+    files = {
+        "back\\slash.txt": b"backslash",
+        "new\nline.txt": b"newline",
+        "plain.txt": b"plain",
+    }
+    with _archive(files_dir, files, tmp_path) as archive:
+        manifest = archive.read(MANIFEST_NAME).decode()
+        extracted = tmp_path / "extracted"
+        archive.extractall(extracted)
+
+    lines = manifest.splitlines()
+    assert len(lines) == 3
+    assert f"\\{hashlib.sha256(b'backslash').hexdigest()}  back\\\\slash.txt" in lines
+    assert f"\\{hashlib.sha256(b'newline').hexdigest()}  new\\nline.txt" in lines
+    assert f"{hashlib.sha256(b'plain').hexdigest()}  plain.txt" in lines
+
+    try:
+        result = subprocess.run(
+            ["sha256sum", "-c", MANIFEST_NAME],
+            cwd=extracted,
+            capture_output=True,
+            check=False,
+        )
+    except FileNotFoundError:
+        pytest.skip("sha256sum не установлен")
+    assert result.returncode == 0, result.stdout + result.stderr
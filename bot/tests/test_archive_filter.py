@@ -0,0 +1,48 @@
+from datetime import date
+
+import pytest
+from services import ArchiveFilter, parse_archive_filter
+
+
+def test_empty_filter_selects_everything() -> None:
+    archive_filter = parse_archive_filter([])
+    assert archive_filter == ArchiveFilter()
+    assert not archive_filter
+    assert archive_filter.describe() == ""
+    assert archive_filter.filename_suffix() == ""
+
+
+def test_single_date() -> None:
+    archive_filter = parse_archive_filter(["2024-01-15"])
+    assert archive_filter.date_from == archive_filter.date_to == date(2024, 1, 15)
+    assert archive_filter.describe() == "за 2024-01-15"
+    assert archive_filter.filename_suffix() == "_2024-01-15"
+
+
+def test_period_types_and_sizes() -> None:
+    archive_filter = parse_archive_filter(
+        ["Photo", "docs", "photos", "2024-01-01..2024-01-31", ">1.5MB", "<500kb"]
+    )
+    assert archive_filter.media_types == ("photo", "document")
+    assert archive_filter.date_from == date(2024, 1, 1)
+    assert archive_filter.date_to == date(2024, 1, 31)
+    assert archive_filter.min_size == int(1.5 * 1024**2)
+    assert archive_filter.max_size == 500 * 1024
+    assert archive_filter.filename_suffix() == "_photo_document_2024-01-01_2024-01-31"
+
+
+def test_cyrillic_size_units() -> None:
+    archive_filter = parse_archive_filter([">10мб"])
+    assert archive_filter.min_size == 10 * 1024**2
+
+
+@pytest.mark.parametrize("arg", ["2024-13-01", "2024-01-01..2024-02-30"])
+def test_invalid_date(arg: str) -> None:
+    with pytest.raises(ValueError, match="формат даты"):
+        parse_archive_filter([arg])
+
+
+@pytest.mark.parametrize("arg", ["pictures", ">10XB", "=10MB", "10MB"])
+def test_unknown_filter(arg: str) -> None:
+    with pytest.raises(ValueError, match="Неизвестный фильтр"):
+        parse_archive_filter([arg])
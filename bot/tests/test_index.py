@@ -0,0 +1,137 @@
+import asyncio
+import time
+from collections.abc import Awaitable, Callable
+from pathlib import Path
+
+import pytest
+from index import FileIndex, RedisFileIndex, SqliteFileIndex
+
+IndexTest = Callable[[FileIndex], Awaitable[None]]
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def run_with_index(
+    request: pytest.FixtureRequest, tmp_path: Path
+) -> Callable[[IndexTest], None]:
+    """Выполняет тест на каждом бэкенде индекса."""
+
+    def run(test: IndexTest) -> None:
+        async def main() -> None:
+            index: FileIndex
+            if request.param == "sqlite":
+                index = SqliteFileIndex(tmp_path / "index.sqlite3")
+            else:
+                fakeredis = pytest.importorskip("fakeredis")
+                index = RedisFileIndex(fakeredis.aioredis.FakeRedis())
+            try:
+                await test(index)
+            finally:
+                index.close()
+
+        asyncio.run(main())
+
+    return run
+
+
+def test_add_list_and_remove(run_with_index: Callable[[IndexTest], None]) -> None:
+    async def test(index: FileIndex) -> None:
+        await index.add_file(user_id=1, key="1/a.jpg", size=10, media_type="photo")
+        await index.add_file(user_id=1, key="1/a_1.jpg", size=20, sha256="h")
+        await index.add_file(user_id=12, key="12/a.jpg", size=30)
+        # Повторное добавление ключа заменяет запись
+        await index.add_file(user_id=1, key="1/a.jpg", size=15, media_type="photo")
+
+        assert await index.keys_with_prefix("1/a") == {"1/a.jpg", "1/a_1.jpg"}
+        assert [obj.key for obj in await index.list_user_files(1)] == [
+            "1/a_1.jpg",
+            "1/a.jpg",
+        ]
+        photos = await index.list_user_files(1, media_types=["photo"])
+        assert [(obj.key, obj.size) for obj in photos] == [("1/a.jpg", 15)]
+        assert [obj.key for obj in await index.list_user_files(1, min_size=16)] == [
+            "1/a_1.jpg"
+        ]
+        assert sorted(await index.users_over_quota(20)) == [(1, 35), (12, 30)]
+
+        await index.remove_files(["1/a_1.jpg"])
+        assert await index.get_file("1/a_1.jpg") is None
+        assert sorted(await index.users_over_quota(0)) == [(1, 15), (12, 30)]
+        assert await index.remove_user(1) == 1
+        assert await index.users_over_quota(0) == [(12, 30)]
+
+    run_with_index(test)
+
+
+def test_eviction_order(run_with_index: Callable[[IndexTest], None]) -> None:
+    async def test(index: FileIndex) -> None:
+        for i in range(4):
+            await index.add_file(user_id=i % 2, key=f"{i % 2}/f{i}", size=i)
+            await asyncio.sleep(0.002)
+        await index.mark_archived(["1/f3", "0/missing"])
+
+        rows = await index.select_for_eviction(limit=3)
+        assert [tuple(row) for row in rows] == [
+            ("0/f0", 0, 0, None),
+            ("1/f1", 1, 1, None),
+            ("0/f2", 0, 2, None),
+        ]
+        archived = await index.select_for_eviction(limit=10, archived=True)
+        assert [row[0] for row in archived] == ["1/f3"]
+        by_user = await index.select_for_eviction(limit=10, user_id=1)
+        assert [row[0] for row in by_user] == ["1/f1", "1/f3"]
+        assert await index.select_for_eviction(limit=10, created_before=0) == []
+
+    run_with_index(test)
+
+
+def test_scrub_queue(run_with_index: Callable[[IndexTest], None]) -> None:
+    async def test(index: FileIndex) -> None:
+        await index.add_file(user_id=1, key="1/a", size=1, sha256="a")
+        await index.add_file(user_id=1, key="1/b", size=1, sha256="b")
+        await index.add_file(user_id=1, key="1/c", size=1)
+        now = time.time() + 1
+        assert {
+            obj.key
+            for obj in await index.select_for_scrub(limit=10, verified_before=now)
+        } == {
+            "1/a",
+            "1/b",
+        }
+        await index.mark_verified(["1/a"], verified_at=now + 10)
+        assert [
+            obj.key
+            for obj in await index.select_for_scrub(limit=10, verified_before=now)
+        ] == ["1/b"]
+
+    run_with_index(test)
+
+
+def test_packs_and_rename(run_with_index: Callable[[IndexTest], None]) -> None:
+    async def test(index: FileIndex) -> None:
+        pack = "1/.packs/p.pack"
+        for i in range(3):
+            await index.add_file(
+                user_id=1, key=f"1/f{i}", size=10, pack=pack, pack_offset=i * 10
+            )
+        await index.remove_files(["1/f0", "1/f1"])
+        assert await index.fragmented_packs(0.5) == [(pack, 1)]
+
+        await index.replace_pack(
+            pack, new_pack="1/.packs/q.pack", user_id=1, size=10, offsets=[("1/f2", 0)]
+        )
+        assert await index.fragmented_packs(0) == []
+        (obj,) = await index.list_pack_files("1/.packs/q.pack")
+        assert (obj.key, obj.pack_offset) == ("1/f2", 0)
+
+        await index.rename_keys(
+            [("1/.packs/q.pack", "ab/cd/1/.packs/q.pack")],
+            user_id=1,
+            old_prefix="1",
+            new_prefix="ab/cd/1",
+        )
+        (obj,) = await index.list_user_files(1)
+        assert (obj.key, obj.pack) == ("ab/cd/1/f2", "ab/cd/1/.packs/q.pack")
+        assert await index.keys_with_prefix("1/") == set()
+        assert await index.fragmented_packs(0) == []
+
+    run_with_index(test)
@@ -0,0 +1,84 @@
+import asyncio
+
+from locks import KeyedLock
+
+
+def test_same_key_is_serialized_in_order() -> None:
+    async def run() -> None:
+        locks = KeyedLock("test", max_idle=10)
+        events: list[str] = []
+
+        async def job(name: str) -> None:
+            async with locks.hold(1):
+                events.append(f"{name}+")
+                await asyncio.sleep(0.01)
+                events.append(f"{name}-")
+
+        await asyncio.gather(job("a"), job("b"), job("c"))
+        assert events == ["a+", "a-", "b+", "b-", "c+", "c-"]
+
+    asyncio.run(run())
+
+
+def test_different_keys_run_in_parallel() -> None:
+    async def run() -> None:
+        locks = KeyedLock("test", max_idle=10)
+        inside = 0
+        peak = 0
+
+        async def job(key: int) -> None:
+            nonlocal inside, peak
+            async with locks.hold(key):
+                inside += 1
+                peak = max(peak, inside)
+                await asyncio.sleep(0.01)
+                inside -= 1
+
+        await asyncio.gather(*(job(key) for key in range(5)))
+        assert peak == 5
+
+    asyncio.run(run())
+
+
+def test_idle_locks_are_reclaimed_lru() -> None:
+    async def run() -> None:
+        locks = KeyedLock("test", max_idle=2)
+        for key in (1, 2, 3):
+            async with locks.hold(key):
+                pass
+        # Держим не больше max_idle простаивающих блокировок, вытесняя старые
+        assert list(locks._lanes) == [2, 3]
+
+        async with locks.hold(2):
+            pass
+        async with locks.hold(4):
+            pass
+        assert list(locks._lanes) == [2, 4]
+
+    asyncio.run(run())
+
+
+def test_busy_locks_are_not_reclaimed() -> None:
+    async def run() -> None:
+        locks = KeyedLock("test", max_idle=0)
+        release = asyncio.Event()
+
+        async def hold_busy() -> None:
+            async with locks.hold("busy"):
+                await release.wait()
+
+        task = asyncio.create_task(hold_busy())
+        await asyncio.sleep(0)
+        async with locks.hold("other"):
+            pass
+        assert locks.locked("busy")
+        assert list(locks._lanes) == ["busy"]
+
+        # Ожидающий той же блокировки получает тот же объект, а не новый
+        waiter = asyncio.create_task(hold_busy())
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(task, waiter)
+        assert not locks._lanes
+
+    asyncio.run(run())
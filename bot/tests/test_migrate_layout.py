@@ -0,0 +1,72 @@
+import asyncio
+from pathlib import Path
+
+import pytest
+from config import settings
+from index import file_index
+from migrate_layout import migrate
+from storage import flat_user_dir, resolve_user_dir, sharded_user_dir
+
+
+@pytest.fixture(autouse=True)
+def sharded_layout(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(settings, "FILES_LAYOUT", "sharded")
+
+
+def _write(root: Path, key: str, data: bytes) -> None:
+    path = root / key
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def test_users_are_moved_with_their_index(files_dir: Path) -> None:
+    flat = flat_user_dir(123)
+    sharded = sharded_user_dir(123)
+
+    async def run() -> None:
+        for name in ("a.txt", "sub/b.txt"):
+            _write(files_dir, f"{flat}/{name}", name.encode())
+            await file_index.add_file(user_id=123, key=f"{flat}/{name}", size=5)
+        # До переноса бот находит файлы в старой директории
+        assert await resolve_user_dir(123) == flat
+
+        await migrate(dry_run=False, delay=0)
+
+        assert not (files_dir / flat).exists()
+        assert (files_dir / sharded / "sub/b.txt").read_bytes() == b"sub/b.txt"
+        keys = [obj.key for obj in await file_index.list_user_files(123)]
+        assert sorted(keys) == [f"{sharded}/a.txt", f"{sharded}/sub/b.txt"]
+        assert await resolve_user_dir(123) == sharded
+
+    asyncio.run(run())
+
+
+def test_merge_into_existing_sharded_dir(files_dir: Path) -> None:
+    flat = flat_user_dir(456)
+    sharded = sharded_user_dir(456)
+
+    async def run() -> None:
+        # Пользователь уже успел сохранить файл с тем же именем в новую директорию
+        _write(files_dir, f"{flat}/a.txt", b"old")
+        _write(files_dir, f"{sharded}/a.txt", b"new")
+        await file_index.add_file(user_id=456, key=f"{flat}/a.txt", size=3)
+        await file_index.add_file(user_id=456, key=f"{sharded}/a.txt", size=3)
+
+        await migrate(dry_run=False, delay=0)
+
+        assert not (files_dir / flat).exists()
+        assert (files_dir / sharded / "a.txt").read_bytes() == b"new"
+        assert (files_dir / sharded / "a_1.txt").read_bytes() == b"old"
+        keys = {obj.key for obj in await file_index.list_user_files(456)}
+        assert keys == {f"{sharded}/a.txt", f"{sharded}/a_1.txt"}
+
+    asyncio.run(run())
+
+
+def test_dry_run_changes_nothing(files_dir: Path) -> None:
+    async def run() -> None:
+        _write(files_dir, "789/a.txt", b"a")
+        await migrate(dry_run=True, delay=0)
+        assert (files_dir / "789/a.txt").exists()
+
+    asyncio.run(run())
@@ -0,0 +1,71 @@
+import asyncio
+from collections.abc import AsyncIterator
+from pathlib import Path
+
+import pytest
+from config import settings
+from index import file_index
+from packs import append_to_pack, compact_packs, read_packed
+
+
+async def _chunks(data: bytes) -> AsyncIterator[bytes]:
+    yield data
+
+
+async def _save_packed(key: str, data: bytes) -> None:
+    pack, offset, size = await append_to_pack(user_dir="1", chunks=_chunks(data))
+    await file_index.add_file(
+        user_id=1, key=key, size=size, pack=pack, pack_offset=offset
+    )
+
+
+@pytest.fixture(autouse=True)
+def packing(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(settings, "PACK_SMALL_FILES", True)
+    monkeypatch.setattr(settings, "PACK_COMPACT_RATIO", 0.5)
+
+
+def test_compaction_keeps_live_files(files_dir: Path) -> None:
+    contents = {f"1/f{i}.txt": bytes([i]) * (100 + i) for i in range(6)}
+
+    async def run() -> None:
+        for key, data in contents.items():
+            await _save_packed(key, data)
+        (pack,) = {obj.pack for obj in await file_index.list_user_files(1)}
+        assert pack is not None
+        old_size = (files_dir / pack).stat().st_size
+
+        # Удалена меньшая часть пакета: уплотнять рано
+        await file_index.remove_files(["1/f0.txt"])
+        assert await compact_packs() == 0
+
+        deleted = ["1/f1.txt", "1/f2.txt", "1/f4.txt"]
+        await file_index.remove_files(deleted)
+        freed = await compact_packs()
+
+        live = await file_index.list_user_files(1)
+        assert [obj.key for obj in live] == ["1/f3.txt", "1/f5.txt"]
+        (new_pack,) = {obj.pack for obj in live}
+        assert new_pack != pack
+        assert not (files_dir / pack).exists()
+        new_size = (files_dir / new_pack).stat().st_size
+        assert new_size == sum(len(contents[obj.key]) for obj in live)
+        assert freed == old_size - new_size
+        for obj in live:
+            assert await read_packed(obj) == contents[obj.key]
+
+    asyncio.run(run())
+
+
+def test_compaction_removes_empty_pack(files_dir: Path) -> None:
+    async def run() -> None:
+        await _save_packed("1/a.txt", b"a" * 10)
+        (obj,) = await file_index.list_user_files(1)
+        await file_index.remove_files([obj.key])
+
+        assert await compact_packs() == 10
+        assert obj.pack is not None
+        assert not (files_dir / obj.pack).exists()
+        assert await file_index.fragmented_packs(0) == []
+
+    asyncio.run(run())
@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import socket
+from collections.abc import AsyncIterator, Iterator
+
+import pytest
+from storage import S3Storage
+
+pytest.importorskip("aiobotocore")
+moto_server = pytest.importorskip("moto.server")
+boto3 = pytest.importorskip("boto3")
+
+BUCKET = "archiver-test"
+# Минимальный размер части multipart-загрузки в S3 (кроме последней)
+PART_SIZE = 5 * 1024 * 1024
+
+
+@pytest.fixture(scope="module")
+def endpoint_url() -> Iterator[str]:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = moto_server.ThreadedMotoServer(ip_address="127.0.0.1", port=port)
+    server.start()
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.stop()
+
+
+@pytest.fixture
+def s3(endpoint_url: str) -> Iterator[S3Storage]:
+    client = boto3.client(
+        "s3",
+        endpoint_url=endpoint_url,
+        region_name="us-east-1",
+        aws_access_key_id="test",
+        aws_secret_access_key="test",
+    )
+    client.create_bucket(Bucket=BUCKET)
+    yield S3Storage(
+        bucket=BUCKET,
+        endpoint_url=endpoint_url,
+        region="us-east-1",
+        access_key_id="test",
+        secret_access_key="test",
+        part_size=PART_SIZE,
+    )
+    for item in client.list_objects_v2(Bucket=BUCKET).get("Contents", []):
+        client.delete_object(Bucket=BUCKET, Key=item["Key"])
+    client.delete_bucket(Bucket=BUCKET)
+
+
+async def _chunks(data: bytes, chunk_size: int = 1024 * 1024) -> AsyncIterator[bytes]:
+    for start in range(0, len(data), chunk_size):
+        yield data[start : start + chunk_size]
+
+
+async def _read(s3: S3Storage, key: str) -> bytes:
+    return b"".join([chunk async for chunk in s3.open_stream(key, 64 * 1024)])
+
+
+def test_small_file_round_trip(s3: S3Storage) -> None:
+    async def run() -> None:
+        digest = hashlib.sha256()
+        size = await s3.put_stream("1/a.txt", _chunks(b"hello"), digest=digest)
+        assert size == 5
+        assert digest.hexdigest() == hashlib.sha256(b"hello").hexdigest()
+        assert await _read(s3, "1/a.txt") == b"hello"
+        stat = await s3.stat("1/a.txt")
+        assert stat is not None and stat.size == 5
+        await s3.close()
+
+    asyncio.run(run())
+
+
+def test_multipart_upload(s3: S3Storage) -> None:
+    # Две полные части и остаток: файл уходит в S3 по частям по мере поступления
+    data = bytes(range(256)) * (PART_SIZE * 2 // 256 + 100)
+
+    async def run() -> None:
+        digest = hashlib.sha256()
+        size = await s3.put_stream("1/big.bin", _chunks(data), digest=digest)
+        assert size == len(data)
+        assert digest.hexdigest() == hashlib.sha256(data).hexdigest()
+        assert await _read(s3, "1/big.bin") == data
+        await s3.close()
+
+    asyncio.run(run())
+
+
+def test_failed_upload_leaves_no_object(s3: S3Storage) -> None:
+    async def broken() -> AsyncIterator[bytes]:
+        yield b"x" * PART_SIZE
+        raise ConnectionError("обрыв скачивания")
+
+    async def run() -> None:
+        with pytest.raises(ConnectionError):
+            await s3.put_stream("1/broken.bin", broken())
+        assert await s3.stat("1/broken.bin") is None
+        client = await s3._get_client()
+        uploads = await client.list_multipart_uploads(Bucket=BUCKET)
+        assert not uploads.get("Uploads")
+        await s3.close()
+
+    asyncio.run(run())
+
+
+def test_missing_object(s3: S3Storage) -> None:
+    async def run() -> None:
+        assert await s3.stat("1/missing.txt") is None
+        with pytest.raises(FileNotFoundError):
+            await _read(s3, "1/missing.txt")
+        await s3.close()
+
+    asyncio.run(run())
+
+
+def test_prefix_operations(s3: S3Storage) -> None:
+    async def run() -> None:
+        for key in ("1/a.txt", "1/sub/b.txt", "12/c.txt"):
+            await s3.put_stream(key, _chunks(b"data"))
+
+        assert await s3.has_prefix("1")
+        assert {obj.key for obj in await s3.list_objects("1")} == {
+            "1/a.txt",
+            "1/sub/b.txt",
+        }
+        # Префикс - директория: файлы пользователя 12 не относятся к пользователю 1
+        assert await s3.delete_prefix("1") == 2
+        assert not await s3.has_prefix("1")
+        assert [obj.key for obj in await s3.list_objects("")] == ["12/c.txt"]
+        await s3.close()
+
+    asyncio.run(run())
@@ -0,0 +1,144 @@
+import asyncio
+import time
+from typing import Any
+
+import pytest
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import EditMessageText, SendMessage
+from config import settings
+from throttling import PRIORITY_HIGH, PRIORITY_LOW, OutboundScheduler, TokenBucket
+
+
+def test_bucket_allows_burst_then_rate() -> None:
+    async def run() -> None:
+        bucket = TokenBucket(rate=20, capacity=2)
+        started = time.monotonic()
+        await bucket.acquire()
+        await bucket.acquire()
+        assert time.monotonic() - started < 0.02
+        await bucket.acquire()
+        # Третий токен появляется через 1 / rate секунд
+        assert time.monotonic() - started >= 0.04
+
+    asyncio.run(run())
+
+
+def test_bucket_serves_high_priority_first() -> None:
+    async def run() -> None:
+        bucket = TokenBucket(rate=20, capacity=1)
+        await bucket.acquire()
+        order: list[str] = []
+
+        async def take(name: str, priority: int) -> None:
+            await bucket.acquire(priority)
+            order.append(name)
+
+        low = asyncio.create_task(take("low", PRIORITY_LOW))
+        await asyncio.sleep(0)
+        high = asyncio.create_task(take("high", PRIORITY_HIGH))
+        await asyncio.gather(low, high)
+        assert order == ["high", "low"]
+
+    asyncio.run(run())
+
+
+def test_bucket_block_pauses_tokens() -> None:
+    async def run() -> None:
+        bucket = TokenBucket(rate=1000, capacity=10)
+        bucket.block(0.1)
+        started = time.monotonic()
+        await bucket.acquire()
+        assert time.monotonic() - started >= 0.09
+
+    asyncio.run(run())
+
+
+def test_bucket_cancelled_waiter_does_not_take_token() -> None:
+    async def run() -> None:
+        bucket = TokenBucket(rate=20, capacity=1)
+        await bucket.acquire()
+        cancelled = asyncio.create_task(bucket.acquire())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        started = time.monotonic()
+        await bucket.acquire()
+        # Токен, освободившийся через 1 / rate, достался живому запросу
+        assert time.monotonic() - started < 0.1
+
+    asyncio.run(run())
+
+
+class FakeApi:
+    """Записывает отправленные запросы вместо обращения к Telegram."""
+
+    def __init__(self, *, retry_after: int | None = None) -> None:
+        self.sent: list[Any] = []
+        self.retry_after = retry_after
+
+    async def __call__(self, bot: Any, method: Any) -> Any:
+        self.sent.append(method)
+        if self.retry_after is not None:
+            retry_after, self.retry_after = self.retry_after, None
+            raise TelegramRetryAfter(
+                method=method, message="Too Many Requests", retry_after=retry_after
+            )
+        return f"ответ на {getattr(method, 'text', None)}"
+
+
+@pytest.fixture
+def fast_limits(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(settings, "THROTTLE_GLOBAL_RATE", 1000)
+    monkeypatch.setattr(settings, "THROTTLE_CHAT_RATE", 20)
+    monkeypatch.setattr(settings, "THROTTLE_CHAT_BURST", 1)
+
+
+@pytest.mark.usefixtures("fast_limits")
+def test_pending_edits_are_coalesced() -> None:
+    async def run() -> None:
+        scheduler = OutboundScheduler()
+        api = FakeApi()
+
+        def edit(text: str) -> Any:
+            method = EditMessageText(chat_id=1, message_id=7, text=text)
+            return scheduler(api, None, method)
+
+        # Первое изменение уходит сразу, остальные ждут токен чата; из них
+        # отправляется только последнее, а ожидавшие получают его ответ
+        results = await asyncio.gather(edit("1"), edit("2"), edit("3"), edit("4"))
+        assert [method.text for method in api.sent] == ["1", "4"]
+        assert results == ["ответ на 1", "ответ на 4", "ответ на 4", "ответ на 4"]
+
+    asyncio.run(run())
+
+
+@pytest.mark.usefixtures("fast_limits")
+def test_edits_of_different_messages_are_not_coalesced() -> None:
+    async def run() -> None:
+        scheduler = OutboundScheduler()
+        api = FakeApi()
+        await asyncio.gather(
+            *(
+                scheduler(
+                    api,
+                    None,
+                    EditMessageText(chat_id=1, message_id=message_id, text="x"),
+                )
+                for message_id in (1, 2, 3)
+            )
+        )
+        assert sorted(method.message_id for method in api.sent) == [1, 2, 3]
+
+    asyncio.run(run())
+
+
+@pytest.mark.usefixtures("fast_limits")
+def test_retry_after_is_retried() -> None:
+    async def run() -> None:
+        scheduler = OutboundScheduler()
+        api = FakeApi(retry_after=0)
+        method = SendMessage(chat_id=1, text="привет")
+        result = await scheduler(api, None, method)
+        assert result == "ответ на привет"
+        assert len(api.sent) == 2
+
+    asyncio.run(run())